@@ -0,0 +1,381 @@
+import asyncio
+import socket
+import struct
+import sys
+from typing import Callable, Dict, Set, Union
+
+from protocol import HEADER, JOIN, LEAVE, LEGACY, LOBBY, MAX_FRAME_SIZE, \
+    PICKLE_MARK, RENAME, VERSION, apply_presence, decode, dumps_legacy, \
+    encode, loads_legacy
+from utils import DEFAULT_LIMITS, DISCONNECT, Messenger, OutboundLimits, \
+    log, serve, traffic
+
+
+async def read_frame(reader: asyncio.StreamReader, header=b'') -> bytes:
+    header += await reader.readexactly(HEADER.size - len(header))
+    *_, length = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"frame of {length} bytes is too large")
+    return header + await reader.readexactly(length)
+
+
+class AsyncMSNServer(Messenger):
+    backlog = 4096
+    version = 2  # presence changes, only the lobby and no sequences
+
+    def __init__(self, ip, port, signal=None, name=None,
+                 limits: OutboundLimits = DEFAULT_LIMITS):
+        super().__init__(ip, port, signal)
+        if name is not None:
+            self.name = name
+        # only the bytes buffered by a transport are known, a peer over the
+        # limit is dropped or, the frames already buffered being out of
+        # reach, the new frame is
+        self.limits = limits
+        self.roster_version = 0
+        self._loop = asyncio.new_event_loop()
+        self._server = None  # type: Union[None, asyncio.AbstractServer]
+        self._closed = None  # type: Union[None, asyncio.Event]
+        self._stopping = False  # asked before the loop was serving
+        self._info = dict()  # type: Dict[asyncio.StreamWriter, str]
+        self._versions = dict()  # type: Dict[asyncio.StreamWriter, int]
+        self._handlers = set()  # type: Set[asyncio.Future]
+
+    @property
+    def info(self):
+        return [self.name] + [name for name in self._info.values() if name]
+
+    def start(self):
+        self.run()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._serve())
+        self._loop.close()
+
+    async def _serve(self):
+        self._closed = asyncio.Event()
+        if self._stopping:
+            self._closed.set()
+        self._server = await asyncio.start_server(
+            self._handle, *self.address, backlog=self.backlog
+        )
+        self.connected = True
+        log.info(f"[{self}] listening connections @ {self.address}")
+        await self._closed.wait()
+        self._server.close()
+        for writer in list(self._info):
+            writer.close()
+        # closed transports feed EOF to the handlers, let them wind down
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        self.connected = False
+
+    def stop(self):
+        self._stopping = True
+        if self._closed is not None:
+            self._loop.call_soon_threadsafe(self._closed.set)
+        if self.reading_thread is not None:
+            self.reading_thread.join()
+        else:
+            self._loop.close()  # never started
+
+    async def _handle(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter):
+        log.info("new connection from %s", writer.get_extra_info("peername"))
+        handled = self._loop.create_future()
+        self._handlers.add(handled)
+        self._info[writer] = ''
+        try:
+            first = await reader.readexactly(1)
+            if first[0] == PICKLE_MARK:
+                log.info("[%s] legacy pickle peer", self)
+                self._versions[writer] = LEGACY
+                await self._serve_legacy(reader, writer, first)
+            else:
+                await self._serve_frames(reader, writer, first)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError,
+                struct.error):
+            pass
+        finally:
+            # whatever went wrong, stop must not wait for this one
+            log.info("[%s] Someone disconnected, removing agent", self)
+            name = self._info.pop(writer)
+            self._versions.pop(writer, None)
+            writer.close()
+            if name:
+                self._announce(LEAVE, [name])
+            self._handlers.discard(handled)
+            handled.set_result(None)
+
+    async def _serve_frames(self, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter, first: bytes):
+        frame = await read_frame(reader, first)
+        while True:
+            command, value = decode(frame)
+            if command == "hello":
+                self._versions[writer] = min(self.version, value)
+                self._write(writer, encode("hello", self._versions[writer]))
+            else:
+                # peers that skip the hello speak version 1
+                self._versions.setdefault(writer, 1)
+                if not self._dispatch(writer, command, value):
+                    return
+            frame = await read_frame(reader)
+
+    async def _serve_legacy(self, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter, first: bytes):
+        received = first + await reader.read(4096)
+        while received:
+            command, value = loads_legacy(received)
+            if not self._dispatch(writer, command, value):
+                return
+            received = await reader.read(4096)
+
+    def _dispatch(self, writer: asyncio.StreamWriter, command, value):
+        traffic.info("%s, %s", command, value)
+        if command == "remove":
+            return False
+        if command == "info":
+            former = self._info[writer]
+            if not former:
+                del self._info[writer]  # last in the roster once named
+            self._info[writer] = value
+            if not former:
+                self._send_roster(writer)
+                self._announce(JOIN, [value], writer)
+            elif former != value:
+                self._announce(RENAME, [former, value])
+        elif command == "resync":
+            self._send_roster(writer)
+        elif command == "message":
+            _, _, self.message = value
+            self._send_to_all(writer)
+        return True
+
+    def _encode(self, writer: asyncio.StreamWriter, command, value, frames):
+        # one encoding per codec version, shared by every writer using it
+        version = self._versions[writer]
+        if version not in frames:
+            if version == LEGACY:
+                frames[version] = dumps_legacy(command, value)
+            else:
+                frames[version] = encode(command, value, version)
+        return frames[version]
+
+    def _write(self, writer: asyncio.StreamWriter, frame: bytes):
+        # an empty buffer takes any frame, the limit is on the backlog
+        transport = writer.transport
+        if transport.is_closing():
+            return
+        buffered = transport.get_write_buffer_size()
+        if buffered and buffered + len(frame) > self.limits.max_bytes:
+            if self.limits.policy == DISCONNECT:
+                log.warning("[%s] Removing agent: too slow to keep up", self)
+                transport.abort()
+            else:
+                traffic.warning("[%s] Dropping a frame for a slow peer", self)
+            return
+        writer.write(frame)
+
+    def _send_roster(self, writer: asyncio.StreamWriter):
+        # only send the names of the connected
+        roster = (LOBBY, self.roster_version, self.info)
+        self._write(writer, self._encode(writer, "roster", roster, dict()))
+
+    def _announce(self, change: int, changed: list, exclude=None):
+        # peers speaking version 2 get the change, older ones still get the
+        # whole roster
+        self.roster_version += 1
+        presence = (LOBBY, self.roster_version, change, changed)
+        roster = None
+        frames = dict()
+        rosters = dict()
+        for writer, version in list(self._versions.items()):
+            if writer == exclude:
+                continue
+            if version >= 2:
+                frame = self._encode(writer, "presence", presence, frames)
+            else:
+                if roster is None:
+                    roster = (LOBBY, self.roster_version, self.info)
+                frame = self._encode(writer, "roster", roster, rosters)
+            self._write(writer, frame)
+
+    def _send_to_all(self, sender: asyncio.StreamWriter):
+        frames = dict()
+        message = (LOBBY, 0, self.message)
+        for writer in list(self._versions):
+            if not writer == sender:
+                self._write(
+                    writer, self._encode(writer, "message", message, frames)
+                )
+
+    def __str__(self):
+        return self.name
+
+
+class AsyncMSNClient:
+    def __init__(self, ip, port, name,
+                 on_message: Callable[[str], None] = None,
+                 on_info: Callable[[list], None] = None):
+        self.address = ip, port
+        self.name = name
+        self.on_message = on_message
+        self.on_info = on_info
+        self.version = VERSION
+        self.roster_version = 0
+        self.last_sequence = 0  # of the last message received
+        self.server_info = list()
+        self._resyncing = False
+        self._reader = None  # type: Union[None, asyncio.StreamReader]
+        self._writer = None  # type: Union[None, asyncio.StreamWriter]
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(
+            *self.address
+        )
+        # the hello layout never changes, any server can read it
+        self._writer.write(encode("hello", VERSION, 1))
+        command, value = decode(await read_frame(self._reader))
+        while command != "hello":
+            command, value = decode(await read_frame(self._reader))
+        self.version = value
+        await self.send_info()
+
+    async def listen(self):
+        while True:
+            try:
+                command, value = decode(await read_frame(self._reader))
+            except (asyncio.IncompleteReadError, ConnectionError, ValueError,
+                    struct.error):
+                break
+            # only the lobby is followed, no other room is ever joined
+            if command == "message":
+                room, sequence, text = value
+                if room != LOBBY:
+                    continue
+                if sequence:
+                    self.last_sequence = sequence
+                if self.on_message is not None:
+                    self.on_message(text)
+            elif command == "roster":
+                _, self.roster_version, self.server_info = value
+                self._resyncing = False
+                self._info_changed()
+            elif command == "presence" and not self._resyncing:
+                room, roster_version, change, changed = value
+                if room != LOBBY:
+                    continue
+                if roster_version != self.roster_version + 1:
+                    # a change was missed, the whole roster is needed again
+                    self._resyncing = True
+                    await self._send("resync", LOBBY)
+                    continue
+                self.roster_version = roster_version
+                apply_presence(self.server_info, change, changed)
+                self._info_changed()
+            elif command == "ping":
+                await self._send("pong")
+
+    def _info_changed(self):
+        if self.on_info is not None:
+            self.on_info(list(self.server_info))
+
+    async def _send(self, command: str, value=None):
+        self._writer.write(encode(command, value, self.version))
+        await self._writer.drain()
+
+    async def send_message(self, message: str):
+        await self._send("message", (LOBBY, 0, message))
+
+    async def send_info(self):
+        await self._send("info", self.name)
+
+    async def close(self):
+        try:
+            await self._send("remove")
+        except ConnectionError:
+            pass
+        self._writer.close()
+
+
+class AsyncClientAdapter(Messenger):
+    # exposes an AsyncMSNClient through the MSNClient interface, the event
+    # loop runs in the reading thread so the GUI can drive it as usual
+    def __init__(self, ip=None, port=None,
+                 message_signal=None, info_signal=None):
+        super().__init__(ip, port, message_signal)
+        self.info_signal = info_signal
+        self.server_info = list()
+        self._loop = asyncio.new_event_loop()
+        self._client = None  # type: Union[None, AsyncMSNClient]
+
+    def connect(self, propagate=False):
+        if self.address == (None, None):
+            log.error(f"[{self}] No address used")
+        self._client = AsyncMSNClient(
+            *self.address, self.name,
+            on_message=self._on_message, on_info=self._on_info
+        )
+        try:
+            log.info(f"[{self}] Trying to connect to {self.address}")
+            self._loop.run_until_complete(
+                asyncio.wait_for(self._client.connect(), 10)
+            )
+            self.connected = True
+        except (OSError, asyncio.TimeoutError):
+            log.warning("Could not reach host")
+            if propagate:
+                raise socket.timeout
+
+    def _on_message(self, value):
+        # what the loop reads in one go is delivered together
+        if not self.inbox and self.signal is not None:
+            self._loop.call_soon(self.deliver)
+        self.message = value
+
+    def _on_info(self, value):
+        self.server_info = value
+        if self.info_signal is not None:
+            self.info_signal.emit()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._client.listen())
+        self.connected = False
+        self._loop.close()
+        log.info(f"{self} stops listening")
+
+    def _submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def send_message(self, message: str):
+        if self.connected:
+            self._submit(self._client.send_message(message))
+        else:
+            log.warning(f"[{self}] Not connected")
+
+    def send_info(self):
+        if self.connected:
+            self._client.name = self.name
+            self._submit(self._client.send_info())
+
+    def stop(self):
+        if self.connected:
+            self._submit(self._client.close()).result(2)
+        self.reading_thread.join()
+
+    def __str__(self):
+        return "Client"
+
+
+def main():
+    if len(sys.argv) > 1:
+        name = sys.argv[1]
+    else:
+        name = None
+    serve(AsyncMSNServer("", 7979, name=name))
+
+
+if __name__ == '__main__':
+    main()
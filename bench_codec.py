@@ -0,0 +1,39 @@
+import pickle
+import sys
+import timeit
+
+from protocol import decode, dumps_legacy, encode, loads_legacy
+
+SAMPLES = {
+    "message": ("message", ("", 1, "[someone@somewhere] hello there\n")),
+    "long message": ("message", ("", 2, "lorem ipsum dolor sit amet " * 40)),
+    "info": ("info", "someone@somewhere"),
+    "roster": ("roster", ("", 1, [f"user{i}@host{i}" for i in range(50)])),
+}
+
+
+def bench(number):
+    print(f"{'sample':<14}{'codec':<8}{'bytes':>8}"
+          f"{'encode µs':>12}{'decode µs':>12}")
+    for sample, (command, value) in SAMPLES.items():
+        frame = encode(command, value)
+        pickled = dumps_legacy(command, value)
+        runs = (
+            ("binary", frame,
+             lambda: encode(command, value), lambda: decode(frame)),
+            ("pickle", pickled,
+             lambda: dumps_legacy(command, value),
+             lambda: pickle.loads(pickled)),
+            ("safe", pickled,
+             lambda: dumps_legacy(command, value),
+             lambda: loads_legacy(pickled)),
+        )
+        for codec, data, encoder, decoder in runs:
+            encoding = timeit.timeit(encoder, number=number) / number * 1e6
+            decoding = timeit.timeit(decoder, number=number) / number * 1e6
+            print(f"{sample:<14}{codec:<8}{len(data):>8}"
+                  f"{encoding:>12.2f}{decoding:>12.2f}")
+
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,368 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from msn_client import MSNClient
+from protocol import FrameBuffer, LOBBY, VERSION, decode_frames, encode
+from utils import open_connection, set_log_level, unix_path
+
+SERVERS = {
+    "msn": "msn_server.py",
+    "multipoint": "multipoint_server.py",
+}
+# the flood limits of the msn server would throttle the few clients sending
+# it all, they are lifted unless given to the server
+UNLIMITED = (
+    "--rate-messages", "--rate-bytes", "--room-rate-messages",
+    "--room-rate-bytes",
+)
+
+
+class Recorder:
+    # every payload starts with the time it was due to be sent, stamping the
+    # schedule rather than the actual send keeps a stalled server from
+    # hiding its own delays
+    def __init__(self):
+        self.latencies = list()
+
+    def record(self, text: str):
+        stamp, _, _ = text.partition(" ")
+        try:
+            due = float(stamp)
+        except ValueError:
+            return  # welcome and server notices
+        self.latencies.append(time.perf_counter() - due)
+
+
+class RawClients:
+    # plain sockets all served by a single selector thread, so thousands of
+    # clients do not need thousands of threads
+    def __init__(self, server: str, address: tuple, count: int, rooms: int,
+                 recorder: Recorder, compress=False):
+        self.server = server
+        self.recorder = recorder
+        self.sockets = list()
+        self.rooms = list()
+        self._buffers = dict()
+        self._selector = selectors.DefaultSelector()
+        for index in range(count):
+            connection = open_connection(address)
+            if unix_path(address) is None:
+                connection.setsockopt(
+                    socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+                )
+            room = f"room{index % rooms}" if rooms else LOBBY
+            if server == "msn":
+                greeting = encode("hello", VERSION, 1) + \
+                    encode("info", f"bench{index}")
+                if room != LOBBY:
+                    greeting += encode("join", room)
+                if compress:
+                    greeting += encode("compress", 1, VERSION)
+                connection.sendall(greeting)
+                self._buffers[connection] = FrameBuffer()
+            else:
+                self._buffers[connection] = bytearray()
+            self._selector.register(connection, selectors.EVENT_READ)
+            self.sockets.append(connection)
+            self.rooms.append(room)
+        self._running = True
+        self._thread = threading.Thread(target=self._receive, daemon=True)
+        self._thread.start()
+
+    def send(self, index: int, text: str):
+        if self.server == "msn":
+            frame = encode("message", (self.rooms[index], 0, text))
+        else:
+            frame = f"{text}\n".encode()
+        self.sockets[index].sendall(frame)
+
+    def _receive(self):
+        while self._running:
+            for key, _ in self._selector.select(0.1):
+                connection = key.fileobj
+                if self.server == "msn":
+                    self._receive_frames(connection)
+                else:
+                    self._receive_lines(connection)
+
+    def _receive_frames(self, connection: socket.socket):
+        buffer = self._buffers[connection]
+        if buffer.recv_from(connection) == 0:
+            self._selector.unregister(connection)
+            return
+        for frame in buffer.frames():
+            for command, value in decode_frames(frame):
+                if command == "message":
+                    self.recorder.record(value[2])
+                elif command == "ping":
+                    connection.sendall(encode("pong"))
+
+    def _receive_lines(self, connection: socket.socket):
+        received = connection.recv(65536)
+        if not received:
+            self._selector.unregister(connection)
+            return
+        buffer = self._buffers[connection]
+        buffer += received
+        *lines, rest = buffer.split(b"\n")
+        self._buffers[connection] = bytearray(rest)
+        for line in lines:
+            self.recorder.record(str(line, "utf-8", "replace"))
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        for connection in self.sockets:
+            connection.close()
+        self._selector.close()
+
+
+class _Probe:
+    # stands in for the Qt signal of a client and records what it got
+    def __init__(self, recorder: Recorder):
+        self.recorder = recorder
+
+    def emit(self, messages: list):
+        for text in messages:
+            self.recorder.record(text)
+
+
+class MSNClients:
+    # the real client, one reading thread each
+    def __init__(self, address: tuple, count: int, rooms: int,
+                 recorder: Recorder, compress=False):
+        self.clients = list()
+        self.rooms = list()
+        for index in range(count):
+            client = MSNClient(*address, message_signal=_Probe(recorder))
+            client.name = f"bench{index}"
+            client.compress = compress
+            client.connect(propagate=True)
+            client.run()
+            room = f"room{index % rooms}" if rooms else LOBBY
+            if room != LOBBY:
+                client.join(room)
+            self.clients.append(client)
+            self.rooms.append(room)
+
+    def send(self, index: int, text: str):
+        self.clients[index].send_message(text, self.rooms[index])
+
+    def close(self):
+        for client in self.clients:
+            client.stop()
+
+
+def start_server(args) -> subprocess.Popen:
+    command = [
+        sys.executable, SERVERS[args.server], "bench", "--port",
+        str(args.port), *args.server_args
+    ]
+    if args.unix is not None:
+        command += ["--unix", args.unix]
+    if args.server == "msn":
+        for option in UNLIMITED:
+            if not any(
+                given == option or given.startswith(f"{option}=")
+                for given in args.server_args
+            ):
+                command += [option, "0"]
+    server = subprocess.Popen(
+        command, cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", args.port), 1).close()
+            return server
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                raise RuntimeError(f"{args.server} server did not start")
+            time.sleep(0.05)
+
+
+def stop_server(server: subprocess.Popen) -> resource.struct_rusage:
+    server.send_signal(signal.SIGINT)
+    try:
+        server.wait(10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+    # the server is the only child, its workers are waited for by it
+    return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+def percentile(ordered: list, fraction: float) -> float:
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def fan_out(rooms: list) -> float:
+    # deliveries expected for a message of each sender
+    sizes = dict()
+    for room in rooms:
+        sizes[room] = sizes.get(room, 0) + 1
+    return sum(sizes[room] - 1 for room in rooms) / len(rooms)
+
+
+def payload(size: int, due: float) -> str:
+    stamp = f"{due:.9f} "
+    return stamp + "x" * max(0, size - len(stamp))
+
+
+def revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench(args) -> dict:
+    server = start_server(args)
+    recorder = Recorder()
+    address = "127.0.0.1", args.port
+    if args.unix is not None:
+        address = f"unix:{unix_path(args.unix) or args.unix}", None
+    try:
+        if args.clients_kind == "msn":
+            clients = MSNClients(
+                address, args.clients, args.rooms, recorder, args.compress
+            )
+        else:
+            clients = RawClients(
+                args.server, address, args.clients, args.rooms, recorder,
+                args.compress
+            )
+        time.sleep(args.warmup)  # rosters and backlogs go out first
+        recorder.latencies.clear()
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        # open loop: messages are due at a fixed rate, round robin over the
+        # clients, whatever the server manages to deliver
+        interval = 1 / args.rate
+        start = time.perf_counter()
+        due = start
+        sent = 0
+        while due < start + args.duration:
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            clients.send(sent % args.clients, payload(args.size, due))
+            sent += 1
+            due += interval
+        sending = time.perf_counter() - start
+        time.sleep(args.drain)
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        clients.close()
+    finally:
+        usage = stop_server(server)
+    latencies = sorted(recorder.latencies)
+    expected = int(sent * fan_out(clients.rooms))
+    return {
+        "server": args.server,
+        "server_args": args.server_args,
+        "clients_kind": args.clients_kind,
+        "clients": args.clients,
+        "rooms": args.rooms,
+        "rate": args.rate,
+        "size": args.size,
+        "compress": args.compress,
+        "transport": "tcp" if args.unix is None else "unix",
+        "duration": sending,
+        "sent": sent,
+        "expected": expected,
+        "delivered": len(latencies),
+        "sent_per_sec": sent / sending,
+        "msgs_per_sec": len(latencies) / sending,
+        "latency_ms": {
+            name: None if value is None else value * 1e3
+            for name, value in (
+                ("p50", percentile(latencies, 0.5)),
+                ("p99", percentile(latencies, 0.99)),
+                ("p999", percentile(latencies, 0.999)),
+                ("max", latencies[-1] if latencies else None),
+            )
+        },
+        "server_cpu_sec": usage.ru_utime + usage.ru_stime,
+        # kilobytes on Linux, bytes on macOS
+        "server_max_rss": usage.ru_maxrss,
+        "clients_cpu_sec": after.ru_utime + after.ru_stime -
+        before.ru_utime - before.ru_stime,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "revision": revision(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load a chat server on localhost and measure it"
+    )
+    parser.add_argument("--server", choices=sorted(SERVERS), default="msn")
+    parser.add_argument(
+        "--clients-kind", choices=("raw", "msn"), default="raw",
+        help="plain sockets on one thread or MSNClient, msn server only"
+    )
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument(
+        "--rooms", type=int, default=0,
+        help="spread the clients over that many rooms, msn server only"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=200,
+        help="messages per second sent over all the clients"
+    )
+    parser.add_argument("--size", type=int, default=64,
+                        help="bytes of text in every message")
+    parser.add_argument(
+        "--compress", action="store_true",
+        help="ask for deflated frames, msn server only"
+    )
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--warmup", type=float, default=1)
+    parser.add_argument("--drain", type=float, default=1,
+                        help="seconds left for the last deliveries")
+    parser.add_argument("--port", type=int, default=7989)
+    parser.add_argument(
+        "--unix", default=None,
+        help="connect the clients through this Unix socket of the server"
+    )
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument(
+        "server_args", nargs=argparse.REMAINDER,
+        help="passed on to the server, after --"
+    )
+    args = parser.parse_args()
+    if args.server_args[:1] == ["--"]:
+        args.server_args = args.server_args[1:]
+    if args.server != "msn" and (
+        args.clients_kind == "msn" or args.rooms or args.compress
+    ):
+        parser.error("MSN clients, rooms and compression need the msn server")
+    set_log_level(logging.WARNING)
+    results = bench(args)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,12 @@
 import socket
 
-from utils import Messenger, log
+from utils import Messenger, client_socket, endpoint, log
 
 
 class Client(Messenger):
     def __init__(self, ip=None, port=None, signal=None):
         super(Client, self).__init__(ip, port, signal)
-        self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.connection = client_socket(self.address)
         self.connection.settimeout(2)
 
     def connect(self, propagate=False):
@@ -16,14 +15,14 @@ class Client(Messenger):
         try:
             log.info(f"[{self}] Trying to connect to {self.address}")
             self.connection.settimeout(10)
-            self.connection.connect(self.address)
+            self.connection.connect(endpoint(self.address))
             self.connection.settimeout(2)
             self.connected = True
             if not self.agnostic:
                 self.send_message(
                     f"<{self.name} has entered the chat>\n"
                 )
-        except (ConnectionRefusedError, socket.timeout):
+        except (ConnectionRefusedError, FileNotFoundError, socket.timeout):
             log.warning("Could not reach host")
             if propagate:
                 raise
@@ -32,6 +31,7 @@ class Client(Messenger):
         while self.connected:
             try:
                 self.message = self.connection.recv(4096)
+                self.deliver()
                 if self.message == b'':
                     self.connected = False
             except socket.timeout:
@@ -0,0 +1,66 @@
+import collections
+import itertools
+import os
+
+from utils import DISCONNECT, OutboundLimits, unix_path
+
+# servers linked as nodes each serve their own clients and gossip with the
+# nodes they are linked to: messages and the names each node holds go out
+# once with an id unique to the federation, every node forwards what it
+# has not seen yet to its other links, so any connected graph of nodes
+# reaches them all
+NODE_VERSION = 10  # first version linking nodes
+DEDUPE_SIZE = 65536  # ids remembered, the latest ones
+# a link carries the traffic of every client, a node too stuck to take it
+# is unlinked and told everything again once linked back
+LINK_LIMITS = OutboundLimits(1024 * 1024, 256 * 1024 * 1024, DISCONNECT)
+
+
+def node_id() -> str:
+    # a new one every run, a node coming back is a new node
+    return os.urandom(8).hex()
+
+
+def peer_address(text: str) -> tuple:
+    # host:port, or unix:/path for a node on the same host
+    if unix_path(text) is not None:
+        return text, 0
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+class MessageIds:
+    # node:counter, unique as long as the node ids are
+    def __init__(self, node: str):
+        self.node = node
+        self._counter = itertools.count(1)
+
+    def next(self) -> str:
+        return f"{self.node}:{next(self._counter)}"
+
+
+class DedupeCache:
+    # the last capacity ids seen, the oldest is forgotten first; an id
+    # comes back within a few hops or never
+    __slots__ = ("capacity", "_order", "_ids")
+
+    def __init__(self, capacity=DEDUPE_SIZE):
+        self.capacity = capacity
+        self._order = collections.deque()
+        self._ids = set()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, identifier: str):
+        return identifier in self._ids
+
+    def add(self, identifier: str) -> bool:
+        # False when it was seen already
+        if identifier in self._ids:
+            return False
+        if len(self._order) == self.capacity:
+            self._ids.discard(self._order.popleft())
+        self._order.append(identifier)
+        self._ids.add(identifier)
+        return True
@@ -1,11 +1,11 @@
 from typing import Union
 
 from PyQt5 import QtGui
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QTextCursor
 from PyQt5.QtWidgets import QMainWindow, QHBoxLayout, \
     QGroupBox, QVBoxLayout, QLabel, QLineEdit, QComboBox, QPushButton, \
-    QTextEdit
+    QPlainTextEdit
 
 from client import Client
 from server import Server
@@ -70,6 +70,9 @@ class ServerConfigurator(QGroupBox):
 
 
 class MessageBox(QGroupBox):
+    frame_interval = 50  # ms, incoming messages are rendered together
+    max_history = 5000  # lines kept, the oldest go first
+
     def __init__(self, parent, name):
         super().__init__(name)
         self.parent = parent  # type: QMainWindow
@@ -77,7 +80,13 @@ class MessageBox(QGroupBox):
         layout = QVBoxLayout()
         self.setLayout(layout)
         self.text_history_box = TextShow()
+        self.text_history_box.setMaximumBlockCount(self.max_history)
         layout.addWidget(self.text_history_box)
+        self._pending = list()
+        self._frame = QTimer(self)
+        self._frame.setSingleShot(True)
+        self._frame.setInterval(self.frame_interval)
+        self._frame.timeout.connect(self._render)
         text_layout = QHBoxLayout()
         self.user_text_message_box = QLineEdit()
         self.user_text_message_box.setEnabled(False)
@@ -107,12 +116,25 @@ class MessageBox(QGroupBox):
             self.append_message(signed_msg)
 
     def append_message(self, message):
-        self.text_history_box.insertPlainText(message)
+        # the first message of a frame starts the timer, the others wait
+        # for it
+        if isinstance(message, bytes):
+            message = message.decode(errors="replace")
+        self._pending.append(message)
+        if not self._frame.isActive():
+            self._frame.start()
+
+    def _render(self):
+        text = "".join(self._pending)
+        self._pending.clear()
+        self.text_history_box.moveCursor(QTextCursor.End)
+        self.text_history_box.insertPlainText(text)
         self.text_history_box.moveCursor(QTextCursor.End)
 
-    def update_text(self):
+    def update_text(self, messages: list):
         if self.endpoint is not None:
-            self.append_message(self.endpoint.message)
+            for message in messages:
+                self.append_message(message)
         else:
             log.error("Endpoint is not connected")
 
@@ -120,7 +142,7 @@ class MessageBox(QGroupBox):
         self.endpoint = endpoint
 
 
-class TextShow(QTextEdit):
+class TextShow(QPlainTextEdit):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -0,0 +1,89 @@
+import array
+import json
+import socket
+import struct
+from typing import List, Tuple, Union
+
+# a server started with the control socket of a running one takes over its
+# listening sockets and its clients, their descriptors are passed along
+# with SCM_RIGHTS after a description of what they are
+REQUEST = b"takeover\n"
+ACK = b"ok"
+HEADER = struct.Struct("!II")  # bytes of state, descriptors
+MAX_FDS = 250  # descriptors per message, the kernel takes 253 at most
+
+
+def _recv_exactly(channel: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        received = channel.recv(size - len(data))
+        if not received:
+            raise ConnectionAbortedError("the other server went away")
+        data += received
+    return bytes(data)
+
+
+def _send_fds(channel: socket.socket, fds: List[int]):
+    # a byte carries each batch, the receiver gets them one at a time
+    for start in range(0, len(fds), MAX_FDS):
+        batch = array.array("i", fds[start:start + MAX_FDS])
+        channel.sendmsg(
+            [b"."], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, batch)]
+        )
+
+
+def _recv_fds(channel: socket.socket, count: int) -> List[int]:
+    fds = array.array("i")
+    while len(fds) < count:
+        wanted = min(MAX_FDS, count - len(fds))
+        data, ancillary, flags, _ = channel.recvmsg(
+            1, socket.CMSG_SPACE(wanted * fds.itemsize)
+        )
+        if not data:
+            raise ConnectionAbortedError("the other server went away")
+        for level, kind, payload in ancillary:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(
+                    payload[:len(payload) - len(payload) % fds.itemsize]
+                )
+        if flags & socket.MSG_CTRUNC:
+            raise OSError("descriptors were lost on the way")
+    return fds.tolist()
+
+
+def asked(channel: socket.socket) -> bool:
+    # anything else is a peer checking whether the socket is in use
+    try:
+        return _recv_exactly(channel, len(REQUEST)) == REQUEST
+    except ConnectionAbortedError:
+        return False
+
+
+def hand_over(channel: socket.socket, state: dict,
+              sockets: List[socket.socket]):
+    # returns once the new server has everything, the sockets are then its
+    # own as well and must not be written to any more
+    data = json.dumps(state).encode()
+    channel.sendall(HEADER.pack(len(data), len(sockets)) + data)
+    _send_fds(channel, [sock.fileno() for sock in sockets])
+    if _recv_exactly(channel, len(ACK)) != ACK:
+        raise ValueError("the new server did not take over")
+
+
+def take_over(path: str, timeout=10.0) -> Union[
+        None, Tuple[dict, List[socket.socket]]]:
+    # the state and the sockets of the server listening on path, None when
+    # nobody does
+    channel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    channel.settimeout(timeout)
+    with channel:
+        try:
+            channel.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        channel.sendall(REQUEST)
+        size, count = HEADER.unpack(_recv_exactly(channel, HEADER.size))
+        state = json.loads(_recv_exactly(channel, size).decode())
+        fds = _recv_fds(channel, count)
+        channel.sendall(ACK)
+    return state, [socket.socket(fileno=fd) for fd in fds]
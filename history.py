@@ -0,0 +1,220 @@
+import bisect
+import collections
+import mmap
+import os
+import itertools
+import struct
+from typing import Dict, List
+
+from protocol import HEADER
+
+OFFSET = struct.Struct("!Q")
+
+
+class Segment:
+    # an append-only file of encoded frames and an index of their offsets,
+    # the index is preallocated and memory mapped, entry i holding where
+    # the frame of sequence first + i starts
+    def __init__(self, directory, first: int, capacity: int):
+        self.first = first
+        self.capacity = capacity
+        path = os.path.join(directory, f"{first:020d}")
+        self.log_path = f"{path}.log"
+        self.index_path = f"{path}.idx"
+        self._log = open(self.log_path, "ab+")
+        self._size = self._log.seek(0, os.SEEK_END)
+        with open(self.index_path, "ab+") as index:
+            if index.seek(0, os.SEEK_END) < capacity * OFFSET.size:
+                index.truncate(capacity * OFFSET.size)
+        self._index_file = open(self.index_path, "rb+")
+        self._index = mmap.mmap(self._index_file.fileno(), 0)
+        self.count = self._recover_count()
+
+    def _recover_count(self) -> int:
+        # offsets are increasing and the unused entries are zeros, the
+        # first entry after the start holding 0 is where the index ends
+        if self._size == 0:
+            return 0
+        low, high = 1, self.capacity
+        while low < high:
+            middle = (low + high) // 2
+            if OFFSET.unpack_from(self._index, middle * OFFSET.size)[0]:
+                low = middle + 1
+            else:
+                high = middle
+        # frames are indexed once written, anything after the last indexed
+        # frame comes from an interrupted append
+        start, = OFFSET.unpack_from(self._index, (low - 1) * OFFSET.size)
+        self._log.seek(start)
+        header = self._log.read(HEADER.size)
+        end = start + HEADER.size
+        if len(header) == HEADER.size:
+            end += HEADER.unpack(header)[-1]
+        if end > self._size:
+            low -= 1
+            end = start
+        if end < self._size:
+            self._log.truncate(end)
+            self._size = end
+        return low
+
+    @property
+    def last(self) -> int:
+        return self.first + self.count - 1
+
+    @property
+    def full(self) -> bool:
+        return self.count == self.capacity
+
+    def append(self, frame: bytes):
+        self._log.write(frame)
+        self._log.flush()
+        OFFSET.pack_into(self._index, self.count * OFFSET.size, self._size)
+        self._size += len(frame)
+        self.count += 1
+
+    def read_from(self, sequence: int) -> bytes:
+        # all the frames from sequence to the end, in a single read
+        start, = OFFSET.unpack_from(
+            self._index, (sequence - self.first) * OFFSET.size
+        )
+        self._log.seek(start)
+        return self._log.read(self._size - start)
+
+    def close(self):
+        self._index.close()
+        self._index_file.close()
+        self._log.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.log_path)
+        os.remove(self.index_path)
+
+
+class SegmentLog:
+    def __init__(self, directory, segment_capacity=65536, max_segments=16):
+        self.directory = directory
+        self.segment_capacity = segment_capacity
+        self.max_segments = max_segments
+        os.makedirs(directory, exist_ok=True)
+        firsts = sorted(
+            int(name[:-4]) for name in os.listdir(directory)
+            if name.endswith(".log")
+        )
+        self._firsts = list()  # type: List[int]
+        self._segments = dict()  # type: Dict[int, Segment]
+        for first in firsts:
+            self._open(first)
+        if not self._segments:
+            self._open(1)
+
+    def _open(self, first: int) -> Segment:
+        segment = Segment(self.directory, first, self.segment_capacity)
+        self._firsts.append(first)
+        self._segments[first] = segment
+        return segment
+
+    @property
+    def first(self) -> int:
+        return self._firsts[0]
+
+    @property
+    def last(self) -> int:
+        return self._segments[self._firsts[-1]].last
+
+    def append(self, sequence: int, frame: bytes):
+        segment = self._segments[self._firsts[-1]]
+        if segment.full:
+            segment = self._open(sequence)
+            while len(self._firsts) > self.max_segments:
+                self._segments.pop(self._firsts.pop(0)).remove()
+        segment.append(frame)
+
+    def read_from(self, sequence: int) -> bytes:
+        sequence = max(sequence, self.first)
+        if sequence > self.last:
+            return b''
+        position = bisect.bisect_right(self._firsts, sequence) - 1
+        chunks = [self._segments[self._firsts[position]].read_from(sequence)]
+        for first in self._firsts[position + 1:]:
+            chunks.append(self._segments[first].read_from(first))
+        return b''.join(chunks)
+
+    def close(self):
+        for segment in self._segments.values():
+            segment.close()
+
+
+class MessageHistory:
+    # the last messages are kept in memory, older ones in the optional
+    # segment log; both hold encoded frames so a replay is a plain copy
+    def __init__(self, size=100, directory=None, opened=True,
+                 **log_options):
+        # a history taken over from another process is opened once that
+        # process stopped writing to the log
+        self.size = size
+        self._recent = collections.deque(maxlen=size)
+        self.directory = directory
+        self.log = None
+        self.sequence = 0
+        self._log_options = log_options
+        if directory is not None and opened:
+            self.open()
+
+    def open(self):
+        # the sequence goes on from the end of the log
+        self.log = SegmentLog(self.directory, **self._log_options)
+        self.sequence = self.log.last
+
+    def append(self, frame: bytes) -> int:
+        # the frame must carry the sequence returned by next_sequence
+        self.sequence += 1
+        self._recent.append(frame)
+        if self.log is not None:
+            self.log.append(self.sequence, frame)
+        return self.sequence
+
+    @property
+    def next_sequence(self) -> int:
+        return self.sequence + 1
+
+    def since(self, sequence: int, limit: int) -> bytes:
+        # at most the last limit frames following sequence, in one buffer
+        first = max(sequence + 1, self.sequence - limit + 1, 1)
+        if first > self.sequence:
+            return b''
+        in_memory = self.sequence - len(self._recent) + 1
+        if first >= in_memory:
+            return b''.join(
+                itertools.islice(self._recent, first - in_memory, None)
+            )
+        if self.log is not None:
+            return self.log.read_from(first)
+        return b''.join(self._recent)
+
+    def last(self, count: int) -> bytes:
+        return self.since(self.sequence - count, count)
+
+    def recent(self) -> list:
+        # the frames in memory, oldest first
+        return list(self._recent)
+
+    def restore(self, sequence: int, recent: list) -> bool:
+        # as handed over by another process, the log is opened again in
+        # case it wrote to it meanwhile; False, the history being what the
+        # log holds, when the log does not end at sequence
+        if self.directory is not None:
+            if self.log is not None:
+                self.log.close()
+            self.open()
+            if self.log.last != sequence:
+                return False
+        self.sequence = sequence
+        self._recent.clear()
+        self._recent.extend(recent)
+        return True
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
@@ -0,0 +1,116 @@
+import bisect
+
+# seconds, from a tenth of a millisecond to a second
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1,
+)
+
+
+def labels(**pairs) -> str:
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"')
+         .replace("\n", "\\n"))
+        for name, value in pairs.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+# the metrics are only updated from the thread serving the connections, plain
+# attributes need no lock and cost a single addition
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, label=""):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name + self.label, self.value
+
+
+class Gauge:
+    # read from the state it describes when the metrics are rendered
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, function, label=""):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.function = function
+
+    def samples(self):
+        yield self.name + self.label, self.function()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            yield f'{self.name}_bucket{labels(le=bound)}', total
+        yield f"{self.name}_sum", self.sum
+        yield f"{self.name}_count", self.count
+
+
+class Registry:
+    def __init__(self):
+        self._families = dict()  # name -> metrics sharing it
+
+    def _register(self, metric):
+        self._families.setdefault(metric.name, list()).append(metric)
+        return metric
+
+    def counter(self, name: str, description: str, label="") -> Counter:
+        return self._register(Counter(name, description, label))
+
+    def gauge(self, name: str, description: str, function,
+              label="") -> Gauge:
+        return self._register(Gauge(name, description, function, label))
+
+    def histogram(self, name: str, description: str,
+                  buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, description, buckets))
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        lines = list()
+        for name, family in self._families.items():
+            lines.append(f"# HELP {name} {family[0].description}")
+            lines.append(f"# TYPE {name} {family[0].kind}")
+            for metric in family:
+                for sample, value in metric.samples():
+                    lines.append(f"{sample} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def http_response(text: str) -> bytes:
+    body = text.encode()
+    return (
+        b"HTTP/1.0 200 OK\r\n"
+        b"Content-Type: text/plain; version=0.0.4\r\n"
+        b"Content-Length: %d\r\n"
+        b"Connection: close\r\n\r\n" % len(body)
+    ) + body
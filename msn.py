@@ -1,5 +1,4 @@
 import os
-import pickle
 import sys
 import json
 import threading
@@ -12,81 +11,18 @@ from PyQt5.QtWidgets import QMainWindow, QApplication, QWidget, QHBoxLayout, \
     QGroupBox, QVBoxLayout, QLabel, QLineEdit, QPushButton, QComboBox
 from playsound import playsound
 
+from async_msn import AsyncClientAdapter
 from gui import MessageBox, ServerConfigurator
-from utils import log, socket, Messenger
+from msn_client import MSNClient
+from utils import log, socket
 from themes import COLOR_SCHEME, THEMES, DEFAULT_THEME
 
 CONFIG_FILE = ".config"
 DEFAULT_NAME = f"{os.getlogin()}@{socket.gethostname()}"
 
 
-class MSNClient(Messenger):
-    def __init__(self, ip=None, port=None,
-                 message_signal=None, info_signal=None):
-        super().__init__(ip, port, message_signal)
-        self.info_signal = info_signal  # type: pyqtSignal
-        self.server_info = list()
-        self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.connection.settimeout(2)
-
-    def connect(self, propagate=False):
-        if self.address == (None, None):
-            log.error(f"[{self}] No address used")
-        try:
-            log.info(f"[{self}] Trying to connect to {self.address}")
-            self.connection.settimeout(10)
-            self.connection.connect(self.address)
-            self.connection.settimeout(2)
-            self.connected = True
-            self.connection.send(pickle.dumps(("info", self.name)))
-        except (ConnectionError, socket.timeout):
-            log.warning("Could not reach host")
-            if propagate:
-                raise
-
-    def _run(self):
-        while self.connected:
-            try:
-                data = self.connection.recv(4096)
-                if data == b'':
-                    self.connected = False
-                    break
-                else:
-                    command, value = pickle.loads(data)
-                    if command == "message":
-                        self.message = value
-                    elif command == "info":
-                        self.server_info = value
-                        if self.info_signal is not None:
-                            self.info_signal.emit()
-            except socket.timeout:
-                pass
-            except ConnectionError:
-                self.connected = False
-        log.info(f"{self} stops listening")
-
-    def send_message(self, message: str):
-        if self.connected:
-            try:
-                data = ("message", message)
-                self.connection.send(pickle.dumps(data))
-            except ConnectionError:
-                log.warning(f"[{self}] Connection failed")
-            except AttributeError:
-                log.warning(f"[{self}] Sending failed, not connected")
-        else:
-            log.warning(f"[{self}] Not connected")
-
-    def closing_statement(self):
-        self.connection.send(pickle.dumps(("info", "remove")))
-
-    def __str__(self):
-        return "Client"
-
-
 class Window(QMainWindow):
-    client_signal = pyqtSignal()
+    client_signal = pyqtSignal(list)  # the messages received together
     server_signal = pyqtSignal()
     agnostic = False
 
@@ -100,7 +36,8 @@ class Window(QMainWindow):
                         "theme": DEFAULT_THEME,
                         "username": DEFAULT_NAME,
                         "ip": "127.0.0.1",
-                        "port": "7979"
+                        "port": "7979",
+                        "backend": "threads"
                     }, conf)
         with open(".config", 'r') as conf:
             self.config = json.load(conf)
@@ -112,7 +49,7 @@ class Window(QMainWindow):
         self._setup_page()
         self.messenger_box = MessageBox(self, "MSN")
         self.layout.addWidget(self.messenger_box)
-        self.client = None  # type: Union[None, MSNClient]
+        self.client = None  # type: Union[None, MSNClient, AsyncClientAdapter]
         self._name = self.config.get("username", DEFAULT_NAME)
         self.show()
 
@@ -137,7 +74,11 @@ class Window(QMainWindow):
 
     def create_client(self):
         self._save_address()
-        self.client = MSNClient(
+        if self.config.get("backend") == "asyncio":
+            client_type = AsyncClientAdapter
+        else:
+            client_type = MSNClient
+        self.client = client_type(
             self.address_box.ip, self.address_box.port,
             self.client_signal, self.server_signal
         )
@@ -154,7 +95,7 @@ class Window(QMainWindow):
             self.client.connected)
         self.client_signal.connect(self._send_notification)
 
-    def _send_notification(self):
+    def _send_notification(self, messages: list):
         app.alert(self)
         threading.Thread(
             target=playsound,
@@ -166,7 +107,7 @@ class Window(QMainWindow):
             text = ''
             for name in self.client.server_info:
                 text += f"{name}\n"
-            self.address_box.server_info.setText(text)
+            self.address_box.server_info.setPlainText(text)
 
     def _setup_page(self):
         setup_layout = QVBoxLayout()
@@ -222,7 +163,7 @@ class Window(QMainWindow):
         if self.client is not None:
             if self.client.name != name:
                 self.client.name = name
-                self.client.connection.send(pickle.dumps(("info", self._name)))
+                self.client.send_info()
 
     def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
         log.info("closing window")
@@ -0,0 +1,342 @@
+import collections
+import random
+import socket
+import struct
+import threading
+import time
+from typing import Dict, Set, Union
+
+from protocol import FrameBuffer, LOBBY, VERSION, apply_presence, \
+    decode, decode_frames, deflate, encode
+from transfer import download, file_id, upload
+from utils import Messenger, client_socket, endpoint, log
+
+
+class MSNClient(Messenger):
+    compress = True  # ask the server for deflated frames
+    reconnect = True  # when the link drops, until stopped
+    backoff = 0.5  # seconds, the longest first wait, doubled on each failure
+    max_backoff = 30
+    outbox_size = 100  # messages kept while reconnecting, oldest dropped
+    # a server speaking version 8 is pinged after that many seconds of
+    # silence, and given up on after the timeout
+    ping_interval = 30
+    idle_timeout = 90
+
+    def __init__(self, ip=None, port=None,
+                 message_signal=None, info_signal=None):
+        super().__init__(ip, port, message_signal)
+        self.info_signal = info_signal
+        # the names in the lobby and in every room joined, with the version
+        # of each roster and the sequence of the last message received
+        self.rosters = {LOBBY: list()}  # type: Dict[str, list]
+        self.roster_versions = {LOBBY: 0}  # type: Dict[str, int]
+        self.last_sequences = {LOBBY: 0}  # type: Dict[str, int]
+        self.message_room = LOBBY  # where the last message was sent
+        self.server_metrics = ""  # as last requested
+        # files offered to the rooms, by id: room, name, size and checksums
+        self.offers = dict()  # type: Dict[str, tuple]
+        self._resyncing = set()  # type: Set[str]
+        # rooms whose history was asked again, by the sequence received
+        # then: the replay goes on until it reaches it
+        self._replaying = dict()  # type: Dict[str, int]
+        self._buffer = FrameBuffer()
+        self.version = VERSION
+        self.compressed = False  # both ways, once the server agreed
+        # how the server numbers its messages, since version 7: coming back
+        # with the same token, only the messages missed are sent again
+        self.token = None  # type: Union[None, str]
+        self.outbox = collections.deque(maxlen=self.outbox_size)
+        self._stopping = threading.Event()
+        self._seen = time.monotonic()  # when the server last sent something
+        self._pinged = False
+        self.connection = self._socket()
+
+    def _socket(self) -> socket.socket:
+        connection = client_socket(self.address)
+        connection.settimeout(2)
+        return connection
+
+    @property
+    def server_info(self) -> list:
+        return self.rosters[LOBBY]
+
+    def connect(self, propagate=False):
+        if self.address == (None, None):
+            log.error(f"[{self}] No address used")
+        try:
+            log.info(f"[{self}] Trying to connect to {self.address}")
+            self.connection.settimeout(10)
+            self.connection.connect(endpoint(self.address))
+            self._negotiate()
+            self.connection.settimeout(2)
+            self.connected = True
+            self._seen = time.monotonic()
+            self.send_info()
+            self._rejoin()
+        except (ConnectionError, FileNotFoundError, socket.timeout):
+            log.warning("Could not reach host")
+            if propagate:
+                raise
+
+    def _negotiate(self):
+        # the hello layout never changes, any server can read it
+        greeting = encode("hello", VERSION, 1)
+        previous, self.token = self.token, None
+        self.compressed = False
+        if previous is not None:
+            # what follows is read with the version of the last server, one
+            # that does not know it any more drops it
+            greeting += encode("session", previous, self.version) + encode(
+                "resume", (LOBBY, self.last_sequences[LOBBY]), self.version
+            )
+        self.connection.sendall(greeting)
+        while True:
+            if self._buffer.recv_from(self.connection) == 0:
+                raise ConnectionAbortedError
+            for frame in self._buffer.frames():
+                command, value = decode(frame)
+                if command == "hello":
+                    self.version = value
+                    log.info(f"[{self}] speaking version {self.version}")
+                    if self.version < 7:
+                        return self._negotiated(previous)
+                elif command == "session":
+                    self.token = value
+                    return self._negotiated(previous)
+
+    def _negotiated(self, previous: str):
+        if self.token is None or self.token != previous:
+            # the sequences from before do not apply, nothing is skipped
+            for room in self.last_sequences:
+                self.last_sequences[room] = 0
+            self._replaying.clear()
+        elif previous is not None:
+            log.info(f"[{self}] resuming the session")
+        if self.compress and self.version >= 6:
+            self._send("compress", 1)
+
+    def _rejoin(self):
+        # the rooms joined before a reconnection, then what was written
+        # meanwhile
+        for room in list(self.rosters):
+            if room == LOBBY:
+                continue
+            if self.version >= 7:
+                self._send("resume", (room, self.last_sequences[room]))
+            elif self.version >= 4:
+                self._send("join", room)
+            else:
+                self._forget(room)
+        while self.outbox:
+            room, message = self.outbox.popleft()
+            self.send_message(message, room)
+
+    def _run(self):
+        while True:
+            self._listen()
+            self.deliver()  # what came before the error
+            if not self.reconnect or self._stopping.is_set() or \
+                    not self._reconnect():
+                break
+        log.info(f"{self} stops listening")
+
+    def _listen(self):
+        while self.connected:
+            try:
+                # frames may have come along with the negotiation
+                for frame in self._buffer.frames():
+                    for command, value in decode_frames(frame):
+                        self._dispatch(command, value)
+                self.deliver()
+                if self._buffer.recv_from(self.connection) == 0:
+                    self.connected = False
+                self._seen = time.monotonic()
+                self._pinged = False
+            except socket.timeout:
+                self._check_silence()
+            except (ConnectionError, ValueError, struct.error):
+                self.connected = False
+
+    def _check_silence(self):
+        # a half-open connection never raises, the silence gives it away
+        if self.version < 8:
+            return
+        quiet = time.monotonic() - self._seen
+        if quiet >= self.idle_timeout:
+            log.warning(f"[{self}] Server silent for {quiet:.0f} s")
+            self.connected = False
+        elif quiet >= self.ping_interval and not self._pinged:
+            self._pinged = True
+            self._send("ping")
+
+    def _reconnect(self) -> bool:
+        # full jitter: the clients dropped together by a server restart
+        # spread their attempts over the whole wait instead of coming back
+        # at once
+        attempt = 0
+        while True:
+            wait = min(self.max_backoff, self.backoff * 2 ** attempt)
+            if self._stopping.wait(random.uniform(0, wait)):
+                return False
+            attempt += 1
+            self.connection.close()
+            self.connection = self._socket()
+            self._buffer = FrameBuffer()
+            self._resyncing.clear()
+            try:
+                self.connect(propagate=True)
+            except (OSError, ValueError, struct.error) as error:
+                log.info(f"[{self}] Reconnection {attempt} failed: {error}")
+                continue
+            return not self._stopping.is_set()
+
+    def _dispatch(self, command: str, value):
+        if command == "message":
+            room, sequence, text = value
+            if room not in self.rosters:
+                return  # sent before the room was left
+            if sequence:
+                replayed = self._replaying.get(room)
+                if replayed is not None and sequence >= replayed:
+                    del self._replaying[room]
+                if self.token is not None and \
+                        sequence <= self.last_sequences[room]:
+                    if replayed is None:
+                        return  # sent again on resuming, already received
+                else:
+                    self.last_sequences[room] = sequence
+            self.message_room = room
+            self.message = text
+        elif command == "roster":
+            room, version, names = value
+            self.roster_versions[room] = version
+            self.rosters[room] = names
+            self.last_sequences.setdefault(room, 0)
+            self._resyncing.discard(room)
+            if self.info_signal is not None:
+                self.info_signal.emit()
+        elif command == "presence":
+            self._apply_presence(*value)
+        elif command == "metrics":
+            self.server_metrics = value
+        elif command == "compress":
+            self.compressed = bool(value)
+        elif command == "ping":
+            self._send("pong")
+        elif command == "offer":
+            room, name, size, checksums = value
+            if room not in self.rosters:
+                return
+            identifier = file_id(size, checksums)
+            self.offers[identifier] = value
+            self.message_room = room
+            self.message = f"<{name}, {size} bytes, offered as {identifier}>"
+
+    def _apply_presence(self, room, roster_version, change, changed):
+        if room not in self.rosters or room in self._resyncing:
+            return
+        if roster_version != self.roster_versions.get(room, 0) + 1:
+            # a change was missed, the whole roster is needed again
+            log.info(f"[{self}] roster gap in '{room}', resynchronizing")
+            self._resyncing.add(room)
+            self._send("resync", room)
+            return
+        self.roster_versions[room] = roster_version
+        apply_presence(self.rosters.get(room, list()), change, changed)
+        if self.info_signal is not None:
+            self.info_signal.emit()
+
+    def send_message(self, message: str, room=LOBBY):
+        if self.connected:
+            try:
+                self._send("message", (room, 0, message))
+            except ConnectionError:
+                log.warning(f"[{self}] Connection failed")
+                self._hold(message, room)
+            except AttributeError:
+                log.warning(f"[{self}] Sending failed, not connected")
+        elif self.reconnect and self.reading_thread is not None and \
+                not self._stopping.is_set():
+            self._hold(message, room)
+        else:
+            log.warning(f"[{self}] Not connected")
+
+    def _hold(self, message: str, room: str):
+        # sent once reconnected
+        if len(self.outbox) == self.outbox.maxlen:
+            log.warning(f"[{self}] Outbox full, dropping the oldest message")
+        self.outbox.append((room, message))
+
+    def request_history(self, since: int, room=LOBBY):
+        # what comes back is delivered even if it was received before
+        received = self.last_sequences.get(room, 0)
+        if since < received:
+            self._replaying[room] = received
+        self._send("history", (room, since))
+
+    def request_metrics(self):
+        # only answered to clients on the same host as the server
+        if self.version < 5:
+            log.warning(f"[{self}] The server does not share metrics")
+            return
+        self._send("metrics", "")
+
+    def send_file(self, path: str, room=LOBBY) -> threading.Thread:
+        # on a channel of its own, messages go on meanwhile; the room is
+        # offered the file once the server has all of it
+        return self._in_background(upload, self.address, path, room)
+
+    def fetch_file(self, identifier: str, path: str) -> threading.Thread:
+        return self._in_background(download, self.address, identifier, path)
+
+    def _in_background(self, transfer, *args) -> threading.Thread:
+        def run():
+            try:
+                transfer(*args)
+            except (OSError, ValueError, struct.error) as error:
+                log.warning(f"[{self}] Transfer failed: {error}")
+
+        thread = threading.Thread(target=run, name=f"{self} transfer")
+        thread.start()
+        return thread
+
+    def join(self, room: str):
+        # the server answers with the roster and the last messages of the room
+        if self.version < 4:
+            log.warning(f"[{self}] The server does not know rooms")
+            return
+        self._send("join", room)
+
+    def leave(self, room: str):
+        if room == LOBBY or room not in self.rosters:
+            return
+        self._send("leave", room)
+        self._forget(room)
+
+    def _forget(self, room: str):
+        # the reading thread may still be handling the room
+        self.rosters.pop(room, None)
+        self.roster_versions.pop(room, None)
+        self.last_sequences.pop(room, None)
+        self._replaying.pop(room, None)
+        self._resyncing.discard(room)
+
+    def send_info(self):
+        self._send("info", self.name)
+
+    def stop(self):
+        self._stopping.set()
+        super().stop()
+
+    def closing_statement(self):
+        self._send("remove")
+
+    def _send(self, command: str, value=None):
+        frame = encode(command, value, self.version)
+        if self.compressed:
+            frame = deflate(frame)  # left as it is when too short to gain
+        self.connection.sendall(frame)
+
+    def __str__(self):
+        return "Client"
@@ -1,105 +1,1386 @@
-import pickle
+import errno
+import itertools
+import os
+import selectors
 import socket
-import sys
-
-from utils import Messenger, log
-
-
-class MSNServer(Messenger):
-    def __init__(self, ip, port, signal=None, name=None):
-        super().__init__(ip, port, signal)
-        if name is not None:
-            self.name = name
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.connection_pool = list()
-        self._sock.bind(self.address)
-        self._sock.listen()
-        self.first_connection = True
-        self.connected = True
-        self._info = {self._sock: self.name}
-
-    def start(self):
-        while self.connected:
-            log.info("spawning new listener")
-            connection, address = self._sock.accept()
-            log.info(f"new connection from {address}")
-            connection.settimeout(.5)
-            self.connection_pool.append(connection)
-            if self.first_connection:
-                self.first_connection = False
-                self.run()
+import struct
+import tempfile
+import time
+from typing import BinaryIO, Dict, Set, Union
+
+from federation import DedupeCache, LINK_LIMITS, MessageIds, NODE_VERSION, \
+    node_id, peer_address
+from history import MessageHistory
+from metrics import labels
+from protocol import FrameBuffer, JOIN, LEAVE, LEGACY, LOBBY, \
+    MAX_ROOM_NAME, PICKLE_MARK, RENAME, VERSION, apply_presence, decode, \
+    decode_frames, deflate, dumps_legacy, encode, loads_legacy
+from timers import TimerWheel
+from transfer import FileStore, file_id
+from utils import DEFAULT_FLOOD, DEFAULT_LIMITS, FloodLimits, \
+    OutboundLimits, SelectorServer, TokenBucket, client_socket, endpoint, \
+    limits_from, log, serve, server_arguments, set_log_level, traffic, \
+    unix_listener
+from workers import run_workers
+
+
+class Session:
+    __slots__ = (
+        "connection", "fd", "name", "buffer", "version", "rooms",
+        "bytes_received", "frames_received", "seen", "compressed", "welcome",
+        "resumed", "cursor", "messages", "bytes", "throttled", "strikes",
+        "struck", "node"
+    )
+
+    def __init__(self, connection: socket.socket):
+        self.connection = connection
+        self.fd = connection.fileno()  # its key, as long as it is open
+        self.name = None  # type: Union[None, str]
+        self.buffer = FrameBuffer()
+        self.version = None  # negotiated on the first bytes received
+        self.rooms = set()  # type: Set[str]
+        self.bytes_received = 0
+        self.frames_received = 0
+        self.seen = time.monotonic()  # when something was last received
+        self.compressed = False  # asked for deflated frames
+        self.welcome = False  # roster and backlog to send after the hello
+        # a client coming back with the token of this server only gets the
+        # messages it missed, from the lobby sequence it gave
+        self.resumed = False
+        self.cursor = None  # type: Union[None, int]
+        # what it may send, its reads are deferred while it is in debt
+        self.messages = None  # type: Union[None, TokenBucket]
+        self.bytes = None  # type: Union[None, TokenBucket]
+        self.throttled = False
+        self.strikes = 0  # burst periods it spent over its limits lately
+        self.struck = 0.0  # when the last one started
+        # the id of the node at the other end, for a link between nodes
+        self.node = None  # type: Union[None, str]
 
     @property
-    def info(self):
-        return self._info
-
-    def send_info(self, connection: socket.socket):
-        connection.send(
-            pickle.dumps(
-                ("info", list(self.info.values())
-                 )
+    def codec(self) -> tuple:
+        return self.version, self.compressed
+
+    def encode(self, command: str, value=None) -> bytes:
+        if self.version == LEGACY:
+            return dumps_legacy(command, value)
+        return encode(command, value, self.version)
+
+    def pack(self, frames: bytes) -> bytes:
+        return deflate(frames) if self.compressed else frames
+
+
+class Sessions:
+    # sessions by file descriptor: adding, removing and finding one cost
+    # O(1), and the broadcasts iterate a tuple that is only rebuilt after a
+    # change
+    __slots__ = ("_sessions", "_snapshot")
+
+    def __init__(self):
+        self._sessions = dict()  # type: Dict[int, Session]
+        self._snapshot = ()  # type: Union[None, tuple]
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, fd: int):
+        return fd in self._sessions
+
+    def __getitem__(self, fd: int) -> Session:
+        return self._sessions[fd]
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def get(self, fd: int) -> Union[None, Session]:
+        return self._sessions.get(fd)
+
+    def add(self, session: Session):
+        # added again, a session moves last
+        self._sessions.pop(session.fd, None)
+        self._sessions[session.fd] = session
+        self._snapshot = None
+
+    def remove(self, fd: int) -> Union[None, Session]:
+        session = self._sessions.pop(fd, None)
+        if session is not None:
+            self._snapshot = None
+        return session
+
+    def snapshot(self) -> tuple:
+        # the sessions in the order they were added, left as they are by
+        # later changes
+        if self._snapshot is None:
+            self._snapshot = tuple(self._sessions.values())
+        return self._snapshot
+
+
+class Room:
+    def __init__(self, name: str, history: MessageHistory):
+        self.name = name
+        # the sessions in the room, in the order they joined
+        self.members = Sessions()
+        # the names in the room on the other workers, or on the other nodes
+        # by their id
+        self.shards = dict()  # type: Dict[Union[int, str], list]
+        self.version = 0  # of the roster
+        self.history = history
+        # what it may carry from the sessions of this worker, whoever sends
+        # to it while it is in debt is throttled
+        self.messages = None  # type: Union[None, TokenBucket]
+        self.bytes = None  # type: Union[None, TokenBucket]
+
+
+class MSNServer(SelectorServer):
+    replay_limit = 1000  # messages sent at most for a history request
+    room_history = 50  # messages kept in memory by each room but the lobby
+    ping_interval = 30  # seconds of silence before a session is pinged
+    # a session over its limits for that many burst periods, without a
+    # minute of rest between, is warned, then dropped
+    warn_after = 3
+    disconnect_after = 10
+    strike_memory = 60
+    # a node gossips all its names that often, those of a node or a link
+    # silent for node_timeout are gone; lost links are dialed again
+    refresh_interval = 30
+    node_timeout = 90
+    redial_interval = 5
+
+    def __init__(self, ip, port, signal=None, name=None,
+                 limits: OutboundLimits = DEFAULT_LIMITS,
+                 bus: socket.socket = None, worker=0,
+                 history: MessageHistory = None, backlog=20,
+                 compression=True, idle_timeout=90, files: FileStore = None,
+                 flood: FloodLimits = DEFAULT_FLOOD,
+                 unix: Union[None, str, socket.socket] = None,
+                 handoff: str = None, peers: list = None):
+        super().__init__(
+            ip, port, signal, name, limits, bus is not None, unix, handoff
+        )
+        # every connection, by file descriptor; those named are in the
+        # lobby roster in the order they were named
+        self.sessions = Sessions()
+        # messages are numbered and kept, newcomers get the last backlog
+        self.history = history if history is not None else MessageHistory()
+        if self.history.log is None and self.history.directory is not None \
+                and not self.taken_over:
+            # left for the handed over state otherwise
+            self.history.open()
+        self.backlog = backlog
+        self.compression = compression  # for the sessions asking for it
+        # the sequences only make sense within this run of this worker, the
+        # clients resume from them only when given the same token back
+        self.token = f"{os.urandom(8).hex()}-{worker}"
+        # sessions silent for that long are dropped, the timers only wake
+        # the loop once a second whatever their number
+        self.idle_timeout = idle_timeout
+        self.timers = TimerWheel()
+        self._idle_tick = self.timers.resolution \
+            if idle_timeout or peers is not None else None
+        self.tick = self._idle_tick
+        # the throttled sessions are read again once their debt is repaid,
+        # the loop then wakes more often
+        self.flood = flood
+        self.throttles = TimerWheel(resolution=0.05)
+        # files come and go on channels of their own, which leave the
+        # sessions once they asked for a transfer; none without a store
+        self.files = files
+        self.uploads = dict()  # type: Dict[socket.socket, tuple]
+        self.downloads = dict()  # type: Dict[socket.socket, BinaryIO]
+        # every session is in the lobby, other rooms are joined by name and
+        # only exist while someone is in them
+        self.lobby = self._limited(Room(LOBBY, self.history))
+        self.rooms = {LOBBY: self.lobby}  # type: Dict[str, Room]
+        # when running as one of several workers, the bus links it to the
+        # others: messages are relayed and each worker shares its roster
+        self.bus = bus
+        self.worker = worker
+        # as a node of a federation, given the addresses of the nodes to
+        # dial even if empty, the links carry the messages and the names of
+        # every node as gossip; names are versioned by their node, the
+        # latest version wins whatever way it came
+        self.node = node_id()
+        self.peers = dict()  # type: Dict[socket.socket, Session]
+        self.dedupe = None  # type: Union[None, DedupeCache]
+        self.peer_addresses = list(peers or ())
+        self._dialed = dict()  # type: Dict[socket.socket, tuple]
+        self._redial = {address: 0.0 for address in self.peer_addresses}
+        self._versions = dict()  # type: Dict[tuple, tuple]
+        # changes come in the order they were made unless they took
+        # different ways, those made on a version not known yet wait
+        self._pending = dict()  # type: Dict[tuple, Dict[int, tuple]]
+        # rooms whose names this node tells in full on the next tick
+        self._dirty = set()  # type: Set[str]
+        self._next_refresh = 0.0
+        if peers is not None:
+            self.ids = MessageIds(self.node)
+            self._names_versions = itertools.count(1)
+            self.dedupe = DedupeCache()
+        self._decode_errors = self.metrics.counter(
+            "chat_decode_errors_total", "frames or pickles that did not decode"
+        )
+        self._idle_timeouts = self.metrics.counter(
+            "chat_idle_timeouts_total", "sessions dropped for being silent"
+        )
+        self._throttles = self.metrics.counter(
+            "chat_throttles_total", "times a session had its reads deferred"
+        )
+        self._fan_out = self.metrics.histogram(
+            "chat_fan_out_seconds", "time spent queuing a frame for a room"
+        )
+        self._gossiped = self.metrics.counter(
+            "chat_gossip_total", "frames from other nodes applied and spread"
+        )
+        self._duplicates = self.metrics.counter(
+            "chat_gossip_duplicates_total",
+            "frames from other nodes seen before"
+        )
+        self.metrics.gauge(
+            "chat_rooms", "rooms in use", lambda: len(self.rooms)
+        )
+        self.metrics.gauge(
+            "chat_peers", "nodes linked to", lambda: len(self.peers)
+        )
+        if bus is not None:
+            self._bus_buffer = FrameBuffer()
+            self._selector.register(
+                bus, selectors.EVENT_READ, self._read_bus
             )
+
+    @property
+    def info(self) -> dict:
+        # the name of each connection, this server included
+        info = {self._sock: self.name}
+        for session in self.sessions:
+            if session.name is not None:
+                info[session.connection] = session.name
+        return info
+
+    @property
+    def roster(self):
+        return self.roster_of(self.lobby)
+
+    def roster_of(self, room: Room) -> list:
+        # the names come from the sessions themselves, one that is gone
+        # cannot be left in
+        if room is self.lobby:
+            names = [self.name]
+            names.extend(
+                session.name for session in self.sessions
+                if session.name is not None
+            )
+        else:
+            names = [session.name for session in room.members]
+        for shard in room.shards.values():
+            names.extend(shard)
+        return names
+
+    def _members(self, room: Room) -> Sessions:
+        # the sessions a room is routed to
+        return self.sessions if room is self.lobby else room.members
+
+    def send_info(self, connection: socket.socket, room: Room = None):
+        if room is None:
+            room = self.lobby
+        session = self.sessions[connection.fileno()]
+        self.send_to(
+            connection,
+            session.pack(session.encode(
+                "roster", (room.name, room.version, self.roster_of(room))
+            ))
         )  # only send the names of the connected
 
     def update_info(self, client, info, remove=False):
-        if remove and client in self._info.keys():
-            del self._info[client]
+        session = self.sessions.get(client.fileno())
+        if session is None:
+            return
+        former = session.name
+        if remove:
+            if former is None:
+                return
+            for name in list(session.rooms):
+                self._leave(self.rooms[name], session)
+            session.name = None
+            self._announce(self.lobby, LEAVE, [former])
+        elif former is None:
+            session.name = info
+            self.sessions.add(session)  # last in the roster
+            self._announce(self.lobby, JOIN, [info])
+        elif former != info:
+            session.name = info
+            self._announce(self.lobby, RENAME, [former, info])
+            for name in session.rooms:
+                self._announce(self.rooms[name], RENAME, [former, info])
+
+    def join(self, session: Session, name: str, since: int = None):
+        # only named sessions speaking version 4 can be in other rooms, the
+        # backlog is what followed since when given
+        connection = session.connection
+        if name == LOBBY or session.name is None or \
+                len(name.encode()) > MAX_ROOM_NAME:
+            return
+        room = self._room(name)
+        if session.fd not in room.members:
+            room.members.add(session)
+            session.rooms.add(name)
+            self._announce(room, JOIN, [session.name], exclude=connection)
+        self.send_info(connection, room)
+        if since is None:
+            frames = room.history.last(self.backlog)
         else:
-            self._info[client] = info
-        # check-up
-        for connected in list(self._info.keys()):  # make a copy of the list
-            if connected not in self.connection_pool and \
-                    not connected == self._sock:
-                del self._info[connected]
-        for connection in self.connection_pool:  # type: socket.socket
-            self.send_info(connection)
+            frames = room.history.since(since, self.replay_limit)
+        self._replay(session, frames)
+
+    def leave(self, session: Session, name: str):
+        room = self.rooms.get(name)
+        if room is not None and room is not self.lobby and \
+                session.fd in room.members:
+            self._leave(room, session)
+
+    def _leave(self, room: Room, session: Session):
+        room.members.remove(session.fd)
+        session.rooms.discard(room.name)
+        self._announce(room, LEAVE, [session.name])
+        self._discard(room)
+
+    def _room(self, name: str) -> Room:
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = self._limited(Room(
+                name, MessageHistory(self.room_history)
+            ))
+        return room
+
+    def _bucket(self, rate: float) -> Union[None, TokenBucket]:
+        if not rate:
+            return None
+        return TokenBucket(rate, rate * self.flood.burst)
+
+    def _limited(self, room: Room) -> Room:
+        room.messages = self._bucket(self.flood.room_messages)
+        room.bytes = self._bucket(self.flood.room_bytes)
+        return room
+
+    def _discard(self, room: Room):
+        if room is not self.lobby and not room.members and not room.shards:
+            del self.rooms[room.name]
+
+    def _announce(self, room: Room, change: int, changed: list, worker=None,
+                  exclude=None):
+        # sessions speaking version 2 get the change, older ones still get
+        # the whole roster; changes made here are shared with the workers,
+        # or gossiped to the other nodes
+        started = time.perf_counter()
+        room.version += 1
+        presence = (room.name, room.version, change, changed)
+        roster = None
+        frames = dict()
+        for session in self._members(room).snapshot():
+            if session.version is None or session.connection == exclude:
+                continue
+            if session.version >= 2:
+                frame = self._frame_for(session, frames, "presence", presence)
+            else:
+                if roster is None:
+                    roster = (room.name, room.version, self.roster_of(room))
+                frame = self._frame_for(session, frames, "roster", roster)
+            self.send_to(session.connection, frame)
+        self._fan_out.observe(time.perf_counter() - started)
+        if self.bus is not None and worker is None:
+            self.bus.sendall(
+                encode("delta", (room.name, self.worker, change, changed))
+            )
+        if self.dedupe is not None and worker is None:
+            self._gossip_change(room, change, changed)
 
     def _run(self):
-        while self.connected:
-            for connection in self.connection_pool:  # type:socket.socket
+        super()._run()
+        self.history.close()
+
+    def _read_bus(self, bus: socket.socket, mask):
+        if self._bus_buffer.recv_from(bus) == 0:
+            log.error(f"[{self}] Lost the worker bus")
+            self.connected = False
+            return
+        for frame in self._bus_buffer.frames():
+            command, value = decode(frame)
+            if command == "relay":
+                name, self.message = value
+                room = self.rooms.get(name)
+                if room is not None:  # nobody would read it here otherwise
+                    self._publish(room, self.message)
+            elif command == "delta":
+                name, worker, change, changed = value
+                room = self._room(name)
+                shard = room.shards.setdefault(worker, list())
+                apply_presence(shard, change, changed)
+                if not shard:
+                    del room.shards[worker]
+                self._announce(room, change, changed, worker)
+                self._discard(room)
+            elif command == "shard":
+                worker, names = value
+                for room in list(self.rooms.values()):
+                    former = room.shards.pop(worker, list())
+                    if former:
+                        self._announce(room, LEAVE, former, worker)
+                        self._discard(room)
+                if names:
+                    self.lobby.shards[worker] = names
+                    self._announce(self.lobby, JOIN, names, worker)
+
+    def _federate(self, now: float):
+        # the names are gossiped in full once in a while to tell the other
+        # nodes this one is still there; the lost links are dialed again
+        if now >= self._next_refresh:
+            self._next_refresh = now + self.refresh_interval
+            self._dirty.update(self.rooms)
+            self._expire(now)
+        for name in self._dirty:
+            self._gossip_names(name)
+        self._dirty.clear()
+        for address, when in list(self._redial.items()):
+            if now >= when:
+                self._dial(address)
+
+    def _dial(self, address: tuple):
+        # the hello and the id of this node wait for the connection
+        del self._redial[address]
+        connection = client_socket(address)
+        connection.setblocking(False)
+        error = connection.connect_ex(endpoint(address))
+        if error not in (0, errno.EINPROGRESS):
+            log.info("[%s] Could not dial node %s: %s", self, address,
+                     os.strerror(error))
+            connection.close()
+            self._redial[address] = time.monotonic() + self.redial_interval
+            return
+        self._adopt(connection)
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._outbound[connection].limits = LINK_LIMITS
+        self.peers[connection] = Session(connection)
+        self._dialed[connection] = address
+        self.send_to(connection, encode("hello", VERSION, 1))
+        self.send_to(connection, encode("peer", self.node, NODE_VERSION))
+
+    def _link(self, session: Session, node: str):
+        # a node dialing this one, its session leaves the lobby
+        connection = session.connection
+        if self.dedupe is None or session.name is not None or \
+                session.version < NODE_VERSION:
+            log.warning("[%s] Refusing a link", self)
+            self._drop(connection)
+            return
+        self._detach(session)
+        self._outbound[connection].limits = LINK_LIMITS
+        self.peers[connection] = session
+        if not self._linked(session, node):
+            self._drop(connection)
+
+    def _linked(self, link: Session, node: str) -> bool:
+        # once both ends know each other, each tells the other everything
+        # it knows; False for a link that must go
+        connection = link.connection
+        if link.node is not None:
+            return True
+        if connection not in self._dialed:
+            self.send_to(connection, encode("peer", self.node, NODE_VERSION))
+        if node == self.node:
+            # the end that dialed learns it from the answer above
+            log.warning("[%s] Linked to itself, unlinking", self)
+            address = self._dialed.get(connection)
+            if address in self.peer_addresses:
+                self.peer_addresses.remove(address)  # not dialed again
+            return False
+        link.node = node
+        log.info(f"[{self}] Linked to node {node}")
+        for (name, of), (version, _) in list(self._versions.items()):
+            self._gossip(
+                encode("names", (name, of, version, self._names_of(name, of)),
+                       NODE_VERSION),
+                link
+            )
+        return True
+
+    def _receive_peer(self, link: Session) -> int:
+        received = link.buffer.recv_from(link.connection)
+        link.bytes_received += received
+        link.seen = time.monotonic()
+        if received and not self._from_peer(link):
+            return 0
+        return received
+
+    def _from_peer(self, link: Session) -> bool:
+        # what a link carries is not throttled, it comes from many clients;
+        # False for a link that must go
+        for frame in link.buffer.frames():
+            try:
+                command, value = decode(frame)
+            except (ValueError, struct.error):
+                traffic.warning("[%s] Dropping undecodable frame", self)
+                self._decode_errors.inc()
+                continue
+            link.frames_received += 1
+            if command == "hello":
+                link.version = value
+                if value < NODE_VERSION:
+                    log.warning("[%s] Node speaking version %d, unlinking",
+                                self, value)
+                    return False
+            elif command == "peer":
+                if not self._linked(link, value):
+                    return False
+            elif command == "gossip" and link.node is not None:
+                self._receive_gossip(link, bytes(frame), *value)
+        return True
+
+    def _receive_gossip(self, link: Session, frame: bytes, identifier: str,
+                        inner: bytes):
+        # applied and spread to the other links once, whatever the number
+        # of ways it comes by; names older than those known stop there
+        if not self.dedupe.add(identifier):
+            self._duplicates.inc()
+            return
+        try:
+            command, value = decode(inner)
+        except (ValueError, struct.error):
+            traffic.warning("[%s] Dropping undecodable gossip", self)
+            self._decode_errors.inc()
+            return
+        if command == "relay":
+            name, self.message = value
+            room = self.rooms.get(name)
+            if room is not None:  # nobody would read it here otherwise
+                self._publish(room, self.message)
+        elif command == "change":
+            # spread even if it waits, the nodes behind may need it
+            self._apply_change(*value)
+        elif command != "names" or not self._apply_names(*value):
+            return
+        self._gossiped.inc()
+        self._spread(frame, link)
+
+    def _gossip(self, inner: bytes, link: Session = None):
+        # to every linked node, or to that one only
+        identifier = self.ids.next()
+        self.dedupe.add(identifier)  # it may come back
+        frame = encode("gossip", (identifier, inner), NODE_VERSION)
+        if link is None:
+            self._spread(frame)
+        else:
+            self.send_to(link.connection, frame)
+
+    def _spread(self, frame: bytes, source: Session = None):
+        for link in list(self.peers.values()):
+            if link is not source and link.node is not None:
+                self.send_to(link.connection, frame)
+
+    def _names_of(self, name: str, node: str) -> list:
+        # the names a node has in a room, as known here
+        room = self.rooms.get(name)
+        if room is None:
+            return list()
+        if node != self.node:
+            return room.shards.get(node, list())
+        return [
+            session.name for session in self._members(room)
+            if session.name is not None
+        ]
+
+    def _gossip_names(self, name: str):
+        names = self._names_of(name, self.node)
+        version = next(self._names_versions)
+        if names or name in self.rooms:
+            self._versions[name, self.node] = version, time.monotonic()
+        else:
+            self._versions.pop((name, self.node), None)  # told for good
+        self._gossip(
+            encode("names", (name, self.node, version, names), NODE_VERSION)
+        )
+
+    def _gossip_change(self, room: Room, change: int, changed: list):
+        # made on the names the other nodes were told last, all of them
+        # when they were told none
+        known = self._versions.get((room.name, self.node))
+        if known is None:
+            self._gossip_names(room.name)
+            return
+        version = next(self._names_versions)
+        if self._names_of(room.name, self.node):
+            self._versions[room.name, self.node] = version, time.monotonic()
+        else:
+            del self._versions[room.name, self.node]  # told for good
+        self._gossip(encode(
+            "change", (room.name, self.node, known[0], version, change,
+                       changed),
+            NODE_VERSION
+        ))
+
+    def _apply_names(self, name: str, node: str, version: int,
+                     names: list) -> bool:
+        # False when they are not newer than those known; the nodes linked
+        # to one that went tell its names are gone with the version they
+        # had, only its next version brings them back
+        if node == self.node:
+            return False
+        room = self.rooms.get(name)
+        known = self._versions.get((name, node))
+        if known is not None and known[0] >= version:
+            if known[0] > version or names or room is None or \
+                    node not in room.shards:
+                return False
+        self._versions[name, node] = version, time.monotonic()
+        if names and room is None:
+            room = self._room(name)
+        if room is not None:
+            self._reshard(room, node, names)
+        self._catch_up(name, node)
+        return True
+
+    def _apply_change(self, name: str, node: str, base: int, version: int,
+                      change: int, changed: list):
+        if node != self.node:
+            self._pending.setdefault((name, node), dict())[base] = \
+                version, change, changed
+            self._catch_up(name, node)
+
+    def _catch_up(self, name: str, node: str):
+        # the changes made on the version known, in turn; those made on an
+        # older one are in it already
+        pending = self._pending.get((name, node))
+        known = self._versions.get((name, node))
+        if pending is None or known is None:
+            return
+        while known[0] in pending:
+            version, change, changed = pending.pop(known[0])
+            known = self._versions[name, node] = version, time.monotonic()
+            room = self.rooms.get(name)
+            if room is None and change == JOIN:
+                room = self._room(name)
+            if room is None:
+                continue
+            shard = room.shards.setdefault(node, list())
+            apply_presence(shard, change, changed)
+            if not shard:
+                del room.shards[node]
+            self._announce(room, change, changed, node)
+            self._discard(room)
+        for base in [base for base in pending if base < known[0]]:
+            del pending[base]
+        if not pending:
+            del self._pending[name, node]
+
+    def _reshard(self, room: Room, node: str, names: list):
+        # the clients see who left and who joined on that node
+        former = room.shards.pop(node, list())
+        if names:
+            room.shards[node] = names
+        kept = set(names)
+        left = [name for name in former if name not in kept]
+        had = set(former)
+        joined = [name for name in names if name not in had]
+        if left:
+            self._announce(room, LEAVE, left, node)
+        if joined:
+            self._announce(room, JOIN, joined, node)
+        self._discard(room)
+
+    def _forget(self, node: str):
+        # its names go, here and on the nodes told so, until it tells them
+        # again if it can still be reached
+        for (name, of), (version, _) in list(self._versions.items()):
+            room = self.rooms.get(name)
+            if of != node or room is None or node not in room.shards:
+                continue
+            self._reshard(room, node, list())
+            self._gossip(
+                encode("names", (name, node, version, list()), NODE_VERSION)
+            )
+
+    def _unlink(self, link: Session):
+        # the names of the node go, the nodes it is still linked to told
+        # the same of this one: its own names are told again
+        address = self._dialed.pop(link.connection, None)
+        if address in self.peer_addresses:
+            self._redial[address] = time.monotonic() + self.redial_interval
+        if link.node is None or not self.connected:
+            return
+        log.warning(f"[{self}] Lost the link to node {link.node}")
+        self._forget(link.node)
+        self._dirty.update(self.rooms)
+
+    def _expire(self, now: float):
+        # live nodes renew their names on every refresh, those that did not
+        # are gone or cut off; so are links that stayed silent as long
+        for (name, node), (_, renewed) in list(self._versions.items()):
+            if node != self.node and now - renewed > self.node_timeout:
+                del self._versions[name, node]
+                room = self.rooms.get(name)
+                if room is not None and node in room.shards:
+                    self._reshard(room, node, list())
+        # changes made on names that never came, the names told in full on
+        # the next refresh include them
+        for key in list(self._pending):
+            if key not in self._versions:
+                del self._pending[key]
+        for link in list(self.peers.values()):
+            if now - link.seen > self.node_timeout:
+                log.warning("[%s] Node %s went silent, unlinking", self,
+                            link.node)
+                self._drop(link.connection)
+
+    def on_connect(self, connection: socket.socket):
+        session = Session(connection)
+        self.sessions.add(session)
+        session.messages = self._bucket(self.flood.messages)
+        session.bytes = self._bucket(self.flood.bytes)
+        # peers from before version 8 cannot answer the pings, the kernel
+        # probes them instead
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if self.idle_timeout:
+            self.timers.schedule(connection, self.ping_interval)
+
+    def can_hand_over(self, connection: socket.socket) -> bool:
+        # transfers resume on a new channel, they are not worth carrying
+        return connection.fileno() in self.sessions
+
+    def export_state(self, connections: list) -> dict:
+        # names, codecs, rooms and partial frames of the sessions, the
+        # rosters and the history of every room
+        index = {
+            connection: position
+            for position, connection in enumerate(connections)
+        }
+        sessions = [
+            {
+                "index": index[session.connection],
+                "name": session.name,
+                "version": session.version,
+                "compressed": session.compressed,
+                "resumed": session.resumed,
+                "welcome": session.welcome,
+                "cursor": session.cursor,
+                "bytes_received": session.bytes_received,
+                "frames_received": session.frames_received,
+                "buffer": session.buffer.pending().hex(),
+            } for session in self.sessions
+        ]
+        rooms = [
+            {
+                "name": room.name,
+                "version": room.version,
+                "members": [
+                    index[session.connection] for session in room.members
+                ],
+                "sequence": room.history.sequence,
+                "recent": [frame.hex() for frame in room.history.recent()],
+            } for room in self.rooms.values()
+        ]
+        return {"token": self.token, "sessions": sessions, "rooms": rooms}
+
+    def import_state(self, state: dict, connections: list):
+        # the clients go on as if nothing happened, the sequences and the
+        # roster versions follow from the previous server
+        resumed = True
+        adopted = dict()
+        for entry in state["sessions"]:
+            connection = connections[entry["index"]]
+            self.on_connect(connection)
+            session = adopted[entry["index"]] = self.sessions[
+                connection.fileno()
+            ]
+            session.name = entry["name"]
+            session.version = entry["version"]
+            session.compressed = entry["compressed"]
+            session.resumed = entry["resumed"]
+            session.welcome = entry["welcome"]
+            session.cursor = entry["cursor"]
+            session.bytes_received = entry["bytes_received"]
+            session.frames_received = entry["frames_received"]
+            session.buffer.feed(bytes.fromhex(entry["buffer"]))
+        for entry in state["rooms"]:
+            room = self.lobby if entry["name"] == LOBBY else \
+                self._room(entry["name"])
+            room.version = entry["version"]
+            restored = room.history.restore(
+                entry["sequence"],
+                [bytes.fromhex(frame) for frame in entry["recent"]]
+            )
+            if not restored:
+                log.warning(
+                    f"[{self}] the history of {room.name} ends at "
+                    f"{room.history.sequence}, not at {entry['sequence']}, "
+                    f"the clients are not resumed"
+                )
+                resumed = False
+            for position in entry["members"]:
+                session = adopted[position]
+                room.members.add(session)
+                session.rooms.add(room.name)
+        if not resumed:
+            # the sequences the clients have do not follow in this history,
+            # they come back with the new token and take the backlog
+            for session in adopted.values():
+                self._drop(session.connection)
+            return
+        self.token = state["token"]
+        for session in adopted.values():
+            if len(session.buffer):
+                # frames left waiting by throttling
                 try:
-                    received = connection.recv(4096)
-                    if received:
-                        command, value = pickle.loads(received)
-                        log.info(f"{command}, {value}")
-                        if command == "info":
-                            self.update_info(
-                                connection, value, value == "remove"
-                            )
-                        elif command == "message":
-                            self.message = value
-                            self._send_to_all(connection)
-                            if self.signal is not None:
-                                self.signal.emit()
-                    else:
-                        raise ConnectionAbortedError
-
-                except socket.timeout:
-                    # going to the next connection endpoint
-                    continue
-                except ConnectionError:
-                    log.info(
-                        f"[{self}] Someone disconnected, removing agent"
+                    self._process(session)
+                except ValueError as error:
+                    log.warning("[%s] %s, removing agent", self, error)
+                    self._drop(session.connection)
+
+    def on_tick(self):
+        now = time.monotonic()
+        if self.dedupe is not None:
+            self._federate(now)
+        if self.throttles:
+            for connection in self.throttles.expire(now):
+                self._resume(connection)
+        self.tick = self.throttles.resolution if self.throttles \
+            else self._idle_tick
+        if not self.idle_timeout:
+            return
+        for connection in self.timers.expire(now):
+            session = self.sessions.get(connection.fileno())
+            if session is None:
+                continue
+            quiet = now - session.seen
+            if session.version is not None and session.version < 8:
+                continue  # left to the keepalive
+            if quiet >= self.idle_timeout:
+                log.info("[%s] Silent for %.0f s, removing agent", self, quiet)
+                self._idle_timeouts.inc()
+                self._drop(connection)
+            elif quiet >= self.ping_interval:
+                # any answer counts, the next check is when it is too late
+                if session.version is not None:
+                    self.send_to(connection, session.encode("ping"))
+                self.timers.schedule(connection, self.idle_timeout - quiet)
+            else:
+                self.timers.schedule(connection, self.ping_interval - quiet)
+
+    def receive(self, connection: socket.socket) -> int:
+        if connection in self.peers:
+            return self._receive_peer(self.peers[connection])
+        if connection in self.uploads:
+            return self._receive_upload(connection)
+        if connection in self.downloads:
+            return len(connection.recv(4096))  # nothing is expected
+        session = self.sessions[connection.fileno()]
+        if session.version is None:
+            first = connection.recv(1, socket.MSG_PEEK)
+            if first and first[0] == PICKLE_MARK:
+                log.info("[%s] legacy pickle peer", self)
+                session.version = LEGACY
+        if session.version == LEGACY:
+            return self._receive_legacy(session)
+        received = session.buffer.recv_from(connection)
+        session.bytes_received += received
+        session.seen = time.monotonic()
+        self._charge(session, session.bytes, received, True)
+        try:
+            self._process(session)
+        except ValueError as error:
+            log.warning("[%s] %s, removing agent", self, error)
+            return 0
+        if connection in self.peers and not self._from_peer(session):
+            return 0  # what followed the link is for the node
+        return received
+
+    def _process(self, session: Session):
+        # the frames received, those following a throttling frame are kept
+        # until the session is read again
+        for frame in session.buffer.frames():
+            try:
+                decoded = decode_frames(frame)
+            except (ValueError, struct.error):
+                traffic.warning("[%s] Dropping undecodable frame", self)
+                self._decode_errors.inc()
+                continue
+            for command, value in decoded:
+                session.frames_received += 1
+                self._handle(session, command, value)
+            if session.throttled or session.fd not in self.sessions:
+                break
+        if session.welcome and session.fd in self.sessions:
+            self._welcome(session)
+
+    def _charge(self, session: Session, bucket: TokenBucket, amount: int,
+                own: bool):
+        # called for every read and message, takes from the bucket and only
+        # throttles once it is in debt
+        if bucket is None:
+            return
+        now = time.monotonic()
+        delay = bucket.take(amount, now)
+        if delay:
+            self._throttle(session, delay, own, now)
+
+    def _throttle(self, session: Session, delay: float, own: bool,
+                  now: float):
+        # the session is read again once the debt is repaid; one going over
+        # its own limits for long is warned, then dropped
+        connection = session.connection
+        if own and now - session.struck >= self.flood.burst:
+            if now - session.struck > self.strike_memory:
+                session.strikes = 0
+            session.struck = now
+            session.strikes += 1
+            if session.strikes >= self.disconnect_after:
+                session.throttled = True  # what is buffered stays there
+                self.evict(connection, "sending too fast")
+                return
+            if session.strikes == self.warn_after:
+                log.warning("[%s] Warning a session sending too fast", self)
+                self.send_to(connection, session.pack(session.encode(
+                    "message",
+                    (LOBBY, 0, f"<Slow down, {self} is delaying you>\n")
+                )))
+        self._throttles.inc()
+        traffic.info("[%s] Deferring reads for %.2f s", self, delay)
+        session.throttled = True
+        self.pause_reading(connection)
+        self.throttles.schedule(connection, delay)
+        self.tick = self.throttles.resolution
+
+    def _resume(self, connection: socket.socket):
+        session = self.sessions.get(connection.fileno())
+        if session is None or not session.throttled:
+            return
+        session.throttled = False
+        try:
+            self._process(session)
+        except ValueError as error:
+            log.warning("[%s] %s, removing agent", self, error)
+            self._drop(connection)
+            return
+        if not session.throttled:
+            self.resume_reading(connection)
+        self.deliver()
+
+    def _welcome(self, session: Session):
+        # sent once what came along with the hello is handled, a request
+        # for compression applies to the backlog already
+        session.welcome = False
+        self.send_info(session.connection)
+        if session.version < 3:
+            return
+        if session.cursor is None:
+            frames = self.history.last(self.backlog)
+        else:
+            frames = self.history.since(session.cursor, self.replay_limit)
+        self._replay(session, frames)
+
+    def _receive_legacy(self, session: Session) -> int:
+        received = session.connection.recv(4096)
+        session.bytes_received += len(received)
+        session.seen = time.monotonic()
+        self._charge(session, session.bytes, len(received), True)
+        if received:
+            try:
+                command, value = loads_legacy(received)
+            except ValueError:
+                traffic.warning("[%s] Dropping undecodable message", self)
+                self._decode_errors.inc()
+            else:
+                session.frames_received += 1
+                self._handle(session, command, value)
+        return len(received)
+
+    def _handle(self, session: Session, command, value):
+        traffic.info("%s, %s", command, value)
+        connection = session.connection
+        if command == "hello":
+            session.version = min(VERSION, value)
+            self.send_to(connection, session.encode("hello", session.version))
+            if session.version >= 7:
+                self.send_to(connection, session.encode("session", self.token))
+            session.welcome = True
+        elif session.version is None:
+            session.version = 1  # peers that skip the hello speak version 1
+        if command == "resync":
+            room = self._joined(session, value)
+            if room is not None:
+                self.send_info(connection, room)
+        elif command == "history":
+            name, since = value
+            room = self._joined(session, name)
+            if room is not None:
+                self._replay(
+                    session, room.history.since(since, self.replay_limit)
+                )
+        elif command == "info":
+            self.update_info(connection, value)
+        elif command == "remove":
+            self.update_info(connection, None, remove=True)
+        elif command == "join":
+            self.join(session, value)
+        elif command == "ping":
+            self.send_to(connection, session.encode("pong"))
+        elif command == "upload":
+            self._upload(session, value)
+        elif command == "download":
+            self._download(session, value)
+        elif command == "peer":
+            self._link(session, value)
+        elif command == "session":
+            session.resumed = value == self.token
+        elif command == "resume":
+            # a join, with only the messages that followed since when the
+            # client had the token of this server
+            name, since = value
+            if not session.resumed:
+                since = None
+            if name != LOBBY:
+                self.join(session, name, since)
+            elif session.welcome:
+                session.cursor = since
+            elif since is not None:
+                self._replay(
+                    session, self.history.since(since, self.replay_limit)
+                )
+        elif command == "leave":
+            self.leave(session, value)
+        elif command == "compress":
+            session.compressed = bool(value) and self.compression
+            self.send_to(
+                connection, session.encode("compress", int(session.compressed))
+            )
+        elif command == "metrics":
+            # local peers only, they see every session
+            if connection.family == socket.AF_UNIX or \
+                    connection.getpeername()[0] in ("127.0.0.1", "::1"):
+                self.send_to(
+                    connection,
+                    session.pack(
+                        session.encode("metrics", self.session_metrics())
                     )
-                    self.connection_pool.remove(connection)
+                )
+        elif command == "message":
+            name, _, self.message = value
+            room = self._joined(session, name)
+            if room is not None:
+                self._send_to_all(connection, room)
+                self._charge(session, session.messages, 1, True)
+                self._charge(session, room.messages, 1, False)
+                self._charge(session, room.bytes, len(self.message), False)
+
+    def _channel(self, session: Session) -> bool:
+        # whether the session can carry a file, it then leaves the lobby
+        connection = session.connection
+        if self.files is None or session.name is not None:
+            log.warning("[%s] Refusing a transfer", self)
+            self._drop(connection)
+            return False
+        self._detach(session)
+        return True
+
+    def _detach(self, session: Session):
+        # the session is no client any more, nothing is sent to it unasked
+        connection = session.connection
+        self.sessions.remove(session.fd)
+        session.welcome = False
+        self.timers.cancel(connection)
+        self.throttles.cancel(connection)
+        self.resume_reading(connection)
+
+    def _upload(self, session: Session, value):
+        room, name, size, checksums = value
+        if self.files is None or not self.files.accepts(name, size, checksums):
+            log.warning("[%s] Refusing %s of %d bytes", self, name, size)
+            self._drop(session.connection)
+            return
+        if not self._channel(session):
+            return
+        identifier = file_id(size, checksums)
+        writer = self.files.writer(identifier, size, checksums)
+        self.uploads[session.connection] = session, writer, value
+        self.send_to(
+            session.connection, session.encode("offset", writer.offset)
+        )
+        if writer.done:
+            self._uploaded(session.connection)
+
+    def _receive_upload(self, connection: socket.socket) -> int:
+        session, writer, _ = self.uploads[connection]
+        if writer.done:
+            return len(connection.recv(4096))  # until the uploader leaves
+        try:
+            received = writer.recv_from(connection)
+        except ValueError as error:
+            log.warning("[%s] %s, dropping the upload", self, error)
+            return 0
+        session.bytes_received += received
+        if writer.done:
+            self._uploaded(connection)
+        return received
+
+    def _uploaded(self, connection: socket.socket):
+        # the uploader is told the file is there as the room is
+        session, writer, offer = self.uploads[connection]
+        room, name, size, checksums = offer
+        identifier = file_id(size, checksums)
+        self.files.complete(identifier, writer, name)
+        log.info("[%s] %s stored as %s", self, name, identifier)
+        self.send_to(connection, session.encode("offer", offer))
+        if room in self.rooms:
+            self._broadcast(self.rooms[room], "offer", offer, since=9)
+
+    def _download(self, session: Session, value):
+        identifier, offset = value
+        if self.files is None or not self.files.has(identifier):
+            log.warning("[%s] No file %s to send", self, identifier)
+            self._drop(session.connection)
+            return
+        if not self._channel(session):
+            return
+        connection = session.connection
+        name, size, checksums = self.files.description(identifier)
+        file = open(self.files.path(identifier), "rb")
+        self.downloads[connection] = file
+        self.send_to(
+            connection, session.encode("offer", (LOBBY, name, size, checksums))
+        )
+        offset = min(offset, size)
+        self.send_file(connection, file.fileno(), offset, size - offset)
+
+    def _joined(self, session: Session, name: str):
+        # the room if the session is in it
+        if name == LOBBY:
+            return self.lobby
+        if name in session.rooms:
+            return self.rooms[name]
+        return None
+
+    def session_metrics(self) -> str:
+        lines = [self.metrics.render()]
+        for session in self.sessions:
+            queue = self._outbound.get(session.connection)
+            if queue is None:
+                continue
+            label = labels(session=session.name or "", fd=session.fd)
+            for name, value in (
+                    ("bytes_received", session.bytes_received),
+                    ("bytes_sent", queue.sent),
+                    ("frames_received", session.frames_received),
+                    ("frames_queued", queue.queued),
+                    ("outbound_bytes", queue.bytes),
+            ):
+                lines.append(f"chat_session_{name}{label} {value}\n")
+        return "".join(lines)
 
-    def _send_to_all(self, sender: socket.socket):
-        for connection in self.connection_pool:  # type: socket.socket
-            if not connection == sender:
-                connection.send(pickle.dumps(("message", self.message)))
+    def _replay(self, session: Session, frames: bytes):
+        # the stored frames go out as they are, in a single write, or all
+        # deflated together
+        if frames:
+            self.send_to(session.connection, session.pack(frames))
 
-    def __str__(self):
-        return self.name
+    def eviction_notice(self, connection: socket.socket, reason: str):
+        session = self.sessions.get(connection.fileno())
+        if session is None or session.version is None:
+            return None
+        return session.encode(
+            "message", (LOBBY, 0, f"<Disconnected by {self}: {reason}>\n")
+        )
+
+    def on_disconnect(self, connection: socket.socket):
+        # nobody is left to tell when the server is stopping
+        session = self.sessions.get(connection.fileno())
+        if session is not None and session.connection is connection:
+            if self.connected:
+                self.update_info(connection, None, remove=True)
+            self.sessions.remove(session.fd)
+        self.timers.cancel(connection)
+        self.throttles.cancel(connection)
+        link = self.peers.pop(connection, None)
+        if link is not None:
+            self._unlink(link)
+        elif connection in self.uploads:
+            self.uploads.pop(connection)[1].close()
+        elif connection in self.downloads:
+            self.downloads.pop(connection).close()
+
+    def _send_to_all(self, sender: socket.socket, room: Room = None):
+        if room is None:
+            room = self.lobby
+        self._publish(room, self.message, sender)
+        if self.bus is not None:
+            self.bus.sendall(encode("relay", (room.name, self.message)))
+        if self.peers:
+            self._gossip(
+                encode("relay", (room.name, self.message), NODE_VERSION)
+            )
+
+    def _publish(self, room: Room, text: str, sender=None):
+        message = (room.name, room.history.next_sequence, text)
+        # lobby messages are stored in version 3 which every later session
+        # reads as well, the other rooms only exist since version 4
+        first = 3 if room is self.lobby else 4
+        frame = encode("message", message, first)
+        room.history.append(frame)
+        frames = {
+            (version, False): frame for version in range(first, VERSION + 1)
+        }
+        self._broadcast(room, "message", message, sender, frames)
+
+    def _broadcast(self, room: Room, command: str, value, sender=None,
+                   frames=None, since=LEGACY):
+        # every codec version is encoded once, the frame is then shared by
+        # the outbound queues of all the sessions speaking it, from since
+        if frames is None:
+            frames = dict()
+        started = time.perf_counter()
+        for session in self._members(room).snapshot():
+            if session.version is None or session.connection == sender or \
+                    session.version < since:
+                continue
+            self.send_to(
+                session.connection,
+                self._frame_for(session, frames, command, value)
+            )
+        self._fan_out.observe(time.perf_counter() - started)
+
+    def _frame_for(self, session: Session, frames: dict, command: str,
+                   value) -> bytes:
+        # a broadcast is encoded once per codec version, then deflated once
+        # for all the sessions asking for compression
+        frame = frames.get(session.codec)
+        if frame is None:
+            frame = frames.get((session.version, False))
+            if frame is None:
+                frame = frames[session.version, False] = session.encode(
+                    command, value
+                )
+            frame = frames[session.codec] = session.pack(frame)
+        return frame
 
 
 def main():
-    if len(sys.argv) > 1:
-        name = sys.argv[1]
+    parser = server_arguments("Messenger server")
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="processes sharing the port, each serving part of the clients"
+    )
+    parser.add_argument(
+        "--history", type=int, default=100,
+        help="messages kept in memory"
+    )
+    parser.add_argument(
+        "--history-dir", default=None,
+        help="directory of the on-disk message log, none by default"
+    )
+    parser.add_argument(
+        "--backlog", type=int, default=20,
+        help="last messages sent to the clients joining"
+    )
+    parser.add_argument(
+        "--idle-timeout", type=float, default=90,
+        help="seconds of silence before a client is dropped, 0 never drops"
+    )
+    parser.add_argument(
+        "--files-dir",
+        default=os.path.join(tempfile.gettempdir(), "msn-files"),
+        help="directory of the files sent through the server"
+    )
+    parser.add_argument(
+        "--max-file-size", type=int, default=4096,
+        help="megabytes, the largest file accepted, 0 refuses them all"
+    )
+    parser.add_argument(
+        "--no-compression", dest="compression", action="store_false",
+        help="never send deflated frames, even to the clients asking"
+    )
+    parser.add_argument(
+        "--rate-messages", type=float, default=DEFAULT_FLOOD.messages,
+        help="messages a second a client may send, 0 for no limit"
+    )
+    parser.add_argument(
+        "--rate-bytes", type=float, default=DEFAULT_FLOOD.bytes,
+        help="bytes a second a client may send, 0 for no limit"
+    )
+    parser.add_argument(
+        "--room-rate-messages", type=float,
+        default=DEFAULT_FLOOD.room_messages,
+        help="messages a second a room may carry, 0 for no limit"
+    )
+    parser.add_argument(
+        "--room-rate-bytes", type=float, default=DEFAULT_FLOOD.room_bytes,
+        help="characters a second a room may carry, 0 for no limit"
+    )
+    parser.add_argument(
+        "--rate-burst", type=float, default=DEFAULT_FLOOD.burst,
+        help="seconds worth of sending allowed at once"
+    )
+    parser.add_argument(
+        "--federate", action="store_true",
+        help="take links from other servers as a node of a federation, "
+             "they are trusted with every message"
+    )
+    parser.add_argument(
+        "--peer", action="append", type=peer_address, default=list(),
+        help="host:port or unix:/path of a node to link to, implies "
+             "--federate, may be repeated"
+    )
+    args = parser.parse_args()
+    if args.handoff is not None and args.workers > 1:
+        parser.error("a hot restart takes over a single process")
+    federated = args.federate or bool(args.peer)
+    if federated and args.workers > 1:
+        parser.error("a node of a federation is a single process")
+    set_log_level(args.log_level)
+    limits = limits_from(args)
+    flood = FloodLimits(
+        args.rate_messages, args.rate_bytes, args.room_rate_messages,
+        args.room_rate_bytes, args.rate_burst
+    )
+
+    unix = args.unix
+    if unix is not None and args.workers > 1:
+        # bound once, the workers all accept on it
+        unix = unix_listener(unix)
+
+    def make_server(worker=0, bus=None):
+        files = None
+        if args.max_file_size:
+            # shared by the workers, complete files are named after their
+            # content
+            files = FileStore(
+                args.files_dir, args.max_file_size * 1024 * 1024, worker
+            )
+        directory = args.history_dir
+        if directory is not None and bus is not None:
+            directory = os.path.join(directory, f"worker{worker}")
+        server = MSNServer(
+            "", args.port, name=args.name, limits=limits, bus=bus,
+            worker=worker,
+            history=MessageHistory(
+                args.history, directory, opened=args.handoff is None
+            ),
+            backlog=args.backlog, compression=args.compression,
+            idle_timeout=args.idle_timeout, files=files, flood=flood,
+            unix=unix, handoff=args.handoff,
+            peers=args.peer if federated else None
+        )
+        if args.metrics_port is not None:
+            # one port per worker, following the first
+            server.expose_metrics(
+                args.metrics_port + worker, args.metrics_host
+            )
+        return server
+
+    if args.workers > 1:
+        try:
+            run_workers(args.workers, make_server)
+        finally:
+            if unix is not None:
+                os.unlink(unix.getsockname())
+                unix.close()
     else:
-        name = None
-    server = MSNServer("", 7979, name=name)
-    server.start()
+        serve(make_server())
 
 
 if __name__ == '__main__':
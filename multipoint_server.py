@@ -1,72 +1,38 @@
 import socket
-import sys
 
-from utils import Messenger, log
+from utils import SelectorServer, limits_from, serve, server_arguments, \
+    set_log_level
 
 
-class MultipointServer(Messenger):
-    def __init__(self, ip, port, signal=None, name=None):
-        super(MultipointServer, self).__init__(ip, port, signal)
-        if name is not None:
-            self.name = name
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.connection_pool = list()
-        self._sock.bind(self.address)
-        self._sock.listen()
-        self.first_connection = True
-        self.connected = True
+class MultipointServer(SelectorServer):
+    def on_connect(self, connection: socket.socket):
+        self.send_to(connection, f"<Welcome to {self}>\n".encode())
+        self.send_to(
+            connection,
+            f"<There are {len(self.connection_pool)} people "
+            f"online>\n".encode()
+        )
 
-    def start(self):
-        while self.connected:
-            log.info("spawning new listener")
-            connection, address = self._sock.accept()
-            log.info(f"new connection from {address}")
-            connection.settimeout(.5)
-            connection.send(f"<Welcome to {self}>\n".encode())
-            self.connection_pool.append(connection)
-            connection.send(
-                f"<There are {len(self.connection_pool)} people "
-                f"online>\n".encode()
-            )
-            if self.first_connection:
-                self.first_connection = False
-                self.run()
-
-    def _run(self):
-        while self.connected:
-            for connection in self.connection_pool:  # type:socket.socket
-                try:
-                    message = connection.recv(4096)
-                    if message:
-                        self.message = message
-                    else:
-                        raise ConnectionAbortedError
-                    self._send_to_all(connection)
-                    if self.signal is not None:
-                        self.signal.emit()
-                except socket.timeout:
-                    # going to the next connection endpoint
-                    continue
-                except (ConnectionAbortedError, ConnectionResetError):
-                    log.info(
-                        f"[{self}] Someone disconnected, removing agent"
-                    )
-                    self.connection_pool.remove(connection)
+    def receive(self, connection: socket.socket) -> int:
+        received = connection.recv(4096)
+        if received:
+            self.message = received
+            self._send_to_all(connection)
+        return len(received)
 
     def _send_to_all(self, sender: socket.socket):
-        for connection in self.connection_pool:  # type: socket.socket
+        for connection in list(self.connection_pool.values()):
             if not connection == sender:
-                connection.send(self.message)
-
-    def __str__(self):
-        return self.name
+                self.send_to(connection, self.message)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        name = sys.argv[1]
-    else:
-        name = None
-    server = MultipointServer("", 7979, name=name)
-    server.start()
+    args = server_arguments("Multipoint server").parse_args()
+    set_log_level(args.log_level)
+    server = MultipointServer(
+        "", args.port, name=args.name, limits=limits_from(args),
+        unix=args.unix, handoff=args.handoff
+    )
+    if args.metrics_port is not None:
+        server.expose_metrics(args.metrics_port, args.metrics_host)
+    serve(server)
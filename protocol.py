@@ -0,0 +1,584 @@
+import io
+import pickle
+import socket
+import struct
+import zlib
+
+# every frame starts with the command, the version of its schema and the
+# length of the payload that follows
+HEADER = struct.Struct("!BBI")
+VERSION_BYTE = struct.Struct("!B")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+VERSION = 10  # highest schema version this codec speaks
+LEGACY = 0  # peers still sending bare pickles
+PICKLE_MARK = 0x80  # first byte of a pickle, no command uses it
+
+COMMANDS = (
+    "hello", "message", "info", "remove", "roster",
+    # between the worker processes of one server
+    "relay", "shard",
+    # since version 2
+    "presence", "resync",
+    # between the worker processes of one server
+    "delta",
+    # since version 3
+    "history",
+    # since version 4
+    "join", "leave",
+    # since version 5
+    "metrics",
+    # since version 6
+    "compress", "deflated",
+    # since version 7
+    "session", "resume",
+    # since version 8
+    "ping", "pong",
+    # since version 9, on channels carrying a file
+    "upload", "offset", "offer", "download",
+    # since version 10, between the nodes of a federation
+    "peer", "gossip", "names", "change",
+)
+COMMAND_CODES = {command: code for code, command in enumerate(COMMANDS)}
+
+# presence changes, roster versions only exist since version 2 and are 0
+# before that
+JOIN, LEAVE, RENAME = range(3)
+ROSTER_VERSION = struct.Struct("!Q")
+PRESENCE = struct.Struct("!QB")
+# messages are numbered by the server since version 3, 0 before that
+SEQUENCE = struct.Struct("!Q")
+# rooms exist since version 4, everything before happens in the lobby
+LOBBY = ""
+ROOM_LENGTH = struct.Struct("!B")
+MAX_ROOM_NAME = 255  # bytes
+# since version 6 a peer may ask for compressed frames: deflated frames
+# hold one or more whole frames, compressed on their own against a preset
+# dictionary so the same bytes can go to every peer
+COMPRESS_THRESHOLD = 128  # bytes under which frames are left as they are
+COMPRESS_LEVEL = 6
+DICTIONARY = (
+    b"https://www. .com .org .net localhost has left the chat "
+    b"has entered the chat <Disconnected by : too slow to keep up>\n"
+    b"what can just not but all have this with are for that you and the "
+)
+# since version 9 files go on channels of their own, in chunks checked
+# against the CRC-32 given with the file, a file is named after them
+CHUNK = struct.Struct("!I")
+FILE_ID_SIZE = 32  # bytes of SHA-256
+# since version 10 servers link as nodes of a federation, what they gossip
+# is a frame carried along with an id unique to the federation
+LABEL_LENGTH = struct.Struct("!B")
+NODE_CHANGE = struct.Struct("!QQB")  # version made on, version, change
+
+
+def apply_presence(names: list, change: int, changed: list):
+    if change == JOIN:
+        names.extend(changed)
+    elif change == LEAVE:
+        for name in changed:
+            if name in names:
+                names.remove(name)
+    elif change == RENAME:
+        old, new = changed
+        if old in names:
+            names[names.index(old)] = new
+        else:
+            names.append(new)
+
+
+def _encode_version(value: int) -> bytes:
+    return VERSION_BYTE.pack(value)
+
+
+def _decode_version(payload) -> int:
+    return VERSION_BYTE.unpack_from(payload)[0]
+
+
+def _encode_nothing(value) -> bytes:
+    return b''
+
+
+def _decode_nothing(payload):
+    return None
+
+
+def _decode_lobby(payload) -> str:
+    return LOBBY
+
+
+def _encode_bytes(value: bytes) -> bytes:
+    return value
+
+
+def _decode_bytes(payload) -> bytes:
+    return bytes(payload)
+
+
+def _encode_text(value: str) -> bytes:
+    return value.encode()
+
+
+def _decode_text(payload) -> str:
+    return str(payload, "utf-8")
+
+
+def _encode_unsequenced_message(value: tuple) -> bytes:
+    return value[1].encode()
+
+
+def _decode_unsequenced_message(payload) -> tuple:
+    return 0, str(payload, "utf-8")
+
+
+def _encode_message(value: tuple) -> bytes:
+    sequence, text = value
+    return SEQUENCE.pack(sequence) + text.encode()
+
+
+def _decode_message(payload) -> tuple:
+    sequence, = SEQUENCE.unpack_from(payload)
+    return sequence, str(payload[SEQUENCE.size:], "utf-8")
+
+
+def _encode_sequence(value: int) -> bytes:
+    return SEQUENCE.pack(value)
+
+
+def _decode_sequence(payload) -> int:
+    return SEQUENCE.unpack_from(payload)[0]
+
+
+def _encode_names(value: list) -> bytes:
+    # names come from single line entries, NUL can not appear in them
+    return "\0".join(value).encode()
+
+
+def _decode_names(payload) -> list:
+    if not payload:
+        return list()
+    return str(payload, "utf-8").split("\0")
+
+
+def _encode_unversioned_roster(value: tuple) -> bytes:
+    return _encode_names(value[1])
+
+
+def _decode_unversioned_roster(payload) -> tuple:
+    return 0, _decode_names(payload)
+
+
+def _encode_roster(value: tuple) -> bytes:
+    roster_version, names = value
+    return ROSTER_VERSION.pack(roster_version) + _encode_names(names)
+
+
+def _decode_roster(payload) -> tuple:
+    roster_version, = ROSTER_VERSION.unpack_from(payload)
+    return roster_version, _decode_names(payload[ROSTER_VERSION.size:])
+
+
+def _encode_presence(value: tuple) -> bytes:
+    roster_version, change, changed = value
+    return PRESENCE.pack(roster_version, change) + _encode_names(changed)
+
+
+def _decode_presence(payload) -> tuple:
+    roster_version, change = PRESENCE.unpack_from(payload)
+    return roster_version, change, _decode_names(payload[PRESENCE.size:])
+
+
+def _encode_shard(value: tuple) -> bytes:
+    worker, names = value
+    return VERSION_BYTE.pack(worker) + _encode_names(names)
+
+
+def _decode_shard(payload) -> tuple:
+    return _decode_version(payload), _decode_names(payload[1:])
+
+
+def _encode_delta(value: tuple) -> bytes:
+    worker, change, changed = value
+    return VERSION_BYTE.pack(worker) + _encode_presence((0, change, changed))
+
+
+def _decode_delta(payload) -> tuple:
+    _, change, changed = _decode_presence(payload[1:])
+    return _decode_version(payload), change, changed
+
+
+def _encode_file(value: tuple) -> bytes:
+    name, size, checksums = value
+    name = name.encode()
+    return ROOM_LENGTH.pack(len(name)) + name + SEQUENCE.pack(size) + \
+        struct.pack(f"!{len(checksums)}I", *checksums)
+
+
+def _decode_file(payload) -> tuple:
+    length, = ROOM_LENGTH.unpack_from(payload)
+    end = ROOM_LENGTH.size + length
+    name = str(payload[ROOM_LENGTH.size:end], "utf-8")
+    size, = SEQUENCE.unpack_from(payload, end)
+    end += SEQUENCE.size
+    count = (len(payload) - end) // CHUNK.size
+    return name, size, list(struct.unpack_from(f"!{count}I", payload, end))
+
+
+def _encode_download(value: tuple) -> bytes:
+    identifier, offset = value
+    return bytes.fromhex(identifier) + SEQUENCE.pack(offset)
+
+
+def _decode_download(payload) -> tuple:
+    identifier = bytes(payload[:FILE_ID_SIZE]).hex()
+    return identifier, SEQUENCE.unpack_from(payload, FILE_ID_SIZE)[0]
+
+
+def _encode_label(label: str) -> bytes:
+    label = label.encode()
+    return LABEL_LENGTH.pack(len(label)) + label
+
+
+def _decode_label(payload) -> tuple:
+    # the label and where what follows it starts
+    length, = LABEL_LENGTH.unpack_from(payload)
+    end = LABEL_LENGTH.size + length
+    return str(payload[LABEL_LENGTH.size:end], "utf-8"), end
+
+
+def _encode_gossip(value: tuple) -> bytes:
+    identifier, frame = value
+    return _encode_label(identifier) + frame
+
+
+def _decode_gossip(payload) -> tuple:
+    identifier, end = _decode_label(payload)
+    return identifier, bytes(payload[end:])
+
+
+def _encode_node_names(value: tuple) -> bytes:
+    node, version, names = value
+    return _encode_label(node) + SEQUENCE.pack(version) + \
+        _encode_names(names)
+
+
+def _decode_node_names(payload) -> tuple:
+    node, end = _decode_label(payload)
+    version, = SEQUENCE.unpack_from(payload, end)
+    return node, version, _decode_names(payload[end + SEQUENCE.size:])
+
+
+def _encode_node_change(value: tuple) -> bytes:
+    node, base, version, change, changed = value
+    return _encode_label(node) + NODE_CHANGE.pack(base, version, change) + \
+        _encode_names(changed)
+
+
+def _decode_node_change(payload) -> tuple:
+    node, end = _decode_label(payload)
+    base, version, change = NODE_CHANGE.unpack_from(payload, end)
+    changed = _decode_names(payload[end + NODE_CHANGE.size:])
+    return node, base, version, change, changed
+
+
+def _split_room(value: tuple) -> tuple:
+    # the room and the rest of the value, as the layouts without room take it
+    room, *rest = value
+    return room, rest[0] if len(rest) == 1 else tuple(rest)
+
+
+def _join_room(room: str, value) -> tuple:
+    if isinstance(value, tuple):
+        return (room,) + value
+    return room, value
+
+
+def _before_rooms(encoder, decoder) -> tuple:
+    # values start with their room, layouts from before version 4 only
+    # carry the lobby so the room is left out of their payload
+    def encode_in_lobby(value: tuple) -> bytes:
+        return encoder(_split_room(value)[1])
+
+    def decode_in_lobby(payload) -> tuple:
+        return _join_room(LOBBY, decoder(payload))
+
+    return encode_in_lobby, decode_in_lobby
+
+
+def _in_room(encoder, decoder) -> tuple:
+    # the room name, at most 255 bytes, is put in front of the payload
+    def encode_in_room(value: tuple) -> bytes:
+        room, rest = _split_room(value)
+        room = room.encode()
+        return ROOM_LENGTH.pack(len(room)) + room + encoder(rest)
+
+    def decode_in_room(payload) -> tuple:
+        length, = ROOM_LENGTH.unpack_from(payload)
+        end = ROOM_LENGTH.size + length
+        room = str(payload[ROOM_LENGTH.size:end], "utf-8")
+        return _join_room(room, decoder(payload[end:]))
+
+    return encode_in_room, decode_in_room
+
+
+# layouts of each command by the version that introduced them, a version
+# uses the latest layout introduced at or before it
+_SCHEMAS = {
+    "hello": {1: (_encode_version, _decode_version)},
+    "message": {
+        1: _before_rooms(
+            _encode_unsequenced_message, _decode_unsequenced_message
+        ),
+        3: _before_rooms(_encode_message, _decode_message),
+        4: _in_room(_encode_message, _decode_message),
+    },
+    "info": {1: (_encode_text, _decode_text)},
+    "remove": {1: (_encode_nothing, _decode_nothing)},
+    "roster": {
+        1: _before_rooms(
+            _encode_unversioned_roster, _decode_unversioned_roster
+        ),
+        2: _before_rooms(_encode_roster, _decode_roster),
+        4: _in_room(_encode_roster, _decode_roster),
+    },
+    "relay": {
+        1: _before_rooms(_encode_text, _decode_text),
+        4: _in_room(_encode_text, _decode_text),
+    },
+    "shard": {1: (_encode_shard, _decode_shard)},
+    "presence": {
+        2: _before_rooms(_encode_presence, _decode_presence),
+        4: _in_room(_encode_presence, _decode_presence),
+    },
+    "resync": {
+        2: (_encode_nothing, _decode_lobby),
+        4: (_encode_text, _decode_text),
+    },
+    "delta": {
+        2: _before_rooms(_encode_delta, _decode_delta),
+        4: _in_room(_encode_delta, _decode_delta),
+    },
+    "history": {
+        3: _before_rooms(_encode_sequence, _decode_sequence),
+        4: _in_room(_encode_sequence, _decode_sequence),
+    },
+    "join": {4: (_encode_text, _decode_text)},
+    "leave": {4: (_encode_text, _decode_text)},
+    "metrics": {5: (_encode_text, _decode_text)},
+    "compress": {6: (_encode_version, _decode_version)},
+    "deflated": {6: (_encode_bytes, _decode_bytes)},
+    # the token naming how the server numbers its messages, then a room
+    # with the sequence of the last message received in it
+    "session": {7: (_encode_text, _decode_text)},
+    "resume": {7: _in_room(_encode_sequence, _decode_sequence)},
+    "ping": {8: (_encode_nothing, _decode_nothing)},
+    "pong": {8: (_encode_nothing, _decode_nothing)},
+    # a file for a room, with its name, size and the CRC-32 of each chunk
+    "upload": {9: _in_room(_encode_file, _decode_file)},
+    "offer": {9: _in_room(_encode_file, _decode_file)},
+    # what the receiving end already has, from where the data follows
+    "offset": {9: (_encode_sequence, _decode_sequence)},
+    "download": {9: (_encode_download, _decode_download)},
+    # the id of the node, then frames spread to every node: relays, the
+    # names a node has in a room as of its version, and the presence
+    # changes between two of its versions
+    "peer": {10: (_encode_text, _decode_text)},
+    "gossip": {10: (_encode_gossip, _decode_gossip)},
+    "names": {10: _in_room(_encode_node_names, _decode_node_names)},
+    "change": {10: _in_room(_encode_node_change, _decode_node_change)},
+}
+
+
+def _layouts(command: str) -> list:
+    # the layout of every version from 1 to VERSION, None if not known yet
+    layouts = [None]
+    for version in range(1, VERSION + 1):
+        layouts.append(_SCHEMAS[command].get(version, layouts[-1]))
+    return layouts
+
+
+_ENCODERS = dict()
+_DECODERS = list()
+for _command in COMMANDS:
+    _layout = _layouts(_command)
+    for _version in range(1, VERSION + 1):
+        if _layout[_version] is not None:
+            _ENCODERS[_command, _version] = _layout[_version][0]
+    _DECODERS.append(tuple(
+        layout and layout[1] for layout in _layout
+    ))
+
+
+def encode(command: str, value=None, version=VERSION) -> bytes:
+    payload = _ENCODERS[command, version](value)
+    return HEADER.pack(
+        COMMAND_CODES[command], version, len(payload)
+    ) + payload
+
+
+def decode(frame) -> tuple:
+    code, version, _ = HEADER.unpack_from(frame)
+    if code >= len(COMMANDS):
+        raise ValueError(f"unknown command {code}")
+    if not 0 < version <= VERSION:
+        raise ValueError(f"unsupported version {version}")
+    decoder = _DECODERS[code][version]
+    if decoder is None:
+        raise ValueError(f"{COMMANDS[code]} is not part of version {version}")
+    return COMMANDS[code], decoder(frame[HEADER.size:])
+
+
+def deflate(frames: bytes) -> bytes:
+    # small or incompressible data is returned untouched
+    if len(frames) < COMPRESS_THRESHOLD:
+        return frames
+    compressor = zlib.compressobj(
+        COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+        zlib.Z_DEFAULT_STRATEGY, DICTIONARY
+    )
+    data = compressor.compress(frames) + compressor.flush()
+    if len(data) + HEADER.size >= len(frames):
+        return frames
+    return encode("deflated", data, 6)
+
+
+def inflate(data: bytes) -> bytes:
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=DICTIONARY)
+    frames = decompressor.decompress(data, MAX_FRAME_SIZE)
+    if decompressor.unconsumed_tail:
+        raise ValueError("deflated frames are too large")
+    return frames
+
+
+def decode_frames(frame) -> list:
+    # the commands in a frame, several if it was deflated
+    command, value = decode(frame)
+    if command != "deflated":
+        return [(command, value)]
+    try:
+        frames = inflate(value)
+    except zlib.error as error:
+        raise ValueError(f"corrupt deflated frame: {error}")
+    decoded = list()
+    start = 0
+    while start < len(frames):
+        *_, length = HEADER.unpack_from(frames, start)
+        end = start + HEADER.size + length
+        if end > len(frames):
+            raise ValueError("truncated frame in a deflated one")
+        decoded.append(decode(frames[start:end]))
+        start = end
+    return decoded
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    # legacy peers only send tuples of strings, refusing every global keeps
+    # them from running code through the loads
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"global {module}.{name} is forbidden")
+
+
+# what a legacy peer may send, with the type of the value
+_LEGACY_VALUES = {
+    "hello": int, "info": str, "message": str, "remove": type(None),
+    "join": str, "leave": str, "resync": str, "ping": type(None),
+    "pong": type(None),
+}
+
+
+def loads_legacy(data: bytes) -> tuple:
+    # anything but a known command with a value of its type is refused
+    try:
+        loaded = _LegacyUnpickler(io.BytesIO(data)).load()
+    except Exception as error:
+        raise ValueError(f"undecodable pickle: {error}") from error
+    if type(loaded) is not tuple or len(loaded) != 2:
+        raise ValueError("a legacy message is a command and a value")
+    command, value = loaded
+    if type(command) is not str or command not in _LEGACY_VALUES:
+        raise ValueError(f"unknown legacy command {command!r}")
+    if type(value) is not _LEGACY_VALUES[command]:
+        raise ValueError(f"{command} does not take {type(value).__name__}")
+    if command == "info" and value == "remove":
+        return "remove", None
+    if command == "message":
+        return command, (LOBBY, 0, value)
+    return command, value
+
+
+def dumps_legacy(command: str, value=None) -> bytes:
+    if command == "roster":
+        command, value = "info", value[2]
+    elif command == "message":
+        value = value[2]
+    return pickle.dumps((command, value))
+
+
+class FrameBuffer:
+    # per-connection receive buffer: data is received in place and complete
+    # frames are handed out as views on it, partial frames wait for the rest
+    def __init__(self, size=4096):
+        self._initial_size = size
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # first byte not consumed yet
+        self._end = 0  # first free byte
+
+    def __len__(self):
+        return self._end - self._start
+
+    def recv_from(self, connection: socket.socket) -> int:
+        if self._end == len(self._buffer):
+            self._make_room()
+        received = connection.recv_into(self._view[self._end:])
+        self._end += received
+        return received
+
+    def take(self) -> bytes:
+        # what came after the last frame, once the stream is no longer made
+        # of frames
+        data = bytes(self._view[self._start:self._end])
+        self._start = self._end = 0
+        return data
+
+    def pending(self) -> bytes:
+        # what was received and not handed out yet, left in place
+        return bytes(self._view[self._start:self._end])
+
+    def feed(self, data: bytes):
+        while len(self._buffer) - self._end < len(data):
+            self._make_room()
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def frames(self):
+        # the views are only valid until the next receive
+        while self._end - self._start >= HEADER.size:
+            *_, length = HEADER.unpack_from(self._buffer, self._start)
+            if length > MAX_FRAME_SIZE:
+                raise ValueError(f"frame of {length} bytes is too large")
+            end = self._start + HEADER.size + length
+            if end > self._end:
+                break
+            frame = self._view[self._start:end]
+            self._start = end
+            yield frame
+        if self._start == self._end:
+            self._start = self._end = 0
+            if len(self._buffer) > 4 * self._initial_size:
+                self._resize(self._initial_size)
+
+    def _make_room(self):
+        pending = self._end - self._start
+        if self._start and pending < len(self._buffer) // 2:
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, pending
+        else:
+            self._resize(2 * len(self._buffer))
+
+    def _resize(self, size):
+        pending = self._end - self._start
+        buffer = bytearray(size)
+        buffer[:pending] = self._view[self._start:self._end]
+        self._buffer, self._view = buffer, memoryview(buffer)
+        self._start, self._end = 0, pending
@@ -1,6 +1,7 @@
+import select
 import socket
 
-from utils import Messenger, log
+from utils import Messenger, Waker, log
 
 
 class Server(Messenger):
@@ -11,9 +12,14 @@ class Server(Messenger):
         self.connection = None
         self._sock.bind(self.address)
         self._sock.listen()
+        self._waker = Waker()
 
     def _run(self):
         log.info(f"Server running, listening connections @ {self.address}")
+        # waits for a connection or for stop, whichever comes first
+        readable, *_ = select.select([self._sock, self._waker], [], [])
+        if self._waker in readable:
+            return
         self.connection, addr = self._sock.accept()
         log.info(f"Entering connection from {addr}")
         self.connected = True
@@ -25,11 +31,16 @@ class Server(Messenger):
         while self.connected:
             try:
                 self.message = self.connection.recv(4096)
+                self.deliver()
                 if self.message == b'':
                     self.connected = False
             except socket.timeout:
                 pass
 
+    def wake(self):
+        super().wake()
+        self._waker.wake()
+
     def closing_statement(self):
         self.send_message(f"<{self.name} has closed the chat>\n")
 
@@ -14,8 +14,8 @@ from utils import log
 
 
 class Window(QMainWindow):
-    server_message_signal = pyqtSignal()
-    client_message_signal = pyqtSignal()
+    server_message_signal = pyqtSignal(list)
+    client_message_signal = pyqtSignal(list)
 
     def __init__(self):
         super(Window, self).__init__()
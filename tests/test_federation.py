@@ -0,0 +1,217 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import unittest
+
+from conftest import ROOT, free_port
+from federation import DedupeCache, MessageIds, peer_address
+from msn_client import MSNClient
+from msn_server import MSNServer
+from protocol import JOIN, LEAVE, LOBBY, RENAME
+
+
+def wait_until(condition, timeout=10.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+class DedupeCacheTest(unittest.TestCase):
+    def test_seen_once(self):
+        cache = DedupeCache(4)
+        ids = MessageIds("node")
+        first = ids.next()
+        self.assertTrue(cache.add(first))
+        self.assertFalse(cache.add(first))
+        self.assertIn(first, cache)
+        self.assertNotEqual(ids.next(), first)
+
+    def test_oldest_forgotten(self):
+        cache = DedupeCache(3)
+        for identifier in "abcd":
+            cache.add(identifier)
+        self.assertEqual(len(cache), 3)
+        self.assertNotIn("a", cache)
+        self.assertTrue(cache.add("a"))
+        self.assertFalse(cache.add("d"))
+
+    def test_peer_address(self):
+        self.assertEqual(peer_address("10.0.0.1:7000"), ("10.0.0.1", 7000))
+        self.assertEqual(peer_address(":7000"), ("127.0.0.1", 7000))
+        self.assertEqual(peer_address("unix:/tmp/n"), ("unix:/tmp/n", 0))
+
+
+class GossipMergeTest(unittest.TestCase):
+    # as the gossip of a node called other would be applied
+    def setUp(self):
+        self.server = MSNServer(
+            "127.0.0.1", free_port(), name="node", peers=[]
+        )
+
+    def tearDown(self):
+        self.server.stop()
+
+    def names(self, room=LOBBY) -> list:
+        room = self.server.rooms.get(room)
+        return [] if room is None else room.shards.get("other", [])
+
+    def test_latest_version_wins(self):
+        self.assertTrue(
+            self.server._apply_names(LOBBY, "other", 5, ["alice", "bob"])
+        )
+        self.assertFalse(self.server._apply_names(LOBBY, "other", 4, ["x"]))
+        self.assertFalse(self.server._apply_names(LOBBY, "other", 5, ["x"]))
+        self.assertEqual(self.names(), ["alice", "bob"])
+        self.assertEqual(
+            self.server.roster, ["node", "alice", "bob"]
+        )
+        self.assertTrue(self.server._apply_names(LOBBY, "other", 8, ["bob"]))
+        self.assertEqual(self.names(), ["bob"])
+
+    def test_gone_at_the_same_version(self):
+        self.server._apply_names("room", "other", 5, ["alice"])
+        self.assertTrue(self.server._apply_names("room", "other", 5, []))
+        self.assertNotIn("room", self.server.rooms)
+        # told again only with its next version
+        self.assertFalse(self.server._apply_names("room", "other", 5, []))
+        self.assertTrue(self.server._apply_names("room", "other", 6, ["a"]))
+        self.assertEqual(self.names("room"), ["a"])
+
+    def test_changes_in_order(self):
+        self.server._apply_names(LOBBY, "other", 5, ["alice"])
+        self.server._apply_change(LOBBY, "other", 5, 7, JOIN, ["bob"])
+        self.server._apply_change(
+            LOBBY, "other", 7, 9, RENAME, ["alice", "carol"]
+        )
+        self.assertEqual(self.names(), ["carol", "bob"])
+        self.assertEqual(self.server._versions[LOBBY, "other"][0], 9)
+
+    def test_change_waits_for_its_version(self):
+        self.server._apply_names(LOBBY, "other", 5, ["alice"])
+        self.server._apply_change(LOBBY, "other", 7, 9, LEAVE, ["alice"])
+        self.assertEqual(self.names(), ["alice"])
+        self.server._apply_change(LOBBY, "other", 5, 7, JOIN, ["bob"])
+        self.assertEqual(self.names(), ["bob"])
+        self.assertEqual(self.server._pending, {})
+
+    def test_change_before_the_names(self):
+        self.server._apply_change("room", "other", 3, 4, JOIN, ["bob"])
+        self.assertEqual(self.names("room"), [])
+        self.server._apply_names("room", "other", 3, ["alice"])
+        self.assertEqual(self.names("room"), ["alice", "bob"])
+
+    def test_change_in_the_names_already(self):
+        self.server._apply_names(LOBBY, "other", 5, ["alice"])
+        self.server._apply_names(LOBBY, "other", 9, ["alice", "bob"])
+        self.server._apply_change(LOBBY, "other", 5, 7, JOIN, ["bob"])
+        self.assertEqual(self.names(), ["alice", "bob"])
+        self.assertEqual(self.server._pending, {})
+
+
+class FederationTest(unittest.TestCase):
+    # three linked nodes, each with its own process: b dials a, c dials
+    # both so the gossip reaches it two ways
+    def setUp(self):
+        self.processes = list()
+        self.clients = list()
+        self.ports = [free_port() for _ in range(3)]
+        self.node("a", self.ports[0])
+        self.node("b", self.ports[1], self.ports[0])
+        self.node("c", self.ports[2], self.ports[0], self.ports[1])
+
+    def tearDown(self):
+        for client in self.clients:
+            client.stop()
+        for process in self.processes:
+            process.send_signal(signal.SIGINT)
+        for process in self.processes:
+            self.assertEqual(process.wait(10), 0)
+
+    def node(self, name: str, port: int, *peers: int):
+        command = [
+            sys.executable, os.path.join(ROOT, "msn_server.py"), name,
+            "--port", str(port), "--federate", "--idle-timeout", "0"
+        ]
+        for peer in peers:
+            command += ["--peer", f"127.0.0.1:{peer}"]
+        self.processes.append(subprocess.Popen(
+            command, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
+        ))
+
+        def listening() -> bool:
+            try:
+                socket.create_connection(("127.0.0.1", port), 1).close()
+            except OSError:
+                return False
+            return True
+
+        self.assertTrue(wait_until(listening))
+
+    def client(self, name: str, port: int) -> MSNClient:
+        inbox = list()
+
+        class Signal:
+            def emit(self, messages):
+                inbox.extend(messages)
+
+        client = MSNClient("127.0.0.1", port, message_signal=Signal())
+        client.reconnect = False
+        client.inbox_received = inbox
+        client.name = name
+        client.connect()
+        client.run()
+        self.clients.append(client)
+        return client
+
+    def test_names_and_messages_reach_every_node(self):
+        alice = self.client("alice", self.ports[0])
+        carol = self.client("carol", self.ports[2])
+        self.assertTrue(wait_until(
+            lambda: sorted(alice.server_info) == ["a", "alice", "carol"]
+        ))
+        self.assertTrue(wait_until(
+            lambda: sorted(carol.server_info) == ["alice", "c", "carol"]
+        ))
+        alice.send_message("from a")
+        carol.send_message("from c")
+        self.assertTrue(wait_until(
+            lambda: "from a" in carol.inbox_received
+        ))
+        self.assertTrue(wait_until(
+            lambda: "from c" in alice.inbox_received
+        ))
+        # each message once, whatever the number of ways
+        time.sleep(0.3)
+        self.assertEqual(carol.inbox_received.count("from a"), 1)
+
+    def test_changes_reach_every_node(self):
+        alice = self.client("alice", self.ports[0])
+        bob = self.client("bob", self.ports[1])
+        carol = self.client("carol", self.ports[2])
+        self.assertTrue(wait_until(lambda: len(alice.server_info) == 4))
+        alice.join("room")
+        carol.join("room")
+        self.assertTrue(wait_until(
+            lambda: sorted(carol.rosters.get("room", [])) == [
+                "alice", "carol"
+            ]
+        ))
+        carol.name = "carla"
+        carol.send_info()
+        self.assertTrue(wait_until(
+            lambda: sorted(alice.server_info) == ["a", "alice", "bob", "carla"]
+        ))
+        bob.stop()
+        self.assertTrue(wait_until(
+            lambda: sorted(carol.server_info) == ["alice", "c", "carla"]
+        ))
+        carol.leave("room")
+        self.assertTrue(wait_until(
+            lambda: alice.rosters.get("room") == ["alice"]
+        ))
@@ -0,0 +1,102 @@
+import os
+import tempfile
+import unittest
+
+from history import MessageHistory, SegmentLog
+from protocol import LOBBY, VERSION, encode
+
+
+def frames(first: int, count: int) -> list:
+    return [
+        encode("message", (LOBBY, sequence, f"text {sequence}"), VERSION)
+        for sequence in range(first, first + count)
+    ]
+
+
+class SegmentLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def fill(self, count: int, **options) -> SegmentLog:
+        log = SegmentLog(self.directory, **options)
+        for sequence, frame in enumerate(frames(1, count), 1):
+            log.append(sequence, frame)
+        return log
+
+    def test_reopened_where_it_ended(self):
+        self.fill(10, segment_capacity=4).close()
+        log = SegmentLog(self.directory, segment_capacity=4)
+        self.assertEqual((log.first, log.last), (1, 10))
+        self.assertEqual(log.read_from(3), b''.join(frames(3, 8)))
+        log.close()
+
+    def test_interrupted_append_is_cut(self):
+        self.fill(3).close()
+        path = os.path.join(self.directory, f"{1:020d}.log")
+        size = os.path.getsize(path)
+        with open(path, "ab") as log_file:
+            # written, the crash came before it was indexed
+            log_file.write(frames(4, 1)[0][:-2])
+        log = SegmentLog(self.directory)
+        self.assertEqual(log.last, 3)
+        self.assertEqual(os.path.getsize(path), size)
+        log.append(4, frames(4, 1)[0])
+        self.assertEqual(log.read_from(1), b''.join(frames(1, 4)))
+        log.close()
+
+    def test_indexed_frame_cut_short(self):
+        self.fill(3).close()
+        path = os.path.join(self.directory, f"{1:020d}")
+        with open(f"{path}.log", "rb+") as log_file:
+            log_file.truncate(os.path.getsize(f"{path}.log") - 1)
+        log = SegmentLog(self.directory)
+        self.assertEqual(log.last, 2)
+        self.assertEqual(log.read_from(1), b''.join(frames(1, 2)))
+        # its index entry is written over
+        log.append(3, frames(3, 1)[0])
+        log.close()
+        log = SegmentLog(self.directory)
+        self.assertEqual(log.read_from(1), b''.join(frames(1, 3)))
+        log.close()
+
+    def test_oldest_segments_removed(self):
+        log = self.fill(10, segment_capacity=2, max_segments=3)
+        self.assertEqual((log.first, log.last), (5, 10))
+        self.assertEqual(log.read_from(1), b''.join(frames(5, 6)))
+        self.assertEqual(len(os.listdir(self.directory)), 6)
+        log.close()
+
+
+class RestoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def test_log_opened_once_taken_over(self):
+        previous = MessageHistory(10, self.directory)
+        for frame in frames(1, 5):
+            previous.append(frame)
+        history = MessageHistory(10, self.directory, opened=False)
+        self.assertIsNone(history.log)
+        # written by the previous process after this one started
+        for frame in frames(6, 2):
+            previous.append(frame)
+        previous.close()
+        self.assertTrue(history.restore(7, previous.recent()))
+        self.assertEqual(history.sequence, 7)
+        self.assertEqual(history.since(0, 100), b''.join(frames(1, 7)))
+        history.close()
+
+    def test_log_ending_elsewhere(self):
+        history = MessageHistory(10, self.directory, opened=False)
+        self.assertFalse(history.restore(3, frames(1, 3)))
+        # what the log holds, the sequence goes on from there
+        self.assertEqual(history.sequence, 0)
+        self.assertEqual(history.recent(), [])
+        self.assertEqual(history.append(frames(1, 1)[0]), 1)
+        history.close()
+
+    def test_in_memory(self):
+        history = MessageHistory(10)
+        self.assertTrue(history.restore(3, frames(1, 3)))
+        self.assertEqual(history.next_sequence, 4)
+        self.assertEqual(history.last(2), b''.join(frames(2, 2)))
@@ -0,0 +1,83 @@
+import pickle
+import socket
+import time
+import unittest
+
+from async_msn import AsyncMSNServer
+from conftest import free_port
+from msn_server import MSNServer
+from protocol import LOBBY, loads_legacy
+
+MALFORMED = (
+    pickle.dumps(5),
+    pickle.dumps(("message", 123)),
+    pickle.dumps(("info", 7)),
+    pickle.dumps(("hello", "x")),
+    pickle.dumps(("message", "a", "b")),
+    pickle.dumps((1, "x")),
+    pickle.dumps(("history", ("", 0))),
+    pickle.dumps(("info", "truncated"))[:-3],
+)
+
+
+class LoadsLegacyTest(unittest.TestCase):
+    def test_known_commands(self):
+        self.assertEqual(
+            loads_legacy(pickle.dumps(("message", "hi"))),
+            ("message", (LOBBY, 0, "hi"))
+        )
+        self.assertEqual(
+            loads_legacy(pickle.dumps(("info", "remove"))), ("remove", None)
+        )
+        self.assertEqual(
+            loads_legacy(pickle.dumps(("info", "bob"))), ("info", "bob")
+        )
+
+    def test_malformed(self):
+        for payload in MALFORMED:
+            with self.subTest(payload=payload):
+                with self.assertRaises(ValueError):
+                    loads_legacy(payload)
+
+    def test_globals_are_refused(self):
+        with self.assertRaises(ValueError):
+            loads_legacy(pickle.dumps(("info", socket.socket)))
+
+
+class ServersStayUpTest(unittest.TestCase):
+    def _send_malformed(self, port: int):
+        for payload in MALFORMED:
+            with socket.create_connection(("127.0.0.1", port), 2) as peer:
+                peer.sendall(payload)
+                time.sleep(0.05)
+
+    def _still_serving(self, port: int) -> bool:
+        with socket.create_connection(("127.0.0.1", port), 2) as peer:
+            peer.sendall(pickle.dumps(("info", "still")))
+            peer.settimeout(2)
+            return bool(peer.recv(4096))
+
+    def test_selector_server(self):
+        port = free_port()
+        server = MSNServer("127.0.0.1", port, name="srv")
+        server.start()
+        try:
+            self._send_malformed(port)
+            self.assertTrue(server.reading_thread.is_alive())
+            self.assertTrue(self._still_serving(port))
+        finally:
+            server.stop()
+
+    def test_async_server(self):
+        port = free_port()
+        server = AsyncMSNServer("127.0.0.1", port, name="srv")
+        server.start()
+        time.sleep(0.2)
+        self._send_malformed(port)
+        self.assertTrue(self._still_serving(port))
+        server.stop()  # would wait forever on a handler left behind
+        self.assertFalse(server.reading_thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import socket
+import unittest
+
+from protocol import COMMANDS, HEADER, JOIN, LOBBY, MAX_FRAME_SIZE, RENAME, \
+    VERSION, FrameBuffer, decode, decode_frames, deflate, encode
+
+
+class FrameBufferTest(unittest.TestCase):
+    def test_frames_split_anywhere(self):
+        frames = [
+            encode("message", (LOBBY, sequence, "x" * sequence))
+            for sequence in range(1, 200)
+        ]
+        stream = b''.join(frames)
+        buffer = FrameBuffer(64)
+        received = list()
+        for start in range(0, len(stream), 37):
+            buffer.feed(stream[start:start + 37])
+            received.extend(bytes(frame) for frame in buffer.frames())
+        self.assertEqual(received, frames)
+        self.assertEqual(len(buffer), 0)
+
+    def test_partial_frame_waits(self):
+        frame = encode("info", "alice")
+        buffer = FrameBuffer()
+        buffer.feed(frame[:HEADER.size + 2])
+        self.assertEqual(list(buffer.frames()), [])
+        self.assertEqual(buffer.pending(), frame[:HEADER.size + 2])
+        buffer.feed(frame[HEADER.size + 2:])
+        self.assertEqual([bytes(view) for view in buffer.frames()], [frame])
+
+    def test_take_what_follows(self):
+        buffer = FrameBuffer()
+        buffer.feed(encode("ping", None) + b"raw")
+        self.assertEqual(len(list(buffer.frames())), 1)
+        self.assertEqual(buffer.take(), b"raw")
+        self.assertEqual(len(buffer), 0)
+
+    def test_too_large(self):
+        buffer = FrameBuffer()
+        buffer.feed(HEADER.pack(1, VERSION, MAX_FRAME_SIZE + 1))
+        with self.assertRaises(ValueError):
+            list(buffer.frames())
+
+    def test_recv_from(self):
+        frame = encode("message", (LOBBY, 1, "y" * 10000))
+        reader, writer = socket.socketpair()
+        with reader, writer:
+            writer.sendall(frame)
+            buffer = FrameBuffer(16)
+            received = list()
+            while not received:
+                self.assertTrue(buffer.recv_from(reader))
+                received.extend(bytes(view) for view in buffer.frames())
+        self.assertEqual(received, [frame])
+
+
+class LayoutsTest(unittest.TestCase):
+    def test_message(self):
+        value = (LOBBY, 5, "hi")
+        # no sequence before version 3, no room before version 4
+        self.assertEqual(
+            decode(encode("message", value, 1)), ("message", (LOBBY, 0, "hi"))
+        )
+        self.assertEqual(len(encode("message", value, 2)), HEADER.size + 2)
+        self.assertEqual(decode(encode("message", value, 3))[1], value)
+        self.assertEqual(
+            decode(encode("message", ("room", 5, "hi"), 4))[1],
+            ("room", 5, "hi")
+        )
+
+    def test_roster(self):
+        value = (LOBBY, 3, ["alice", "bob"])
+        self.assertEqual(
+            decode(encode("roster", value, 1))[1], (LOBBY, 0, ["alice", "bob"])
+        )
+        self.assertEqual(decode(encode("roster", value, 2))[1], value)
+        self.assertEqual(
+            decode(encode("roster", ("r", 3, ["a"]), 4))[1], ("r", 3, ["a"])
+        )
+
+    def test_presence(self):
+        value = (LOBBY, 7, RENAME, ["old", "new"])
+        self.assertEqual(decode(encode("presence", value, 2))[1], value)
+        self.assertEqual(
+            decode(encode("presence", ("r", 7, JOIN, ["a"]), 4))[1],
+            ("r", 7, JOIN, ["a"])
+        )
+
+    def test_not_in_version(self):
+        frame = bytearray(encode("join", "room", 4))
+        frame[1] = 3
+        with self.assertRaises(ValueError):
+            decode(frame)
+        frame = bytearray(encode("ping", None))
+        frame[1] = VERSION + 1
+        with self.assertRaises(ValueError):
+            decode(frame)
+        with self.assertRaises(ValueError):
+            decode(HEADER.pack(len(COMMANDS), 1, 0))
+
+    def test_latest_layouts(self):
+        values = {
+            "hello": VERSION, "message": ("r", 9, "text"), "info": "alice",
+            "remove": None, "roster": ("r", 2, ["a", "b"]),
+            "relay": ("r", "text"), "shard": (3, ["a"]),
+            "presence": ("r", 4, JOIN, ["c"]), "resync": "r",
+            "delta": ("r", 1, JOIN, ["d"]), "history": ("r", 12),
+            "join": "r", "leave": "r", "metrics": "chat_rooms 1",
+            "compress": 1, "deflated": b"data", "session": "token",
+            "resume": ("r", 8), "ping": None, "pong": None,
+            "upload": ("r", "file.txt", 10, [1, 2]),
+            "offer": ("r", "file.txt", 10, [1, 2]), "offset": 4,
+            "download": ("ab" * 32, 6), "peer": "node",
+            "gossip": ("node:1", encode("info", "x")),
+            "names": ("r", "node", 3, ["a", "b"]),
+            "change": ("r", "node", 3, 4, RENAME, ["a", "b"]),
+        }
+        self.assertEqual(set(values), set(COMMANDS))
+        for command, value in values.items():
+            with self.subTest(command=command):
+                self.assertEqual(
+                    decode(encode(command, value)), (command, value)
+                )
+
+    def test_deflated(self):
+        values = [
+            (LOBBY, sequence, "has entered the chat")
+            for sequence in range(1, 20)
+        ]
+        frames = b''.join(encode("message", value) for value in values)
+        deflated = deflate(frames)
+        self.assertLess(len(deflated), len(frames))
+        self.assertEqual(
+            decode_frames(deflated), [("message", value) for value in values]
+        )
+        small = frames[:HEADER.size]
+        self.assertIs(deflate(small), small)
@@ -0,0 +1,62 @@
+import unittest
+
+from timers import TimerWheel
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.timers = TimerWheel(1.0, slots=8, levels=3, clock=self.clock)
+
+    def advance(self, seconds: float) -> list:
+        self.clock.now += seconds
+        return self.timers.expire()
+
+    def test_expires_when_due(self):
+        self.timers.schedule("a", 3)
+        self.timers.schedule("b", 5)
+        self.assertEqual(self.advance(2), [])
+        self.assertEqual(self.advance(1), ["a"])
+        self.assertEqual(self.advance(2), ["b"])
+        self.assertEqual(len(self.timers), 0)
+
+    def test_never_before_the_next_tick(self):
+        self.timers.schedule("a", 0)
+        self.assertEqual(self.timers.expire(), [])
+        self.assertEqual(self.advance(1), ["a"])
+
+    def test_cancel_and_reschedule(self):
+        self.timers.schedule("a", 2)
+        self.timers.schedule("b", 2)
+        self.timers.cancel("a")
+        self.timers.schedule("b", 6)
+        self.assertNotIn("a", self.timers)
+        self.assertEqual(self.advance(2), [])
+        self.assertEqual(self.advance(4), ["b"])
+
+    def test_far_deadlines_cascade(self):
+        # beyond the first level, and beyond the second
+        for delay in (7, 9, 63, 65, 300):
+            self.timers.schedule(delay, delay)
+        expired = dict()
+        for second in range(1, 301):
+            for key in self.advance(1):
+                expired[key] = second
+        self.assertEqual(expired, {7: 7, 9: 9, 63: 63, 65: 65, 300: 300})
+
+    def test_late_expire_catches_up(self):
+        for delay in range(1, 40):
+            self.timers.schedule(delay, delay)
+        self.assertEqual(sorted(self.advance(100)), list(range(1, 40)))
+
+    def test_power_of_two(self):
+        with self.assertRaises(ValueError):
+            TimerWheel(slots=10)
@@ -0,0 +1,168 @@
+import os
+import pickle
+import socket
+import tempfile
+import time
+import unittest
+import urllib.request
+
+from conftest import free_port
+from msn_server import MSNServer
+from utils import DISCONNECT, DROP_NEW, DROP_OLDEST, OutboundLimits, \
+    OutboundQueue
+
+
+def frame(size: int, fill=b"x") -> bytes:
+    return fill * size
+
+
+class OutboundQueueTest(unittest.TestCase):
+    def test_empty_queue_takes_any_frame(self):
+        queue = OutboundQueue(OutboundLimits(2, 10, DROP_NEW))
+        self.assertIsNone(queue.push(frame(100)))
+        self.assertEqual(queue.push(frame(1)), DROP_NEW)
+        self.assertEqual(len(queue), 1)
+
+    def test_drop_new(self):
+        queue = OutboundQueue(OutboundLimits(2, 100, DROP_NEW))
+        self.assertIsNone(queue.push(frame(10, b"a")))
+        self.assertIsNone(queue.push(frame(10, b"b")))
+        self.assertEqual(queue.push(frame(10, b"c")), DROP_NEW)
+        self.assertEqual(queue.pending(), frame(10, b"a") + frame(10, b"b"))
+        self.assertEqual(queue.bytes, 20)
+
+    def test_drop_oldest(self):
+        queue = OutboundQueue(OutboundLimits(10, 30, DROP_OLDEST))
+        for fill in (b"a", b"b", b"c"):
+            self.assertIsNone(queue.push(frame(10, fill)))
+        self.assertEqual(queue.push(frame(15, b"d")), DROP_OLDEST)
+        self.assertEqual(queue.pending(), frame(10, b"c") + frame(15, b"d"))
+        self.assertEqual(queue.bytes, 25)
+
+    def test_drop_oldest_keeps_the_partial_head(self):
+        queue = OutboundQueue(OutboundLimits(2, 1 << 20, DROP_OLDEST))
+        reader, writer = socket.socketpair()
+        with reader, writer:
+            writer.setblocking(False)
+            writer.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            head = frame(1 << 20, b"a")
+            queue.push(head)
+            queue.flush(writer)
+            self.assertFalse(queue.at_boundary)
+            queue.push(frame(10, b"b"))
+            self.assertEqual(queue.push(frame(10, b"c")), DROP_OLDEST)
+            # it would not fit even alone with the head, nothing is dropped
+            room = len(queue.pending()) - 1
+            queue.limits = OutboundLimits(2, room, DROP_OLDEST)
+            self.assertEqual(queue.push(frame(10, b"d")), DROP_NEW)
+            pending = queue.pending()
+        # what is left of the head, then the newest frame
+        self.assertTrue(pending.endswith(frame(10, b"c")))
+        self.assertEqual(pending[:-10], frame(len(pending) - 10, b"a"))
+
+    def test_drop_oldest_too_large(self):
+        # everything goes, the queue left empty takes it
+        queue = OutboundQueue(OutboundLimits(10, 30, DROP_OLDEST))
+        queue.push(frame(10, b"a"))
+        queue.push(frame(10, b"b"))
+        self.assertEqual(queue.push(frame(40, b"c")), DROP_OLDEST)
+        self.assertEqual(queue.pending(), frame(40, b"c"))
+
+    def test_disconnect(self):
+        queue = OutboundQueue(OutboundLimits(1, 100, DISCONNECT))
+        queue.push(frame(10))
+        self.assertEqual(queue.push(frame(10)), DISCONNECT)
+        self.assertEqual(len(queue), 1)
+
+    def test_flush(self):
+        queue = OutboundQueue()
+        reader, writer = socket.socketpair()
+        with reader, writer:
+            queue.push(b"one")
+            queue.push(b"two")
+            self.assertEqual(queue.flush(writer), 6)
+            self.assertEqual(reader.recv(16), b"onetwo")
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.bytes, 0)
+
+
+class AcceptTest(unittest.TestCase):
+    def test_no_delay_on_tcp(self):
+        path = os.path.join(tempfile.mkdtemp(), "msn.sock")
+        port = free_port()
+        server = MSNServer("127.0.0.1", port, name="srv", unix=path)
+        server.start()
+        try:
+            tcp = socket.create_connection(("127.0.0.1", port))
+            unix = socket.socket(socket.AF_UNIX)
+            unix.connect(path)
+            with tcp, unix:
+                deadline = time.monotonic() + 5
+                while len(server.connection_pool) < 2 and \
+                        time.monotonic() < deadline:
+                    time.sleep(0.01)
+                families = {
+                    connection.family: connection
+                    for connection in server.connection_pool.values()
+                }
+                accepted = families[socket.AF_INET]
+                self.assertTrue(accepted.getsockopt(
+                    socket.IPPROTO_TCP, socket.TCP_NODELAY
+                ))
+                self.assertIn(socket.AF_UNIX, families)
+        finally:
+            server.stop()
+
+    def test_metrics_scraped(self):
+        port, metrics = free_port(), free_port()
+        server = MSNServer("127.0.0.1", port, name="srv")
+        server.expose_metrics(metrics)
+        server.start()
+        try:
+            for _ in range(2):
+                with urllib.request.urlopen(
+                    f"http://127.0.0.1:{metrics}/", timeout=5
+                ) as response:
+                    self.assertIn(b"chat_connections", response.read())
+            # a scraper gone before reading is forgotten as well
+            socket.create_connection(("127.0.0.1", metrics)).close()
+            deadline = time.monotonic() + 5
+            while server._scrapes and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(server._scrapes, {})
+        finally:
+            server.stop()
+
+    def test_slow_scraper_does_not_block(self):
+        port, metrics = free_port(), free_port()
+        server = MSNServer("127.0.0.1", port, name="srv")
+        # more than the socket buffers hold
+        server.metrics.gauge("chat_test", "x" * (32 << 20), lambda: 1)
+        server.expose_metrics(metrics)
+        server.start()
+        try:
+            scraper = socket.socket()
+            scraper.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            scraper.connect(("127.0.0.1", metrics))
+            with scraper:
+                scraper.sendall(b"GET / HTTP/1.0\r\n\r\n")
+                deadline = time.monotonic() + 5
+                # the answer waits in its queue
+                while not any(server._scrapes.values()) and \
+                        time.monotonic() < deadline:
+                    time.sleep(0.01)
+                self.assertTrue(any(server._scrapes.values()))
+                with socket.create_connection(("127.0.0.1", port), 5) as peer:
+                    peer.sendall(pickle.dumps(("info", "bob")))
+                    peer.settimeout(5)
+                    self.assertTrue(peer.recv(4096))
+                scraper.settimeout(5)
+                received = 0
+                while True:
+                    data = scraper.recv(1 << 20)
+                    if not data:
+                        break
+                    received += len(data)
+            self.assertGreater(received, 32 << 20)
+        finally:
+            server.stop()
@@ -0,0 +1,79 @@
+import socket
+import threading
+import unittest
+
+from protocol import JOIN, LOBBY, FrameBuffer, decode, encode
+from utils import DISCONNECT, OutboundLimits
+from workers import RelayBus
+
+
+class SmallBus(RelayBus):
+    limits = OutboundLimits(4, 1024 * 1024, DISCONNECT)
+
+
+class RelayBusTest(unittest.TestCase):
+    def setUp(self):
+        self.workers = dict()
+        self.buffers = dict()
+        ends = dict()
+        for worker in range(3):
+            ends[worker], self.workers[worker] = socket.socketpair()
+            self.buffers[worker] = FrameBuffer()
+        self.restarted = list()
+        self.bus = SmallBus(ends, self.restart)
+        self.thread = threading.Thread(target=self.bus.run)
+        self.thread.start()
+
+    def tearDown(self):
+        for connection in self.workers.values():
+            connection.close()
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+
+    def restart(self, worker: int) -> socket.socket:
+        self.restarted.append(worker)
+        end, self.workers[worker] = socket.socketpair()
+        self.buffers[worker] = FrameBuffer()
+        return end
+
+    def receive(self, worker: int, count: int) -> list:
+        connection, buffer = self.workers[worker], self.buffers[worker]
+        received = list()
+        connection.settimeout(5)
+        while len(received) < count:
+            if buffer.recv_from(connection) == 0:
+                break
+            received.extend(decode(frame) for frame in buffer.frames())
+        return received
+
+    def test_forwards_to_the_others(self):
+        delta = encode("delta", (LOBBY, 0, JOIN, ["alice"]))
+        self.workers[0].sendall(delta)
+        for worker in (1, 2):
+            self.assertEqual(
+                self.receive(worker, 1),
+                [("delta", (LOBBY, 0, JOIN, ["alice"]))]
+            )
+
+    def test_stuck_worker_restarted_and_caught_up(self):
+        self.workers[0].sendall(encode("delta", (LOBBY, 0, JOIN, ["alice"])))
+        self.workers[2].sendall(encode("delta", (LOBBY, 2, JOIN, ["bob"])))
+        self.receive(1, 2)
+        stuck = self.workers[2]
+        relay = encode("relay", ("room", "x" * 65536))
+        # worker 2 reads nothing, its queue overflows once the kernel
+        # buffers are full
+        received = list()
+        while not self.restarted:
+            self.workers[0].sendall(relay)
+            received.extend(self.receive(1, 1))
+        self.assertEqual(self.restarted, [2])
+        stuck.close()
+        # the names of the others, without its own former ones
+        self.assertEqual(
+            self.receive(2, 1),
+            [("delta", (LOBBY, 0, JOIN, ["alice"]))]
+        )
+        # among the relays sent meanwhile
+        while ("shard", (2, [])) not in received:
+            received.extend(self.receive(1, 1))
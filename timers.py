@@ -0,0 +1,88 @@
+import time
+from typing import Dict, Hashable
+
+
+class TimerWheel:
+    # hierarchical timing wheel: the first level has a slot for each of the
+    # next ticks, every level above covers slots times more ticks with
+    # coarser slots, emptied into the lower levels as the clock reaches
+    # them; scheduling, cancelling and expiring a timer cost O(1) and a tick
+    # only looks at the slots due
+    def __init__(self, resolution=1.0, slots=64, levels=4,
+                 clock=time.monotonic):
+        if slots & (slots - 1):
+            raise ValueError("the number of slots must be a power of 2")
+        self.resolution = resolution  # seconds in a tick
+        self._bits = slots.bit_length() - 1
+        self._mask = slots - 1
+        # key -> deadline tick in each slot
+        self._levels = [
+            [dict() for _ in range(slots)] for _ in range(levels)
+        ]
+        self._where = dict()  # type: Dict[Hashable, dict]
+        self._clock = clock
+        self._now = self._tick(clock())
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def _tick(self, when: float) -> int:
+        return int(when / self.resolution)
+
+    def schedule(self, key: Hashable, delay: float):
+        # replaces the timer of the key if it has one, a timer is never
+        # due before the next tick
+        self.cancel(key)
+        deadline = self._tick(self._clock() + delay)
+        self._place(key, max(deadline, self._now + 1))
+
+    def cancel(self, key: Hashable):
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            del slot[key]
+
+    def _place(self, key: Hashable, deadline: int):
+        distance = deadline - self._now
+        level = 0
+        while level < len(self._levels) - 1 and \
+                distance >> (self._bits * (level + 1)):
+            level += 1
+        index = (deadline >> (self._bits * level)) & self._mask
+        slot = self._levels[level][index]
+        slot[key] = deadline
+        self._where[key] = slot
+
+    def expire(self, now: float = None) -> list:
+        # the keys whose deadline has passed, their timers are removed
+        target = self._tick(self._clock() if now is None else now)
+        expired = list()
+        if not self._where:
+            self._now = max(self._now, target)
+            return expired
+        while self._now < target:
+            self._now += 1
+            self._cascade()
+            slot = self._levels[0][self._now & self._mask]
+            if slot:
+                for key in slot:
+                    del self._where[key]
+                expired.extend(slot)
+                slot.clear()
+        return expired
+
+    def _cascade(self):
+        # at the start of each of its rounds, a level hands the slot coming
+        # up to the levels below
+        level = 1
+        while level < len(self._levels) and \
+                not self._now & ((1 << (self._bits * level)) - 1):
+            index = (self._now >> (self._bits * level)) & self._mask
+            slot = self._levels[level][index]
+            timers = list(slot.items())
+            slot.clear()
+            for key, deadline in timers:
+                self._place(key, deadline)
+            level += 1
@@ -0,0 +1,239 @@
+import hashlib
+import os
+import socket
+import struct
+import zlib
+
+from protocol import FrameBuffer, LOBBY, MAX_ROOM_NAME, SEQUENCE, VERSION, \
+    decode, decode_frames, encode
+from utils import log, open_connection
+
+CHUNK_SIZE = 1024 * 1024  # bytes checked at once
+TRANSFER_VERSION = 9  # first version carrying files
+
+
+def chunks(size: int) -> int:
+    return (size + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+
+def describe(path: str) -> tuple:
+    # the size of the file and the CRC-32 of each of its chunks, read
+    # through a single preallocated buffer
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    checksums = list()
+    size = 0
+    with open(path, "rb", buffering=0) as file:
+        while True:
+            filled = 0
+            while filled < CHUNK_SIZE:
+                read = file.readinto(view[filled:])
+                if not read:
+                    break
+                filled += read
+            if not filled:
+                break
+            checksums.append(zlib.crc32(view[:filled]))
+            size += filled
+            if filled < CHUNK_SIZE:
+                break
+    return size, checksums
+
+
+def file_id(size: int, checksums: list) -> str:
+    # the data is checked against the checksums, naming the file after
+    # them names it after its content
+    digest = hashlib.sha256(SEQUENCE.pack(size))
+    digest.update(struct.pack(f"!{len(checksums)}I", *checksums))
+    return digest.hexdigest()
+
+
+class ChunkWriter:
+    # data is received in a preallocated chunk and only written once its
+    # checksum matches, the file always ends on a checked chunk which is
+    # where a transfer resumes from
+    def __init__(self, path: str, size: int, checksums: list):
+        if len(checksums) != chunks(size):
+            raise ValueError(f"{len(checksums)} checksums for {size} bytes")
+        self.path = path
+        self.size = size
+        self.checksums = checksums
+        self._file = open(path, "ab", buffering=0)
+        length = self._file.seek(0, os.SEEK_END)
+        self.offset = min(size, length - length % CHUNK_SIZE)
+        if self.offset != length:
+            self._file.truncate(self.offset)
+        self._buffer = bytearray(min(CHUNK_SIZE, size) or 1)
+        self._view = memoryview(self._buffer)
+        self._filled = 0
+
+    @property
+    def done(self) -> bool:
+        return self.offset == self.size
+
+    @property
+    def _expected(self) -> int:
+        # bytes of the chunk being received
+        return min(CHUNK_SIZE, self.size - self.offset)
+
+    def recv_from(self, connection: socket.socket) -> int:
+        received = connection.recv_into(
+            self._view[self._filled:self._expected]
+        )
+        self._filled += received
+        if received and self._filled == self._expected:
+            self._commit()
+        return received
+
+    def write(self, data: bytes):
+        data = memoryview(data)
+        while data and not self.done:
+            taken = min(len(data), self._expected - self._filled)
+            self._view[self._filled:self._filled + taken] = data[:taken]
+            self._filled += taken
+            data = data[taken:]
+            if self._filled == self._expected:
+                self._commit()
+
+    def _commit(self):
+        chunk = self._view[:self._filled]
+        index = self.offset // CHUNK_SIZE
+        self._filled = 0
+        if zlib.crc32(chunk) != self.checksums[index]:
+            raise ValueError(f"chunk {index} does not match its checksum")
+        self._file.write(chunk)
+        self.offset += len(chunk)
+
+    def close(self):
+        self._file.close()
+
+
+class FileStore:
+    # complete files are named after their id, with the description given
+    # on upload next to them; the checked part of the uploads in progress
+    # is kept to resume from
+    def __init__(self, directory: str, max_size: int, worker=0):
+        self.directory = directory
+        self.max_size = max_size
+        self.worker = worker
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, identifier: str) -> str:
+        return os.path.join(self.directory, identifier)
+
+    def has(self, identifier: str) -> bool:
+        return os.path.exists(self.path(identifier))
+
+    def accepts(self, name: str, size: int, checksums: list) -> bool:
+        return 0 < len(name.encode()) <= MAX_ROOM_NAME and \
+            size <= self.max_size and len(checksums) == chunks(size)
+
+    def writer(self, identifier: str, size: int,
+               checksums: list) -> ChunkWriter:
+        # one part per worker, workers may share the directory
+        part = f"{self.path(identifier)}.{self.worker}.part"
+        return ChunkWriter(part, size, checksums)
+
+    def complete(self, identifier: str, writer: ChunkWriter, name: str):
+        writer.close()
+        if self.has(identifier):
+            os.remove(writer.path)  # uploaded before
+            return
+        description = encode(
+            "offer", (LOBBY, name, writer.size, writer.checksums),
+            TRANSFER_VERSION
+        )
+        with open(f"{self.path(identifier)}.offer", "wb") as file:
+            file.write(description)
+        os.replace(writer.path, self.path(identifier))
+
+    def description(self, identifier: str) -> tuple:
+        # name, size and checksums
+        with open(f"{self.path(identifier)}.offer", "rb") as file:
+            return decode(file.read())[1][1:]
+
+
+def _open_channel(address: tuple, timeout: float) -> tuple:
+    channel = open_connection(address, timeout)
+    buffer = FrameBuffer()
+    try:
+        channel.sendall(encode("hello", VERSION, 1))
+        version = _expect(channel, buffer, "hello")
+        if version < TRANSFER_VERSION:
+            raise ValueError(f"the server speaks version {version}")
+    except BaseException:
+        channel.close()
+        raise
+    return channel, buffer, version
+
+
+def _expect(channel: socket.socket, buffer: FrameBuffer, command: str):
+    # the value of the next frame with that command, the others are skipped
+    while True:
+        for frame in buffer.frames():
+            for received, value in decode_frames(frame):
+                if received == command:
+                    return value
+        if buffer.recv_from(channel) == 0:
+            raise ConnectionAbortedError(f"closed before the {command}")
+
+
+def upload(address: tuple, path: str, room=LOBBY, attempts=3,
+           timeout=30.0) -> str:
+    # offers the file to the room once the server has all of it, returns
+    # its id; an interrupted upload resumes from what the server checked
+    size, checksums = describe(path)
+    name = os.path.basename(path).encode()[:MAX_ROOM_NAME].decode(
+        errors="ignore"
+    )
+    for attempt in range(1, attempts + 1):
+        try:
+            channel, buffer, version = _open_channel(address, timeout)
+            with channel, open(path, "rb") as file:
+                channel.sendall(encode(
+                    "upload", (room, name, size, checksums), version
+                ))
+                offset = _expect(channel, buffer, "offset")
+                if offset < size:
+                    channel.sendfile(file, offset, size - offset)
+                _expect(channel, buffer, "offer")
+                return file_id(size, checksums)
+        except (OSError, ValueError, struct.error) as error:
+            log.warning(f"Upload of {path}, attempt {attempt}: {error}")
+            if attempt == attempts:
+                raise
+
+
+def download(address: tuple, identifier: str, path: str, attempts=3,
+             timeout=30.0):
+    # the data is received next to the path and moved there once complete,
+    # an interrupted download resumes from the last chunk checked
+    part = f"{path}.{identifier}.part"
+    for attempt in range(1, attempts + 1):
+        writer = None
+        try:
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            channel, buffer, version = _open_channel(address, timeout)
+            with channel:
+                channel.sendall(encode(
+                    "download", (identifier, offset - offset % CHUNK_SIZE),
+                    version
+                ))
+                _, _, size, checksums = _expect(channel, buffer, "offer")
+                if file_id(size, checksums) != identifier:
+                    raise ValueError("the server sent another file")
+                writer = ChunkWriter(part, size, checksums)
+                writer.write(buffer.take())
+                while not writer.done:
+                    if writer.recv_from(channel) == 0:
+                        raise ConnectionAbortedError("closed before the end")
+            writer.close()
+            os.replace(part, path)
+            return
+        except (OSError, ValueError, struct.error) as error:
+            log.warning(f"Download of {identifier}, attempt {attempt}: "
+                        f"{error}")
+            if writer is not None:
+                writer.close()
+            if attempt == attempts:
+                raise
@@ -1,16 +1,215 @@
+import argparse
+import atexit
+import collections
+import itertools
 import os
+import queue
+import selectors
+import signal
 import socket
 import sys
 import threading
+import time
 import logging
+import logging.handlers
+import stat
+from typing import Dict, Union
+
+from handoff import asked, hand_over, take_over
+from metrics import Registry, http_response, labels
+
+LOG_QUEUE_SIZE = 10000  # records waiting for the output, the newest are lost
+
+
+class _LogQueueHandler(logging.handlers.QueueHandler):
+    # the record is formatted by the listener, the thread logging it only
+    # hands it over; a full queue drops the record rather than block it
+    dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _LogListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)  # waits for room, the queue drains
+
+
+class RateLimit(logging.Filter):
+    # every message template gets `burst` records, refilled at `rate` per
+    # second; the next record let through tells how many were suppressed
+    def __init__(self, rate=10, burst=20):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._buckets = dict()  # template -> [tokens, last refill, dropped]
+
+    def filter(self, record):
+        now = time.monotonic()
+        bucket = self._buckets.get(record.msg)
+        if bucket is None:
+            bucket = self._buckets[record.msg] = [self.burst, now, 0]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            bucket[2] += 1
+            return False
+        bucket[0] = tokens - 1
+        if bucket[2]:
+            record.msg, record.args = "%s (%d similar suppressed)", (
+                record.getMessage(), bucket[2]
+            )
+            bucket[2] = 0
+        return True
+
+
+class TokenBucket:
+    # rate tokens a second, up to capacity; taking more than there is goes
+    # in debt, repaid before the next take succeeds. Called for every
+    # message, it only updates its own slots
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def take(self, amount: float, now: float) -> float:
+        # seconds until the debt is repaid, 0 when there was enough
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        if tokens > self.capacity:
+            tokens = self.capacity
+        self.tokens = tokens - amount
+        self.stamp = now
+        if self.tokens < 0:
+            return -self.tokens / self.rate
+        return 0
+
+    @property
+    def full(self) -> bool:
+        return self.tokens >= self.capacity - 1
+
 
-log = logging.Logger("PASC")
 handler = logging.StreamHandler(sys.stdout)
 handler.setLevel(logging.DEBUG)
 handler.setFormatter(
     logging.Formatter("%(levelname)s: %(thread)s: %(asctime)s: %(message)s")
 )
-log.addHandler(handler)
+_log_handler = _LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+log = logging.Logger("PASC")
+log.addHandler(_log_handler)
+# events happening for every message go through their own logger, rate
+# limited so a busy room does not flood the output
+traffic = logging.Logger("PASC.traffic")
+traffic.addHandler(_log_handler)
+traffic.addFilter(RateLimit())
+_log_listener = None  # type: _LogListener
+
+
+def start_logging():
+    # stdout is written by a thread of its own, started again in the child
+    # processes as threads do not survive a fork
+    global _log_listener
+    _log_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    _log_listener = _LogListener(
+        _log_handler.queue, handler, respect_handler_level=True
+    )
+    _log_listener.start()
+
+
+def stop_logging():
+    # writes out what is still queued
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
+def set_log_level(level):
+    log.setLevel(level)
+    traffic.setLevel(level)
+
+
+start_logging()
+atexit.register(stop_logging)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=start_logging)
+
+_SCATTER_GATHER = hasattr(socket.socket, "sendmsg")
+
+# peers on the same host may use a Unix socket given as unix:/path in place
+# of the IP, the port is then ignored
+UNIX_PREFIX = "unix:"
+
+
+def unix_path(address) -> Union[None, str]:
+    # the path of a unix:/path address or IP, None for a TCP one
+    host = address[0] if isinstance(address, tuple) else address
+    if isinstance(host, str) and host.startswith(UNIX_PREFIX):
+        return host[len(UNIX_PREFIX):]
+    return None
+
+
+def no_delay(connection: socket.socket):
+    # frames are batched by the queues already, the small ones go out at
+    # once instead of waiting for the previous ones to be acknowledged
+    if connection.family in (socket.AF_INET, socket.AF_INET6):
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def client_socket(address: tuple) -> socket.socket:
+    if unix_path(address) is not None:
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    connection.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    no_delay(connection)
+    return connection
+
+
+def endpoint(address: tuple):
+    # what connect takes for the address
+    path = unix_path(address)
+    return address if path is None else path
+
+
+def open_connection(address: tuple, timeout: float = None) -> socket.socket:
+    if unix_path(address) is None:
+        return socket.create_connection(address, timeout)
+    connection = client_socket(address)
+    connection.settimeout(timeout)
+    try:
+        connection.connect(endpoint(address))
+    except OSError:
+        connection.close()
+        raise
+    return connection
+
+
+def unix_listener(path: str) -> socket.socket:
+    # a socket file left by a server that is gone is replaced, one that
+    # still answers is not
+    path = unix_path(path) or path
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.connect(path)
+            raise OSError(f"{path} is in use")
+    except (FileNotFoundError, ConnectionRefusedError):
+        if os.path.exists(path):
+            os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen()
+    sock.setblocking(False)
+    return sock
 
 
 class Messenger:
@@ -20,10 +219,17 @@ class Messenger:
         self.signal = signal
         self._connected = False
         self._last_message = b''
+        # received and not handed to the signal yet, appended by the reading
+        # thread and emptied in order by deliver
+        self.inbox = collections.deque()
         self._name = f"{os.getlogin()}@{socket.gethostname()}"
         self._agnostic = False
         self.reading_thread = None  # type: threading.Thread
         self._connection = None  # type: socket.socket
+        self.metrics = Registry()
+        self._messages_received = self.metrics.counter(
+            "chat_messages_received_total", "messages received"
+        )
 
     @property
     def address(self):
@@ -47,10 +253,20 @@ class Messenger:
 
     @message.setter
     def message(self, value):
-        log.info(f"[{self}] Got message: {value}")
+        traffic.info("[%s] Got message: %s", self, value)
+        self._messages_received.inc()
         self._last_message = value
         if self.signal is not None:
-            self.signal.emit()
+            self.inbox.append(value)
+
+    def deliver(self):
+        # emits everything received since the last call as a single batch,
+        # once the reading thread is done with what it got at once
+        batch = list()
+        while self.inbox:
+            batch.append(self.inbox.popleft())
+        if batch:
+            self.signal.emit(batch)
 
     @property
     def connected(self):
@@ -92,9 +308,23 @@ class Messenger:
 
     def stop(self):
         if not self._agnostic:
-            self.closing_statement()
+            try:
+                self.closing_statement()
+            except OSError:
+                log.warning(f"[{self}] Could not say goodbye")
         self.connected = False
-        self.reading_thread.join()
+        self.wake()
+        if self.reading_thread is not None:
+            self.reading_thread.join()
+
+    def wake(self):
+        # unblocks the reading thread so it notices it has to stop, pending
+        # data is still delivered before the end of the stream
+        if self.connection is not None:
+            try:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
     def closing_statement(self):
         pass
@@ -114,6 +344,710 @@ class Messenger:
         raise NotImplemented
 
 
+DROP_OLDEST = "drop-oldest"
+DROP_NEW = "drop-new"
+DISCONNECT = "disconnect"
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEW, DISCONNECT)
+
+OutboundLimits = collections.namedtuple(
+    "OutboundLimits", ("max_messages", "max_bytes", "policy")
+)
+DEFAULT_LIMITS = OutboundLimits(1024, 4 * 1024 * 1024, DISCONNECT)
+
+# what a client may send, and what a room may carry: messages and bytes a
+# second, 0 for no limit, with burst seconds worth of tokens to start with
+FloodLimits = collections.namedtuple(
+    "FloodLimits",
+    ("messages", "bytes", "room_messages", "room_bytes", "burst")
+)
+DEFAULT_FLOOD = FloodLimits(20, 64 * 1024, 1000, 1024 * 1024, 2)
+
+
+class FileRegion:
+    # part of a file queued for a socket, the kernel copies it from the
+    # page cache without it ever being read in memory
+    def __init__(self, fd: int, offset: int, count: int):
+        self.fd = fd
+        self.offset = offset
+        self.count = count  # bytes left
+
+    def __len__(self):
+        return self.count
+
+    def send(self, connection: socket.socket) -> int:
+        sent = os.sendfile(connection.fileno(), self.fd, self.offset,
+                           self.count)
+        if not sent:
+            raise OSError("the file ended before the region")
+        self.offset += sent
+        self.count -= sent
+        return sent
+
+
+class OutboundQueue:
+    # frames waiting for the socket to be writable, the frames are shared
+    # between every queue they were broadcast to and never copied
+    max_chunks = 64  # frames handed to the kernel per sendmsg
+
+    def __init__(self, limits: OutboundLimits = DEFAULT_LIMITS):
+        self.limits = limits
+        self.bytes = 0
+        self.queued = 0  # frames accepted so far
+        self.sent = 0  # bytes written so far
+        self._frames = collections.deque()
+        self._offset = 0  # bytes of the first frame already sent
+        self._regions = 0  # file regions among the frames, not counted
+
+    def __len__(self):
+        return len(self._frames)
+
+    @property
+    def at_boundary(self):
+        # nothing was written from the frame at the head of the queue
+        return self._offset == 0
+
+    def _full(self, size):
+        # an empty queue takes any frame, the limits are on the backlog
+        if not self._frames:
+            return False
+        return len(self._frames) >= self.limits.max_messages or \
+            self.bytes + size > self.limits.max_bytes
+
+    def push(self, frame: bytes):
+        # returns the overflow policy applied to make room, if any
+        applied = None
+        if self._full(len(frame)):
+            applied = self.limits.policy
+            if applied != DROP_OLDEST:
+                return applied
+            # the head of the queue may be partially written, keep it
+            keep = 0 if self.at_boundary else 1
+            if keep:
+                # nothing is dropped when dropping them all would not do
+                head = len(self._frames[0]) - self._offset
+                if self.limits.max_messages <= 1 or \
+                        head + len(frame) > self.limits.max_bytes:
+                    return DROP_NEW
+            while len(self._frames) > keep and self._full(len(frame)):
+                dropped = self._frames[keep]
+                del self._frames[keep]
+                self.bytes -= len(dropped)
+        self._frames.append(frame)
+        self.bytes += len(frame)
+        self.queued += 1
+        return applied
+
+    def pending(self) -> bytes:
+        # the frames not written yet, without the files
+        chunks = [
+            frame for frame in self._frames
+            if not isinstance(frame, FileRegion)
+        ]
+        if chunks and self._offset:
+            chunks[0] = chunks[0][self._offset:]
+        return b"".join(chunks)
+
+    def push_file(self, region: FileRegion):
+        # the data stays on disk, the limits do not apply
+        self._frames.append(region)
+        self._regions += 1
+
+    def flush(self, connection: socket.socket) -> int:
+        # returns the number of bytes written
+        written = 0
+        while self._frames:
+            if self._regions and isinstance(self._frames[0], FileRegion):
+                try:
+                    written += self._frames[0].send(connection)
+                except BlockingIOError:
+                    break
+                if not self._frames[0].count:
+                    self._frames.popleft()
+                    self._regions -= 1
+                continue
+            chunks = list(itertools.islice(self._frames, self.max_chunks))
+            if self._regions:
+                chunks = list(itertools.takewhile(
+                    lambda chunk: not isinstance(chunk, FileRegion), chunks
+                ))
+            if self._offset:
+                chunks[0] = memoryview(chunks[0])[self._offset:]
+            try:
+                if _SCATTER_GATHER:
+                    sent = connection.sendmsg(chunks)
+                else:
+                    sent = connection.send(chunks[0])
+            except BlockingIOError:
+                break
+            self.bytes -= sent
+            written += sent
+            sent += self._offset
+            while self._frames and sent >= len(self._frames[0]):
+                sent -= len(self._frames.popleft())
+            self._offset = sent
+        self.sent += written
+        return written
+
+
+class Waker:
+    # self-pipe: a selector watching it returns as soon as wake is called,
+    # from any thread or from a signal handler
+    def __init__(self):
+        self._reader, self._writer = socket.socketpair()
+        self._reader.setblocking(False)
+        self._writer.setblocking(False)
+
+    def fileno(self):
+        return self._reader.fileno()
+
+    def wake(self):
+        try:
+            self._writer.send(b'\0')
+        except OSError:
+            pass  # already full, the selector will wake anyway
+
+    def clear(self, *_):
+        try:
+            while self._reader.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+
+
+class SelectorServer(Messenger):
+    drain_timeout = 1  # seconds given to pending data on stop
+    tick = None  # seconds between two calls to on_tick, at most
+    handoff_timeout = 10  # seconds given to the server taking over
+
+    def __init__(self, ip, port, signal=None, name=None,
+                 limits: OutboundLimits = DEFAULT_LIMITS, reuse_port=False,
+                 unix: Union[None, str, socket.socket] = None,
+                 handoff: str = None):
+        super().__init__(ip, port, signal)
+        if name is not None:
+            self.name = name
+        if limits.policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy {limits.policy}")
+        self.limits = limits
+        # with a handoff path, a server running there hands over its
+        # sockets and clients, this one then listens there for the next
+        inherited = None
+        if handoff is not None:
+            inherited = take_over(handoff, self.handoff_timeout)
+        self._handed_over = False
+        self.taken_over = inherited is not None
+        self._inherited = None  # type: Union[None, tuple]
+        if inherited is None:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                # several processes accept on the port, the kernel spreads
+                # the incoming connections between them
+                self._sock.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_REUSEPORT, 1
+                )
+            self._sock.bind(self.address)
+            self._sock.listen()
+            self._sock.setblocking(False)
+        else:
+            state, sockets = inherited
+            log.info(
+                f"[{self}] taking over {state['connections']} connections"
+            )
+            self._sock = sockets.pop(0)
+            self._inherited = state, sockets
+        self.connection_pool = dict()  # type: Dict[int, socket.socket]
+        self._outbound = dict()  # type: Dict[socket.socket, OutboundQueue]
+        self._paused = set()  # connections not read from for now
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._sock, selectors.EVENT_READ, self._accept)
+        self._waker = Waker()
+        self._selector.register(
+            self._waker, selectors.EVENT_READ, self._waker.clear
+        )
+        # local peers may also come through a Unix socket, given as a path
+        # or already listening when shared by the workers, in which case it
+        # is left for its owner to remove; a server taking over gets it from
+        # the previous one, with the handoff socket
+        self._unix_sock = None  # type: Union[None, socket.socket]
+        self._unix_path = None  # type: Union[None, str]
+        self._handoff_sock = None  # type: Union[None, socket.socket]
+        if inherited is not None:
+            self._handoff_sock = self._inherit()
+            if self._inherited[0]["unix"]:
+                self._unix_sock = self._inherit()
+                if self._inherited[0]["unix_owned"]:
+                    self._unix_path = self._unix_sock.getsockname()
+        elif handoff is not None:
+            self._handoff_sock = unix_listener(handoff)
+        if self._handoff_sock is not None:
+            self._selector.register(
+                self._handoff_sock, selectors.EVENT_READ, self._accept_handoff
+            )
+        if self._unix_sock is None and isinstance(unix, str):
+            self._unix_sock = unix_listener(unix)
+            self._unix_path = self._unix_sock.getsockname()
+        elif self._unix_sock is None:
+            self._unix_sock = unix
+        if self._unix_sock is not None:
+            self._selector.register(
+                self._unix_sock, selectors.EVENT_READ, self._accept
+            )
+        self._metrics_sock = None  # type: socket.socket
+        # scrapers being answered, not clients: never handed over
+        self._scrapes = dict()  # type: Dict[socket.socket, OutboundQueue]
+        if inherited is not None and self._inherited[0]["metrics"]:
+            self._metrics_sock = self._inherit()
+            self._selector.register(
+                self._metrics_sock, selectors.EVENT_READ, self._accept_scrape
+            )
+        self._register_metrics()
+        self.connected = True
+
+    def _inherit(self) -> socket.socket:
+        # the listening sockets come first, in the order they are handed
+        # over
+        sock = self._inherited[1].pop(0)
+        sock.setblocking(False)
+        return sock
+
+    def _register_metrics(self):
+        metrics = self.metrics
+        self._accepted = metrics.counter(
+            "chat_connections_accepted_total", "connections accepted"
+        )
+        self._dropped = metrics.counter(
+            "chat_disconnections_total", "connections closed"
+        )
+        metrics.gauge(
+            "chat_connections", "connections open",
+            lambda: len(self.connection_pool)
+        )
+        self._bytes_received = metrics.counter(
+            "chat_bytes_received_total", "bytes read from the clients"
+        )
+        self._bytes_sent = metrics.counter(
+            "chat_bytes_sent_total", "bytes written to the clients"
+        )
+        self._frames_queued = metrics.counter(
+            "chat_frames_queued_total", "frames queued for the clients"
+        )
+        metrics.gauge(
+            "chat_outbound_frames", "frames waiting in the outbound queues",
+            lambda: sum(len(queue) for queue in self._outbound.values())
+        )
+        metrics.gauge(
+            "chat_outbound_bytes", "bytes waiting in the outbound queues",
+            lambda: sum(queue.bytes for queue in self._outbound.values())
+        )
+        self.overflows = {
+            policy: metrics.counter(
+                "chat_overflows_total", "overflow policies applied",
+                labels(policy=policy)
+            ) for policy in OVERFLOW_POLICIES
+        }
+        self._evictions = metrics.counter(
+            "chat_evictions_total", "clients evicted"
+        )
+
+    def expose_metrics(self, port: int, host="127.0.0.1"):
+        # plain text for Prometheus-style scrapers, on a port of its own,
+        # only reachable from this host unless told otherwise
+        if self._metrics_sock is not None:
+            return  # taken over
+        self._metrics_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._metrics_sock.setsockopt(
+            socket.SOL_SOCKET, socket.SO_REUSEADDR, 1
+        )
+        self._metrics_sock.bind((host, port))
+        self._metrics_sock.listen()
+        self._metrics_sock.setblocking(False)
+        self._selector.register(
+            self._metrics_sock, selectors.EVENT_READ, self._accept_scrape
+        )
+        log.info(f"[{self}] metrics @ {(host, port)}")
+
+    def _accept_scrape(self, sock: socket.socket, mask):
+        try:
+            connection, _ = sock.accept()
+        except BlockingIOError:
+            return
+        connection.setblocking(False)
+        self._scrapes[connection] = OutboundQueue()
+        self._selector.register(connection, selectors.EVENT_READ, self._scrape)
+
+    def _scrape(self, connection: socket.socket, mask):
+        # whatever was asked, the answer is queued like any other write and
+        # the connection closed once it is out; a slow scraper waits for
+        # the socket to be writable rather than block the loop
+        queue = self._scrapes[connection]
+        try:
+            if mask & selectors.EVENT_READ:
+                if not connection.recv(4096):
+                    raise ConnectionResetError
+                queue.push(http_response(self.metrics.render()))
+            queue.flush(connection)
+        except BlockingIOError:
+            return
+        except OSError:
+            pass  # gone, whatever is left goes with it
+        else:
+            if queue:
+                self._selector.modify(
+                    connection, selectors.EVENT_WRITE, self._scrape
+                )
+                return
+        self._selector.unregister(connection)
+        del self._scrapes[connection]
+        connection.close()
+
+    def start(self):
+        log.info(f"[{self}] listening connections @ {self.address}")
+        if self._unix_sock is not None:
+            log.info(f"[{self}] and @ {self._unix_sock.getsockname()}")
+        if self._inherited is not None:
+            self._adopt_all()
+        self.run()
+
+    def _run(self):
+        while self.connected:
+            # only the sockets that are ready are served, an idle server
+            # sleeps in the selector until something happens or wake is
+            # called; once handed over, nothing is read or written any more
+            for key, mask in self._selector.select(self.tick):
+                key.data(key.fileobj, mask)
+                if self._handed_over:
+                    break
+            if self._handed_over:
+                break
+            self.on_tick()
+        if not self._handed_over:
+            self._drain()
+        for connection in list(self.connection_pool.values()):
+            self._drop(connection)
+        self._close()
+
+    def _close(self):
+        # the socket files are removed unless handed over with the sockets
+        self._selector.close()
+        self._sock.close()
+        if self._unix_sock is not None:
+            self._unix_sock.close()
+            if self._unix_path is not None and not self._handed_over:
+                os.unlink(self._unix_path)
+        if self._handoff_sock is not None:
+            path = self._handoff_sock.getsockname()
+            self._handoff_sock.close()
+            if not self._handed_over:
+                os.unlink(path)
+        if self._metrics_sock is not None:
+            self._metrics_sock.close()
+        for connection in self._scrapes:
+            connection.close()
+        self._waker.close()
+
+    def wake(self):
+        self._waker.wake()
+
+    def stop(self):
+        super().stop()
+        if self.reading_thread is None:
+            self._close()  # never started
+
+    def _drain(self):
+        deadline = time.monotonic() + self.drain_timeout
+        while any(self._outbound.values()):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                log.warning(f"[{self}] Stopping with undelivered data")
+                return
+            for key, mask in self._selector.select(remaining):
+                if mask & selectors.EVENT_WRITE:
+                    key.data(key.fileobj, selectors.EVENT_WRITE)
+
+    def _accept_handoff(self, sock: socket.socket, mask):
+        try:
+            channel, _ = sock.accept()
+        except BlockingIOError:
+            return
+        with channel:
+            channel.settimeout(self.handoff_timeout)
+            try:
+                if asked(channel):
+                    self._hand_over(channel)
+            except (OSError, ValueError) as error:
+                log.error(f"[{self}] Could not hand over, still serving: "
+                          f"{error}")
+
+    def _hand_over(self, channel: socket.socket):
+        # the queues are handed over as they are, the new server writes
+        # them before anything else
+        connections = [
+            connection for connection in self.connection_pool.values()
+            if self.can_hand_over(connection)
+        ]
+        listeners = [self._sock, self._handoff_sock]
+        if self._unix_sock is not None:
+            listeners.append(self._unix_sock)
+        if self._metrics_sock is not None:
+            listeners.append(self._metrics_sock)
+        state = {
+            "connections": len(connections),
+            "unix": self._unix_sock is not None,
+            "unix_owned": self._unix_path is not None,
+            "metrics": self._metrics_sock is not None,
+            "pending": [
+                self._outbound[connection].pending().hex()
+                for connection in connections
+            ],
+            "server": self.export_state(connections),
+        }
+        log.info(f"[{self}] handing over {len(connections)} connections")
+        hand_over(channel, state, listeners + connections)
+        self._handed_over = True
+        self.connected = False
+
+    def _adopt_all(self):
+        state, connections = self._inherited
+        self._inherited = None
+        for connection, pending in zip(connections, state["pending"]):
+            self._adopt(connection)
+            if pending:
+                self._outbound[connection].push(bytes.fromhex(pending))
+        self.import_state(state["server"], connections)
+        for connection in connections:
+            self._flush(connection)
+
+    def _adopt(self, connection: socket.socket):
+        connection.setblocking(False)
+        self.connection_pool[connection.fileno()] = connection
+        self._outbound[connection] = OutboundQueue(self.limits)
+        self._selector.register(connection, selectors.EVENT_READ, self._serve)
+
+    def _accept(self, sock: socket.socket, mask):
+        try:
+            connection, address = sock.accept()
+        except BlockingIOError:
+            return
+        log.info("new connection from %s", address or sock.getsockname())
+        self._accepted.inc()
+        connection.setblocking(False)
+        no_delay(connection)
+        self.connection_pool[connection.fileno()] = connection
+        self._outbound[connection] = OutboundQueue(self.limits)
+        self._selector.register(connection, selectors.EVENT_READ, self._serve)
+        self.on_connect(connection)
+
+    def _serve(self, connection: socket.socket, mask):
+        if mask & selectors.EVENT_WRITE:
+            self._flush(connection)
+        if mask & selectors.EVENT_READ and connection in self._outbound:
+            self._read(connection)
+
+    def _read(self, connection: socket.socket):
+        try:
+            received = self.receive(connection)
+        except BlockingIOError:
+            return
+        except OSError:
+            received = 0
+        if not received:
+            log.info("[%s] Someone disconnected, removing agent", self)
+            self._drop(connection)
+            return
+        self._bytes_received.inc(received)
+        self.deliver()
+
+    def send_to(self, connection: socket.socket, frame: bytes):
+        queue = self._outbound.get(connection)
+        if queue is None:
+            return
+        applied = queue.push(frame)
+        if applied is not None:
+            self.overflows[applied].inc()
+            if applied == DISCONNECT:
+                self.evict(connection, "too slow to keep up")
+                return
+        if applied != DROP_NEW:
+            self._frames_queued.inc()
+        if len(queue) == 1:
+            # nothing was pending, the socket is most likely writable
+            self._flush(connection)
+
+    def send_file(self, connection: socket.socket, fd: int, offset: int,
+                  count: int):
+        # after the frames already queued, straight from the file
+        queue = self._outbound.get(connection)
+        if queue is None or not count:
+            return
+        queue.push_file(FileRegion(fd, offset, count))
+        if len(queue) == 1:
+            self._flush(connection)
+
+    def evict(self, connection: socket.socket, reason: str):
+        log.warning("[%s] Removing agent: %s", self, reason)
+        self._evictions.inc()
+        notice = self.eviction_notice(connection, reason)
+        if notice and self._outbound[connection].at_boundary:
+            try:
+                connection.send(notice)  # best effort, it is stuck anyway
+            except OSError:
+                pass
+        self._drop(connection)
+
+    def eviction_notice(self, connection: socket.socket, reason: str):
+        return f"<Disconnected by {self}: {reason}>\n".encode()
+
+    def _flush(self, connection: socket.socket):
+        queue = self._outbound.get(connection)
+        if queue is None:
+            return
+        try:
+            self._bytes_sent.inc(queue.flush(connection))
+        except OSError:
+            log.info("[%s] Could not reach someone, removing agent", self)
+            self._drop(connection)
+            return
+        self._watch(connection)
+
+    def _watch(self, connection: socket.socket):
+        # reads are left out while paused, the connection is only
+        # registered while something is awaited on it
+        events = 0 if connection in self._paused else selectors.EVENT_READ
+        if self._outbound[connection]:
+            events |= selectors.EVENT_WRITE
+        try:
+            key = self._selector.get_key(connection)
+        except KeyError:
+            if events:
+                self._selector.register(connection, events, self._serve)
+            return
+        if not events:
+            self._selector.unregister(connection)
+        elif key.events != events:
+            self._selector.modify(connection, events, self._serve)
+
+    def pause_reading(self, connection: socket.socket):
+        if connection in self._outbound:
+            self._paused.add(connection)
+            self._watch(connection)
+
+    def resume_reading(self, connection: socket.socket):
+        if connection in self._outbound:
+            self._paused.discard(connection)
+            self._watch(connection)
+
+    def _drop(self, connection: socket.socket):
+        if connection not in self._outbound:
+            return
+        self._paused.discard(connection)
+        try:
+            self._selector.unregister(connection)
+        except KeyError:
+            pass  # paused with nothing to send
+        del self.connection_pool[connection.fileno()]
+        del self._outbound[connection]
+        self._dropped.inc()
+        # still open, its descriptor still names it
+        self.on_disconnect(connection)
+        connection.close()
+
+    def on_connect(self, connection: socket.socket):
+        pass
+
+    def can_hand_over(self, connection: socket.socket) -> bool:
+        return True
+
+    def export_state(self, connections: list) -> dict:
+        # what the server taking over needs besides the sockets, the
+        # connections are in the order they are handed over
+        return dict()
+
+    def import_state(self, state: dict, connections: list):
+        # the connections were not accepted here, on_connect was not called
+        pass
+
+    def on_tick(self):
+        # after every wake of the loop, and at least every tick seconds when
+        # tick is set
+        pass
+
+    def receive(self, connection: socket.socket) -> int:
+        # handles what is readable on the connection, returns the number of
+        # bytes received, 0 meaning the peer is gone
+        raise NotImplementedError
+
+    def on_disconnect(self, connection: socket.socket):
+        pass
+
+    def __str__(self):
+        return self.name
+
+
+def server_arguments(description) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("name", nargs="?", default=None)
+    parser.add_argument("--port", type=int, default=7979)
+    parser.add_argument(
+        "--unix", default=None,
+        help="also listen on this Unix socket, as unix:/path or a path"
+    )
+    parser.add_argument(
+        "--handoff", default=None,
+        help="Unix socket of the server to take over from, if one runs, "
+             "then listened on for the next one"
+    )
+    parser.add_argument(
+        "--max-messages", type=int, default=DEFAULT_LIMITS.max_messages,
+        help="frames queued for a client before the overflow policy applies"
+    )
+    parser.add_argument(
+        "--max-bytes", type=int, default=DEFAULT_LIMITS.max_bytes,
+        help="bytes queued for a client before the overflow policy applies"
+    )
+    parser.add_argument(
+        "--overflow-policy", choices=OVERFLOW_POLICIES,
+        default=DEFAULT_LIMITS.policy,
+        help="what to do with a client that does not read fast enough"
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, default=None,
+        help="serve the metrics as plain text on this port"
+    )
+    parser.add_argument(
+        "--metrics-host", default="127.0.0.1",
+        help="address the metrics are served on, \"\" for every interface"
+    )
+    parser.add_argument(
+        "--log-level", default="INFO",
+        choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+        help="INFO logs every message, rate limited"
+    )
+    return parser
+
+
+def serve(server: Messenger):
+    # until interrupted or terminated, the server then stops as asked to:
+    # what is pending is still sent and its socket files are removed
+    def stop(signum, frame):
+        server.stop()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    server.start()
+    server.reading_thread.join()
+
+
+def limits_from(args: argparse.Namespace) -> OutboundLimits:
+    return OutboundLimits(
+        args.max_messages, args.max_bytes, args.overflow_policy
+    )
+
+
 def get_available_hosts():
     *_, ips = socket.gethostbyname_ex(socket.gethostname())
     return ["", "127.0.0.1"] + ips
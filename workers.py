@@ -0,0 +1,189 @@
+import os
+import selectors
+import signal
+import socket
+from typing import Callable, Dict
+
+from protocol import COMMAND_CODES, JOIN, FrameBuffer, apply_presence, \
+    decode, encode
+from utils import DISCONNECT, Messenger, OutboundLimits, OutboundQueue, \
+    log, stop_logging, traffic
+
+# the bus must not lose roster changes, a worker too stuck to take them is
+# restarted and told the names the others hold
+BUS_LIMITS = OutboundLimits(1024 * 1024, 256 * 1024 * 1024, DISCONNECT)
+DELTA = COMMAND_CODES["delta"]
+
+
+class RelayBus:
+    # runs in the parent process, every frame a worker writes on its end of
+    # the bus is forwarded to all the other workers; the roster changes are
+    # followed to catch up a restarted worker
+    limits = BUS_LIMITS
+
+    def __init__(self, ends: Dict[int, socket.socket],
+                 restart: Callable[[int], socket.socket] = None):
+        self.ends = dict()  # type: Dict[int, socket.socket]
+        self.restart = restart
+        self._buffers = dict()  # type: Dict[int, FrameBuffer]
+        self._outbound = dict()  # type: Dict[int, OutboundQueue]
+        # the names each worker holds, by room
+        self._shards = dict()  # type: Dict[str, Dict[int, list]]
+        self._selector = selectors.DefaultSelector()
+        for worker, end in ends.items():
+            self._add(worker, end)
+
+    def _add(self, worker: int, end: socket.socket):
+        end.setblocking(False)
+        self.ends[worker] = end
+        self._buffers[worker] = FrameBuffer()
+        self._outbound[worker] = OutboundQueue(self.limits)
+        self._selector.register(end, selectors.EVENT_READ, worker)
+
+    def run(self):
+        while self.ends:
+            for key, mask in self._selector.select():
+                worker = key.data
+                # a worker removed, or restarted, earlier in the batch
+                if self.ends.get(worker) is not key.fileobj:
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self._flush(worker)
+                if mask & selectors.EVENT_READ and worker in self.ends:
+                    self._read(worker)
+        self._selector.close()
+
+    def _read(self, worker: int):
+        try:
+            received = self._buffers[worker].recv_from(self.ends[worker])
+        except BlockingIOError:
+            return
+        except OSError:
+            received = 0
+        if not received:
+            log.warning(f"[bus] worker {worker} is gone")
+            self._remove(worker)
+            return
+        for frame in self._buffers[worker].frames():
+            frame = bytes(frame)
+            if frame[0] == DELTA:
+                self._follow(*decode(frame)[1])
+            self._forward(worker, frame)
+
+    def _follow(self, room: str, worker: int, change: int, changed: list):
+        shards = self._shards.setdefault(room, dict())
+        shard = shards.setdefault(worker, list())
+        apply_presence(shard, change, changed)
+        if not shard:
+            del shards[worker]
+            if not shards:
+                del self._shards[room]
+
+    def _forward(self, sender: int, frame: bytes):
+        for worker in list(self.ends):
+            if worker == sender or worker not in self.ends:
+                continue
+            if self._outbound[worker].push(frame) is not None:
+                traffic.error("[bus] worker %s is stuck", worker)
+                self._restart(worker)
+            else:
+                self._flush(worker)
+
+    def _flush(self, worker: int):
+        if worker not in self.ends:
+            return
+        queue = self._outbound[worker]
+        try:
+            queue.flush(self.ends[worker])
+        except OSError:
+            self._remove(worker)
+            return
+        events = selectors.EVENT_READ
+        if queue:
+            events |= selectors.EVENT_WRITE
+        self._selector.modify(self.ends[worker], events, worker)
+
+    def _remove(self, worker: int):
+        end = self.ends.pop(worker)
+        del self._buffers[worker], self._outbound[worker]
+        self._selector.unregister(end)
+        end.close()
+        # its clients went with it
+        for room in list(self._shards):
+            self._shards[room].pop(worker, None)
+            if not self._shards[room]:
+                del self._shards[room]
+        self._forward(worker, encode("shard", (worker, [])))
+
+    def _restart(self, worker: int):
+        self._remove(worker)
+        if self.restart is None:
+            return
+        self._add(worker, self.restart(worker))
+        log.warning(f"[bus] worker {worker} restarted")
+        for room, shards in self._shards.items():
+            for other, names in shards.items():
+                self._outbound[worker].push(
+                    encode("delta", (room, other, JOIN, list(names)))
+                )
+        self._flush(worker)
+
+
+def run_workers(count: int,
+                make_server: Callable[[int, socket.socket], Messenger]):
+    if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("workers need fork and SO_REUSEPORT")
+    ends = dict()  # type: Dict[int, socket.socket]
+    pids = dict()  # type: Dict[int, int]
+
+    def spawn(worker: int) -> socket.socket:
+        parent_end, worker_end = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            parent_end.close()
+            for end in ends.values():
+                end.close()
+            server = make_server(worker, worker_end)
+
+            def stop(signum, frame):
+                server.connected = False
+                server.wake()
+
+            # the parent relays the interruption to every worker
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, stop)
+            server.start()
+            server.reading_thread.join()
+            stop_logging()
+            os._exit(0)
+        worker_end.close()
+        pids[worker] = pid
+        return parent_end
+
+    def restart(worker: int) -> socket.socket:
+        # gone before the new one opens the same files, its clients connect
+        # again to any worker
+        os.kill(pids[worker], signal.SIGKILL)
+        os.waitpid(pids[worker], 0)
+        end = ends[worker] = spawn(worker)
+        return end
+
+    for worker in range(count):
+        ends[worker] = spawn(worker)
+    log.info(f"[bus] relaying between {count} workers")
+
+    bus = RelayBus(ends, restart)
+
+    def terminate(signum, frame):
+        bus.restart = None  # the workers are stopping, slowly maybe
+        for child in pids.values():
+            try:
+                os.kill(child, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    bus.run()
+    for child in pids.values():
+        os.waitpid(child, 0)